@@ -3,11 +3,101 @@ Main compositor node - receives inputs and sends to frontend
 """
 import json
 import base64
+import hashlib
 import os
 import time
 import numpy as np
 from pathlib import Path
 
+from .lattice_pointcloud import (
+    backproject_depth,
+    cache_octree,
+    compute_bounds,
+    gaussians_from_depth,
+    get_cached_octree,
+    mesh_from_depth,
+    voxel_downsample,
+    PointCloudOctree,
+    DEFAULT_LOD_BUDGET,
+    DEFAULT_MESH_DISCONTINUITY,
+    DEFAULT_MESH_MAX_LEVEL,
+    DEFAULT_MESH_TOLERANCE,
+    DEFAULT_OCTREE_DEPTH,
+    DEFAULT_SPLAT_BUDGET,
+    encode_glb,
+    encode_mesh_ply,
+    encode_ply_ascii,
+    encode_ply_binary,
+    encode_raw_buffer,
+    encode_splat,
+    encode_splat_ply,
+    RAW_POINT_STRIDE,
+)
+from .lattice_depth import (
+    decode_depth,
+    depth_cache_key,
+    depth_to_normals,
+    encode_depth,
+    encode_normals,
+    get_depth_cache,
+    get_depth_executor,
+    infer_depth,
+    infer_depth_batches,
+    infer_depth_fast,
+    infer_depth_tiled,
+    load_normalcrafter,
+    normalcrafter_video,
+    resize_depth,
+    run_in_depth_executor,
+    single_result,
+    TemporalDepthNormalizer,
+    DEFAULT_DECODE_CHUNK,
+    DEFAULT_DEPTH_BATCH,
+    DEFAULT_FAST_SIZE,
+    DEFAULT_NORMAL_MAX_RES,
+    DEFAULT_NORMAL_OVERLAP,
+    DEFAULT_NORMAL_SCALES,
+    DEFAULT_NORMAL_WINDOW,
+    DEFAULT_NORMALIZE_WINDOW,
+    DEFAULT_TILE_OVERLAP,
+    DEFAULT_TILE_SIZE,
+    DEPTH_FORMATS,
+    DEPTH_NORMALIZE_MODES,
+    NORMALCRAFTER_WEIGHTS,
+    RAW_DEPTH_DTYPES,
+    RELATIVE_DEPTH_RANGE,
+)
+from .lattice_segmentation import (
+    cache_mask_index,
+    clear_model_caches,
+    encode_mask,
+    get_mask_index,
+    export_decoder_onnx,
+    get_segment_executor,
+    get_superpixel_index,
+    image_embedding,
+    image_hash,
+    predict_prompt_groups,
+    propagate_video_masks,
+    region_grow_mask,
+    run_in_segment_executor,
+    set_image_cached,
+    MaskIndex,
+    MASK_FORMATS,
+    SAM2_VIDEO_CHECKPOINTS,
+)
+from .lattice_vlm import (
+    parse_intent_json,
+    IntentStreamParser,
+    VLMCancelled,
+    VLMQueueFull,
+    VLMRequest,
+    VLMUnavailable,
+    VLMWorker,
+    DEFAULT_VISUAL_TOKENS,
+    DEFAULT_VLM_TIMEOUT,
+)
+
 # Project storage directory (relative to this file's location)
 PROJECTS_DIR = Path(__file__).parent.parent / "projects"
 
@@ -314,6 +404,8 @@ try:
                     sam = sam_model_registry[model_type_sam](checkpoint=sam_checkpoint)
                     sam.to(device=device)
                     _segmentation_model = SamPredictor(sam)
+                    # Cached embeddings/mask indexes belong to the previous model
+                    clear_model_caches()
                     _segmentation_model_type = model_type
                     return _segmentation_model
                 else:
@@ -330,11 +422,52 @@ try:
 
         return None
 
+    # Video predictor is kept separately so image and video requests don't
+    # evict each other's model
+    _video_segmentation_model = None
+    # Why loading failed; later requests skip the retry
+    _video_segmentation_model_error = None
+
+    def _load_video_segmentation_model():
+        """
+        Lazy load the SAM2 video predictor (memory-bank propagation).
+
+        A failed load is remembered in _video_segmentation_model_error and not
+        retried until ComfyUI restarts.
+        """
+        global _video_segmentation_model, _video_segmentation_model_error
+
+        if _video_segmentation_model is not None:
+            return _video_segmentation_model
+        if _video_segmentation_model_error is not None:
+            return None
+
+        try:
+            from sam2.build_sam import build_sam2_video_predictor
+            import torch
+            import folder_paths
+
+            model_folder = folder_paths.get_folder_paths("checkpoints")[0] if hasattr(folder_paths, 'get_folder_paths') else "models"
+
+            for name, config in SAM2_VIDEO_CHECKPOINTS:
+                check_path = os.path.join(model_folder, 'sam', name)
+                if os.path.exists(check_path):
+                    device = "cuda" if torch.cuda.is_available() else "cpu"
+                    _video_segmentation_model = build_sam2_video_predictor(config, check_path, device=device)
+                    print(f"[Lattice] Loaded SAM2 video predictor ({name}) on {device}")
+                    return _video_segmentation_model
+
+            raise FileNotFoundError("No SAM2 checkpoint found")
+
+        except Exception as e:
+            _video_segmentation_model_error = str(e)
+            print(f"[Lattice] Failed to load SAM2 video predictor: {e}")
+            return None
+
     def _segment_with_points(image_np, points, labels, model):
         """Run SAM2 segmentation with point prompts"""
-        import torch
-
-        model.set_image(image_np)
+        # Reuses the cached image embedding on follow-up clicks
+        set_image_cached(model, image_np)
 
         points_np = np.array(points)
         labels_np = np.array(labels)
@@ -351,9 +484,7 @@ try:
 
     def _segment_with_box(image_np, box, model):
         """Run SAM2 segmentation with box prompt"""
-        import torch
-
-        model.set_image(image_np)
+        set_image_cached(model, image_np)
 
         box_np = np.array(box)  # [x1, y1, x2, y2]
 
@@ -366,12 +497,17 @@ try:
         best_idx = np.argmax(scores)
         return masks[best_idx]
 
+    # Automatic mask generator, rebuilt only when the SAM model changes
+    _mask_generator = None
+
     def _segment_auto(image_np, model):
         """Run automatic segmentation to find all objects"""
+        global _mask_generator
         from segment_anything import SamAutomaticMaskGenerator
 
-        # Create automatic mask generator
-        mask_generator = SamAutomaticMaskGenerator(model.model)
+        if _mask_generator is None or _mask_generator.predictor.model is not model.model:
+            _mask_generator = SamAutomaticMaskGenerator(model.model)
+        mask_generator = _mask_generator
 
         # Generate all masks
         masks = mask_generator.generate(image_np)
@@ -393,13 +529,24 @@ try:
         Request body:
         {
             "image": "base64_encoded_png",
-            "mode": "point" | "box" | "auto",
+            "mode": "point" | "box" | "auto" | "multi" | "lookup",
             "model": "sam2" | "matseg",
             "points": [[x, y], ...],      // For point mode
             "labels": [1, 0, ...],         // 1=foreground, 0=background
             "box": [x1, y1, x2, y2],       // For box mode
+            "prompts": [                   // For multi mode - one mask per group,
+                {"points": [[x, y]], "labels": [1], "box": [x1, y1, x2, y2]}  // decoded in one batch
+            ],
+            "tolerance": 30,               // No-model fallback: max RGB distance from the seed
+            "fallback_method": "region" | "superpixel",  // No-model fallback: flood fill or superpixels
+            "superpixel_algorithm": "slic" | "felzenszwalb",
+            "superpixels": 1500,           // Approximate superpixel count
             "min_area": 100,               // For auto mode - minimum mask area
-            "max_masks": 20                // For auto mode - maximum masks to return
+            "max_masks": 20,               // For auto mode - maximum masks to return
+            "image_id": "...",             // For lookup mode - from a previous auto response
+            "points": [[x, y], ...],       // For lookup mode - positions to query
+            "include_masks": false,        // For lookup mode - also return the hit masks
+            "mask_format": "png" | "png_cropped" | "rle"
         }
 
         Returns:
@@ -407,17 +554,50 @@ try:
             "status": "success",
             "masks": [
                 {
-                    "mask": "base64_encoded_png",
+                    "mask": "base64_encoded_png",  // or {"size": [h, w], "counts": "..."} for rle
                     "bounds": {"x": 0, "y": 0, "width": 100, "height": 100},
                     "area": 1234,
-                    "score": 0.95
+                    "score": 0.95,
+                    "group": 0,                 // Multi mode: index into "prompts"
+                    "id": 3                     // Auto mode: mask id in the image's mask index
                 }
-            ]
+            ],
+            "mask_format": "png",
+            "image_id": "..."                   // Auto mode: key for later lookups
         }
+
+        Auto mode keeps its full result as a per-image mask index. Lookup
+        mode answers "which masks contain (x, y)" from that index without
+        running the model:
+        {
+            "status": "success",
+            "image_id": "...",
+            "hits": [{"point": [x, y], "top": 3, "ids": [3, 1, 0]}],  // innermost first
+            "masks": [...]  // Only with include_masks, one entry per id in any hit
+        }
+
+        Mask formats:
+        - "png": full-frame 8-bit PNG (default)
+        - "png_cropped": 1-bit PNG covering only "bounds", placed at (x, y)
+        - "rle": COCO compressed RLE of the full frame (column-major)
         """
         try:
             data = await request.json()
 
+            mode = data.get('mode', 'point')
+            model_type = data.get('model', 'sam2')
+
+            mask_format = data.get('mask_format', 'png')
+            if mask_format not in MASK_FORMATS:
+                return web.json_response({
+                    "status": "error",
+                    "message": f"Unknown mask format: {mask_format}"
+                }, status=400)
+
+            # Lookups by image_id are answered from the mask index alone
+            if mode == 'lookup' and data.get('image_id'):
+                return _lookup_masks(data, data['image_id'], mask_format)
+
             # Decode input image
             image_b64 = data.get('image')
             if not image_b64:
@@ -434,14 +614,14 @@ try:
             pil_image = Image.open(io.BytesIO(image_data)).convert('RGB')
             image_np = np.array(pil_image)
 
-            mode = data.get('mode', 'point')
-            model_type = data.get('model', 'sam2')
+            if mode == 'lookup':
+                return _lookup_masks(data, image_hash(image_np), mask_format)
 
             # Load segmentation model
             model = _load_segmentation_model(model_type)
             if model is None:
                 # Fallback to simple threshold-based segmentation
-                return _simple_segment(data, image_np)
+                return await _simple_segment(data, image_np)
 
             results = []
 
@@ -455,8 +635,8 @@ try:
                         "message": "No points provided for point mode"
                     }, status=400)
 
-                mask = _segment_with_points(image_np, points, labels, model)
-                mask_b64, bounds = _mask_to_base64_with_bounds(mask)
+                mask = await run_in_segment_executor(_segment_with_points, image_np, points, labels, model)
+                mask_b64, bounds = _mask_to_base64_with_bounds(mask, mask_format)
 
                 results.append({
                     "mask": mask_b64,
@@ -473,8 +653,8 @@ try:
                         "message": "Invalid box format - expected [x1, y1, x2, y2]"
                     }, status=400)
 
-                mask = _segment_with_box(image_np, box, model)
-                mask_b64, bounds = _mask_to_base64_with_bounds(mask)
+                mask = await run_in_segment_executor(_segment_with_box, image_np, box, model)
+                mask_b64, bounds = _mask_to_base64_with_bounds(mask, mask_format)
 
                 results.append({
                     "mask": mask_b64,
@@ -483,28 +663,60 @@ try:
                     "score": 1.0
                 })
 
+            elif mode == 'multi':
+                groups, error = _validate_prompt_groups(data.get('prompts'))
+                if error:
+                    return web.json_response({
+                        "status": "error",
+                        "message": error
+                    }, status=400)
+
+                # All groups share one embedding and one batched decoder pass
+                group_masks = await run_in_segment_executor(predict_prompt_groups, model, image_np, groups)
+
+                for group_index, (mask, score) in enumerate(group_masks):
+                    mask_b64, bounds = _mask_to_base64_with_bounds(mask, mask_format)
+                    results.append({
+                        "mask": mask_b64,
+                        "bounds": bounds,
+                        "area": int(np.sum(mask)),
+                        "score": score,
+                        "group": group_index
+                    })
+
             elif mode == 'auto':
                 min_area = data.get('min_area', 100)
                 max_masks = data.get('max_masks', 20)
 
-                auto_masks = _segment_auto(image_np, model)
-
-                # Filter by minimum area
-                auto_masks = [m for m in auto_masks if m['area'] >= min_area]
+                # Reuse this image's mask index if auto mode already ran on it
+                image_id = image_hash(image_np)
+                index = get_mask_index(image_id)
+                if index is None:
+                    index = MaskIndex(await run_in_segment_executor(_segment_auto, image_np, model), image_np.shape[:2])
+                    cache_mask_index(image_id, index)
 
-                # Sort by area (largest first) and take top N
-                auto_masks.sort(key=lambda m: m['area'], reverse=True)
-                auto_masks = auto_masks[:max_masks]
+                # Index is sorted by area (largest first); filter and take top N
+                mask_ids = [i for i, entry in enumerate(index.entries) if entry['area'] >= min_area]
+                mask_ids = mask_ids[:max_masks]
 
-                for mask_data in auto_masks:
-                    mask_b64, bounds = _mask_to_base64_with_bounds(mask_data['mask'])
+                for mask_id in mask_ids:
+                    entry = index.entries[mask_id]
+                    mask_b64, bounds = _mask_to_base64_with_bounds(index.mask(mask_id), mask_format)
                     results.append({
                         "mask": mask_b64,
                         "bounds": bounds,
-                        "area": mask_data['area'],
-                        "score": mask_data['score']
+                        "area": entry['area'],
+                        "score": entry['score'],
+                        "id": mask_id
                     })
 
+                return web.json_response({
+                    "status": "success",
+                    "masks": results,
+                    "mask_format": mask_format,
+                    "image_id": image_id
+                })
+
             else:
                 return web.json_response({
                     "status": "error",
@@ -513,7 +725,8 @@ try:
 
             return web.json_response({
                 "status": "success",
-                "masks": results
+                "masks": results,
+                "mask_format": mask_format
             })
 
         except Exception as e:
@@ -524,71 +737,428 @@ try:
                 "message": str(e)
             }, status=500)
 
-    def _mask_to_base64_with_bounds(mask):
-        """Convert binary mask to base64 PNG and calculate bounds"""
-        from PIL import Image
-        import io
+    @routes.post('/lattice/segment/embedding')
+    async def segment_embedding(request):
+        """
+        Compute the SAM image embedding for client-side mask decoding.
+
+        Request body:
+        {
+            "image": "base64_encoded_png",
+            "model": "sam2"
+        }
+
+        Returns application/octet-stream: the embedding as little-endian
+        float16 [1, 256, 64, 64]. Metadata is in the X-Lattice-Metadata header:
+        {
+            "status": "success",
+            "image_id": "...",
+            "shape": [1, 256, 64, 64],
+            "dtype": "float16",
+            "original_size": [h, w],    // Pass as orig_im_size to the decoder
+            "input_size": [h, w],       // Resized image size inside the encoder
+            "image_size": 1024,         // Longest side of the encoder input
+            "cached": true,             // Embedding came from the server cache
+            "decoder": "/lattice/segment/decoder.onnx"  // null if not exportable
+        }
 
-        # Convert boolean mask to uint8
-        mask_uint8 = (mask.astype(np.uint8) * 255)
+        The decoder takes float32 embeddings, so convert the blob before
+        running it. Point coords must be scaled by image_size / max(original_size).
+        """
+        try:
+            data = await request.json()
 
-        # Find bounding box of non-zero region
-        rows = np.any(mask, axis=1)
-        cols = np.any(mask, axis=0)
+            image_b64 = data.get('image')
+            if not image_b64:
+                return web.json_response({
+                    "status": "error",
+                    "message": "No image provided"
+                }, status=400)
 
-        if not np.any(rows) or not np.any(cols):
-            # Empty mask
-            bounds = {"x": 0, "y": 0, "width": mask.shape[1], "height": mask.shape[0]}
-        else:
-            rmin, rmax = np.where(rows)[0][[0, -1]]
-            cmin, cmax = np.where(cols)[0][[0, -1]]
-            bounds = {
-                "x": int(cmin),
-                "y": int(rmin),
-                "width": int(cmax - cmin + 1),
-                "height": int(rmax - rmin + 1)
-            }
+            model = _load_segmentation_model(data.get('model', 'sam2'))
+            if model is None:
+                return web.json_response({
+                    "status": "error",
+                    "message": "SAM model not available"
+                }, status=503)
 
-        # Convert to PIL and encode
-        pil_mask = Image.fromarray(mask_uint8, mode='L')
+            from PIL import Image
+            import io
 
-        buffer = io.BytesIO()
-        pil_mask.save(buffer, format='PNG')
-        mask_b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            image_data = base64.b64decode(image_b64)
+            image_np = np.array(Image.open(io.BytesIO(image_data)).convert('RGB'))
+            image_id = image_hash(image_np)
+
+            # Encoder can take seconds on CPU - keep it off the event loop, on
+            # the same worker as /lattice/segment so the predictor state can't interleave
+            embedding, info = await run_in_segment_executor(image_embedding, model, image_np, image_id)
+
+            # SAM2 predictors (which keep _features) have no ONNX decoder export
+            return _binary_response(embedding.astype('<f2').tobytes(), {
+                "image_id": image_id,
+                **info,
+                "decoder": None if hasattr(model, '_features') else "/lattice/segment/decoder.onnx"
+            })
 
-        return mask_b64, bounds
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return web.json_response({
+                "status": "error",
+                "message": str(e)
+            }, status=500)
 
-    def _simple_segment(data, image_np):
-        """Fallback segmentation without AI model - uses color/luminance thresholding"""
-        from PIL import Image
-        import io
+    # (predictor, path) of the exported decoder, re-exported when the model changes
+    _decoder_onnx = None
 
-        mode = data.get('mode', 'point')
+    @routes.get('/lattice/segment/decoder.onnx')
+    async def segment_decoder_onnx(request):
+        """
+        Download SAM's prompt encoder + mask decoder as an ONNX model.
 
-        if mode == 'box':
-            # Simple box selection - just create a rectangular mask
-            box = data.get('box', [0, 0, image_np.shape[1], image_np.shape[0]])
-            x1, y1, x2, y2 = [int(v) for v in box]
+        Inputs: image_embeddings, point_coords, point_labels, mask_input,
+        has_mask_input, orig_im_size (same as the official SAM web demo).
+        Exported once per loaded model and served from a temp file.
+        """
+        global _decoder_onnx
+        try:
+            model = _load_segmentation_model(request.query.get('model', 'sam2'))
+            if model is None:
+                return web.json_response({
+                    "status": "error",
+                    "message": "SAM model not available"
+                }, status=503)
 
-            mask = np.zeros((image_np.shape[0], image_np.shape[1]), dtype=bool)
-            mask[y1:y2, x1:x2] = True
+            if _decoder_onnx is None or _decoder_onnx[0] is not model or not os.path.exists(_decoder_onnx[1]):
+                import tempfile
+
+                path = os.path.join(tempfile.gettempdir(), f"lattice_sam_decoder_{os.getpid()}_{id(model)}.onnx")
+                await run_in_segment_executor(export_decoder_onnx, model, path)
+                _decoder_onnx = (model, path)
 
-            mask_b64, bounds = _mask_to_base64_with_bounds(mask)
+            return web.FileResponse(_decoder_onnx[1], headers={
+                "Content-Type": "application/octet-stream"
+            })
 
+        except NotImplementedError as e:
             return web.json_response({
-                "status": "success",
-                "masks": [{
+                "status": "error",
+                "message": str(e)
+            }, status=501)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return web.json_response({
+                "status": "error",
+                "message": str(e)
+            }, status=500)
+
+    # Items a streaming worker may run ahead of a slow client
+    STREAM_QUEUE_SIZE = 4
+
+    class _StreamCancelled(Exception):
+        """Raised inside a streaming worker once its client has disconnected"""
+
+    async def _stream_ndjson(request, executor, items):
+        """
+        Stream items from an iterator consumed on executor as NDJSON.
+
+        The worker waits while STREAM_QUEUE_SIZE items are unwritten, so a
+        slow client bounds memory. If the client disconnects, the iterator
+        is closed at its next item and the started response is returned.
+        The last item should carry "status"; an exception from the iterator
+        becomes a final {"status": "error"} item.
+        """
+        import asyncio
+        import threading
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        slots = threading.Semaphore(STREAM_QUEUE_SIZE)
+        cancelled = threading.Event()
+
+        def emit(item):
+            while not slots.acquire(timeout=0.1):
+                if cancelled.is_set():
+                    raise _StreamCancelled()
+            if cancelled.is_set():
+                raise _StreamCancelled()
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        def run():
+            try:
+                for item in items:
+                    emit(item)
+            except _StreamCancelled:
+                pass
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                try:
+                    emit({"status": "error", "message": str(e)})
+                except _StreamCancelled:
+                    pass
+            finally:
+                # Lets generators release their model state (e.g. SAM2 inference state)
+                if hasattr(items, 'close'):
+                    items.close()
+
+        worker = loop.run_in_executor(executor, run)
+        try:
+            while True:
+                item = await queue.get()
+                slots.release()
+                await response.write((json.dumps(item) + "\n").encode('utf-8'))
+                if 'status' in item:
+                    break
+        except ConnectionResetError:
+            # Client went away mid-stream; stop the worker, keep the response
+            cancelled.set()
+            return response
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+        await worker
+        await response.write_eof()
+        return response
+
+    @routes.post('/lattice/segment/video')
+    async def segment_video(request):
+        """
+        Propagate masks through a frame sequence with the SAM2 video predictor.
+
+        Request body:
+        {
+            "frames": ["base64_encoded_png", ...],
+            "prompts": [
+                {"frame": 0, "obj_id": 1, "points": [[x, y]], "labels": [1], "box": [x1, y1, x2, y2]}
+            ],
+            "mask_format": "png" | "png_cropped" | "rle"  // See /lattice/segment
+        }
+
+        Streams newline-delimited JSON (application/x-ndjson), one line per
+        frame as soon as it is propagated (keyframe onward, then earlier frames):
+        {"frame": 12, "masks": [{"obj_id": 1, "mask": "base64_png", "bounds": {...}, "area": 1234}]}
+
+        Final line:
+        {"status": "success", "done": true, "num_frames": 81}
+        or {"status": "error", "message": "..."} if propagation fails midway.
+        """
+        try:
+            data = await request.json()
+
+            frames_b64 = data.get('frames') or []
+            prompts = data.get('prompts') or []
+            mask_format = data.get('mask_format', 'png')
+
+            if mask_format not in MASK_FORMATS:
+                return web.json_response({
+                    "status": "error",
+                    "message": f"Unknown mask format: {mask_format}"
+                }, status=400)
+
+            if not frames_b64:
+                return web.json_response({
+                    "status": "error",
+                    "message": "No frames provided"
+                }, status=400)
+
+            if not prompts:
+                return web.json_response({
+                    "status": "error",
+                    "message": "No prompts provided"
+                }, status=400)
+
+            for i, prompt in enumerate(prompts):
+                if not prompt.get('points') and prompt.get('box') is None:
+                    return web.json_response({
+                        "status": "error",
+                        "message": f"Prompt {i} needs points or a box"
+                    }, status=400)
+                if not 0 <= int(prompt.get('frame', 0)) < len(frames_b64):
+                    return web.json_response({
+                        "status": "error",
+                        "message": f"Prompt {i} references frame outside the sequence"
+                    }, status=400)
+
+            predictor = await run_in_segment_executor(_load_video_segmentation_model)
+            if predictor is None:
+                return web.json_response({
+                    "status": "error",
+                    "message": f"SAM2 video predictor not available: {_video_segmentation_model_error}"
+                }, status=503)
+
+            from PIL import Image
+            import io
+
+            def decode_frames():
+                return [
+                    np.array(Image.open(io.BytesIO(base64.b64decode(f))).convert('RGB'))
+                    for f in frames_b64
+                ]
+
+            frames = await run_in_segment_executor(decode_frames)
+
+            # Propagation runs on the segmentation executor; frames stream as they finish
+            def propagation():
+                for frame_index, masks in propagate_video_masks(predictor, frames, prompts):
+                    frame_result = {"frame": frame_index, "masks": []}
+                    for obj_id, mask in masks.items():
+                        mask_b64, bounds = _mask_to_base64_with_bounds(mask, mask_format)
+                        frame_result["masks"].append({
+                            "obj_id": obj_id,
+                            "mask": mask_b64,
+                            "bounds": bounds,
+                            "area": int(np.sum(mask))
+                        })
+                    yield frame_result
+
+                yield {
+                    "status": "success",
+                    "done": True,
+                    "num_frames": len(frames)
+                }
+
+            return await _stream_ndjson(request, get_segment_executor(), propagation())
+
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return web.json_response({
+                "status": "error",
+                "message": str(e)
+            }, status=500)
+
+    def _lookup_masks(data, image_id, mask_format):
+        """Answer a lookup-mode request from a cached mask index"""
+        index = get_mask_index(image_id)
+        if index is None:
+            return web.json_response({
+                "status": "error",
+                "message": "No mask index for this image - run mode 'auto' first"
+            }, status=404)
+
+        points = data.get('points') or ([data['point']] if data.get('point') else [])
+        if not points:
+            return web.json_response({
+                "status": "error",
+                "message": "No points provided for lookup mode"
+            }, status=400)
+
+        hits = []
+        for point in points:
+            x, y = int(point[0]), int(point[1])
+            hits.append({"point": [x, y], "top": index.top(x, y), "ids": index.lookup(x, y)})
+
+        response = {
+            "status": "success",
+            "image_id": image_id,
+            "hits": hits,
+            "num_masks": len(index)
+        }
+
+        if data.get('include_masks'):
+            hit_ids = sorted({mask_id for hit in hits for mask_id in hit["ids"]})
+            response["masks"] = []
+            for mask_id in hit_ids:
+                entry = index.entries[mask_id]
+                mask_b64, bounds = _mask_to_base64_with_bounds(index.mask(mask_id), mask_format)
+                response["masks"].append({
                     "mask": mask_b64,
                     "bounds": bounds,
-                    "area": int(np.sum(mask)),
-                    "score": 1.0
-                }],
-                "fallback": True,
-                "message": "Using simple box selection (SAM2 not available)"
-            })
+                    "area": entry['area'],
+                    "score": entry['score'],
+                    "id": mask_id
+                })
+            response["mask_format"] = mask_format
+
+        return web.json_response(response)
+
+    def _validate_prompt_groups(prompts):
+        """Check multi-mode prompt groups, returning (groups, error_message)"""
+        if not prompts or not isinstance(prompts, list):
+            return None, "No prompts provided for multi mode"
+
+        for i, group in enumerate(prompts):
+            points = group.get('points') or []
+            box = group.get('box')
+            if not points and box is None:
+                return None, f"Prompt group {i} needs points or a box"
+            if box is not None and len(box) != 4:
+                return None, f"Prompt group {i}: invalid box format - expected [x1, y1, x2, y2]"
+            labels = group.get('labels')
+            if labels is not None and len(labels) != len(points):
+                return None, f"Prompt group {i}: labels and points differ in length"
+
+        return prompts, None
+
+    def _mask_to_base64_with_bounds(mask, mask_format='png'):
+        """Encode binary mask (full PNG, cropped PNG or COCO RLE) and calculate bounds"""
+        return encode_mask(mask, mask_format)
+
+    def _simple_mask(prompt, image_np, data):
+        """Fallback mask for one prompt: box selection, else region growing from the clicked points"""
+        if prompt.get('box') is not None:
+            # Simple box selection - just create a rectangular mask
+            x1, y1, x2, y2 = [int(v) for v in prompt['box']]
+
+            mask = np.zeros((image_np.shape[0], image_np.shape[1]), dtype=bool)
+            mask[y1:y2, x1:x2] = True
+            return mask, 1.0
+
+        points = prompt['points']
+        labels = prompt.get('labels')
+        tolerance = data.get('tolerance', 30)
+
+        if data.get('fallback_method', 'region') == 'superpixel':
+            # Superpixels are computed once per image; later clicks only walk the superpixel graph
+            try:
+                index = get_superpixel_index(
+                    image_np,
+                    algorithm=data.get('superpixel_algorithm', 'slic'),
+                    n_segments=data.get('superpixels', 1500)
+                )
+                return index.select(points, labels, tolerance), 0.5
+            except ImportError:
+                print("[Lattice] scikit-image not installed, using region growing")
+
+        # Connected region of similar color around each clicked point
+        return region_grow_mask(image_np, points, labels, tolerance), 0.5
+
+    def _simple_masks(prompts, image_np, data, mask_format, grouped):
+        """Fallback masks for every prompt, encoded for the response (runs on the segmentation executor)"""
+        results = []
+        for group_index, prompt in enumerate(prompts):
+            mask, score = _simple_mask(prompt, image_np, data)
+            mask_b64, bounds = _mask_to_base64_with_bounds(mask, mask_format)
+
+            result = {
+                "mask": mask_b64,
+                "bounds": bounds,
+                "area": int(np.sum(mask)),
+                "score": score
+            }
+            if grouped:
+                result["group"] = group_index
+            results.append(result)
+        return results
+
+    async def _simple_segment(data, image_np):
+        """Fallback segmentation without AI model - uses color/luminance thresholding"""
+        mode = data.get('mode', 'point')
+        mask_format = data.get('mask_format', 'png')
+
+        if mode == 'box':
+            box = data.get('box', [0, 0, image_np.shape[1], image_np.shape[0]])
+            prompts = [{"box": box}]
+            message = "Using simple box selection (SAM2 not available)"
 
         elif mode == 'point':
-            # Simple flood-fill like selection based on color similarity
+            # Flood-fill selection of the connected similar-colored region
             points = data.get('points', [])
             if not points:
                 return web.json_response({
@@ -596,31 +1166,18 @@ try:
                     "message": "No points provided"
                 }, status=400)
 
-            # Use first point as seed, do color-based region growing
-            px, py = int(points[0][0]), int(points[0][1])
-            py = min(py, image_np.shape[0] - 1)
-            px = min(px, image_np.shape[1] - 1)
-
-            seed_color = image_np[py, px].astype(np.float32)
-            tolerance = data.get('tolerance', 30)
+            prompts = [{"points": points, "labels": data.get('labels')}]
+            message = "Using color-based selection (SAM2 not available)"
 
-            # Color distance
-            color_diff = np.sqrt(np.sum((image_np.astype(np.float32) - seed_color) ** 2, axis=2))
-            mask = color_diff < tolerance
-
-            mask_b64, bounds = _mask_to_base64_with_bounds(mask)
+        elif mode == 'multi':
+            prompts, error = _validate_prompt_groups(data.get('prompts'))
+            if error:
+                return web.json_response({
+                    "status": "error",
+                    "message": error
+                }, status=400)
 
-            return web.json_response({
-                "status": "success",
-                "masks": [{
-                    "mask": mask_b64,
-                    "bounds": bounds,
-                    "area": int(np.sum(mask)),
-                    "score": 0.5
-                }],
-                "fallback": True,
-                "message": "Using color-based selection (SAM2 not available)"
-            })
+            message = "Using box/color-based selection (SAM2 not available)"
 
         else:
             return web.json_response({
@@ -628,6 +1185,17 @@ try:
                 "message": f"Auto mode requires SAM2 model"
             }, status=400)
 
+        # Superpixel indexing and region growing are CPU-bound; keep them off the event loop
+        results = await run_in_segment_executor(_simple_masks, prompts, image_np, data, mask_format, mode == 'multi')
+
+        return web.json_response({
+            "status": "success",
+            "masks": results,
+            "mask_format": mask_format,
+            "fallback": True,
+            "message": message
+        })
+
     # =========================================================================
     # Depth Estimation Endpoint - DepthAnything V3
     # =========================================================================
@@ -676,6 +1244,54 @@ try:
             print(f"[Lattice] Failed to load DepthAnything V3: {e}")
             return None
 
+    def _depth_mode(data):
+        """Inference mode for the depth cache key: 'full', 'fast:<size>' or 'tiled:<size>:<overlap>'"""
+        if data.get('fast', False):
+            return f"fast:{int(data.get('fast_size', DEFAULT_FAST_SIZE))}"
+        if data.get('tiled', False):
+            return (f"tiled:{int(data.get('tile_size', DEFAULT_TILE_SIZE))}:"
+                    f"{int(data.get('tile_overlap', DEFAULT_TILE_OVERLAP))}")
+        return "full"
+
+    async def _infer_depth_cached(image_np, model_name, data, image_key=None):
+        """
+        Float depth for an image, shared across routes through the depth
+        result cache (keyed by image content, model and mode).
+
+        Returns (result, cached): result holds 'depth' [H, W] float32 and,
+        when available, 'intrinsics' and 'conf'. result is None if no depth
+        model could be loaded. image_key is image_hash(image_np), if the
+        caller already has it.
+        """
+        cache = get_depth_cache()
+        key = depth_cache_key(image_key or image_hash(image_np), model_name, _depth_mode(data))
+        result = cache.get(key)
+        if result is not None:
+            return result, True
+
+        model = await run_in_depth_executor(_load_depth_model, model_name)
+        if model is None:
+            return None, False
+
+        if data.get('fast', False):
+            raw = await run_in_depth_executor(
+                infer_depth_fast, model, image_np,
+                int(data.get('fast_size', DEFAULT_FAST_SIZE))
+            )
+        elif data.get('tiled', False):
+            raw = await run_in_depth_executor(
+                infer_depth_tiled, model, image_np,
+                int(data.get('tile_size', DEFAULT_TILE_SIZE)),
+                int(data.get('tile_overlap', DEFAULT_TILE_OVERLAP))
+            )
+        else:
+            raw = await run_in_depth_executor(infer_depth, model, [image_np])
+
+        # Model output is at its processing resolution; cache it at image size
+        result = single_result(raw, image_np.shape[:2])
+        cache.put(key, result)
+        return result, False
+
     @routes.post('/lattice/depth')
     async def generate_depth(request):
         """
@@ -685,6 +1301,12 @@ try:
         {
             "image": "base64_encoded_png",
             "model": "DA3-LARGE-1.1" | "DA3-GIANT-1.1" | "DA3NESTED-GIANT-LARGE-1.1",
+            "format": "png" | "png16" | "f16" | "f32",
+            "tiled": false,  // Full-resolution tiled inference for large plates
+            "tile_size": 1024,  // Tile edge in pixels (bounds peak memory)
+            "tile_overlap": 128,  // Pixels blended between neighbouring tiles
+            "fast": false,  // Preview: infer at low res, guided-upsample to full size
+            "fast_size": 280,  // Network processing resolution (long side; full mode uses 504)
             "return_confidence": false,
             "return_intrinsics": false
         }
@@ -698,9 +1320,26 @@ try:
             "metadata": {
                 "model": "DA3-LARGE-1.1",
                 "width": 1024,
-                "height": 768
+                "height": 768,
+                "format": "png",
+                "bit_depth": 8,
+                "depth_min": 0.41,  // PNG value v maps to
+                "depth_max": 9.87   // min + v / (2^bit_depth - 1) * (max - min)
             }
         }
+
+        format "png" is the 8-bit preview and "png16" a 16-bit PNG in the same
+        JSON. "f16"/"f32" return the raw little-endian float depth as an
+        application/octet-stream body, with the metadata (including
+        intrinsics when requested) in the X-Lattice-Metadata header.
+
+        Tiled mode infers a low-res global pass plus overlapping native-res
+        tiles, aligns each tile's scale/shift to the global pass and
+        feather-blends them. It returns no confidence map.
+
+        Fast mode runs the network at processing resolution fast_size and
+        restores full resolution with a guided filter using the image as guide. It also
+        returns no confidence map, and cannot be combined with tiled.
         """
         try:
             data = await request.json()
@@ -713,9 +1352,15 @@ try:
                     "message": "No image provided"
                 }, status=400)
 
+            depth_format = data.get('format', 'png')
+            if depth_format not in DEPTH_FORMATS:
+                return web.json_response({
+                    "status": "error",
+                    "message": f"Unknown depth format: {depth_format}"
+                }, status=400)
+
             from PIL import Image
             import io
-            import torch
 
             # Decode base64 image
             image_data = base64.b64decode(image_b64)
@@ -725,55 +1370,52 @@ try:
             return_confidence = data.get('return_confidence', False)
             return_intrinsics = data.get('return_intrinsics', False)
 
-            # Try to load and run the model
-            model = _load_depth_model(model_name)
+            if data.get('fast', False) and data.get('tiled', False):
+                return web.json_response({
+                    "status": "error",
+                    "message": "fast and tiled modes are exclusive"
+                }, status=400)
 
-            if model is not None:
-                # Save temp image for inference
-                temp_path = '/tmp/lattice_depth_input.png'
-                pil_image.save(temp_path)
+            # Cached float depth, or inference on the depth executor
+            result, cached = await _infer_depth_cached(np.array(pil_image), model_name, data)
 
-                # Run inference
-                result = model.inference([temp_path])
+            if result is not None:
+                depth_np = result['depth']  # [H, W] float32
 
-                # Get depth map
-                depth_np = result['depth'][0]  # [H, W] float32
+                depth_payload, depth_info = encode_depth(depth_np, depth_format)
 
-                # Normalize to 0-255 for PNG export
-                depth_min = depth_np.min()
-                depth_max = depth_np.max()
-                depth_normalized = ((depth_np - depth_min) / (depth_max - depth_min + 1e-6) * 255).astype(np.uint8)
+                metadata = {
+                    "model": model_name,
+                    "width": pil_image.width,
+                    "height": pil_image.height,
+                    "format": depth_format,
+                    "cached": cached,
+                    **depth_info
+                }
+                if 'tiles' in result:
+                    metadata['tiles'] = result['tiles']
+                if data.get('fast', False):
+                    metadata['fast'] = True
 
-                # Convert to base64
-                depth_pil = Image.fromarray(depth_normalized, mode='L')
-                buffer = io.BytesIO()
-                depth_pil.save(buffer, format='PNG')
-                depth_b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+                if depth_format in RAW_DEPTH_DTYPES:
+                    if return_intrinsics and 'intrinsics' in result:
+                        metadata['intrinsics'] = result['intrinsics'].tolist()
+                    return _binary_response(depth_payload, metadata)
 
                 response = {
                     "status": "success",
-                    "depth": depth_b64,
-                    "metadata": {
-                        "model": model_name,
-                        "width": pil_image.width,
-                        "height": pil_image.height,
-                        "depth_min": float(depth_min),
-                        "depth_max": float(depth_max)
-                    }
+                    "depth": depth_payload,
+                    "metadata": metadata
                 }
 
                 # Optional confidence map
                 if return_confidence and 'conf' in result:
-                    conf_np = result['conf'][0]
-                    conf_normalized = (conf_np * 255).astype(np.uint8)
-                    conf_pil = Image.fromarray(conf_normalized, mode='L')
-                    buffer = io.BytesIO()
-                    conf_pil.save(buffer, format='PNG')
-                    response['confidence'] = base64.b64encode(buffer.getvalue()).decode('utf-8')
+                    conf_normalized = (result['conf'] * 255).astype(np.uint8)
+                    response['confidence'] = _array_to_base64_png(conf_normalized, 'L')
 
                 # Optional camera intrinsics
                 if return_intrinsics and 'intrinsics' in result:
-                    response['intrinsics'] = result['intrinsics'][0].tolist()
+                    response['intrinsics'] = result['intrinsics'].tolist()
 
                 return web.json_response(response)
 
@@ -813,68 +1455,195 @@ try:
             }
         })
 
+    def _array_to_base64_png(array, mode):
+        """Encode a uint8 array as a base64 PNG"""
+        from PIL import Image
+        import io
+
+        buffer = io.BytesIO()
+        Image.fromarray(array, mode=mode).save(buffer, format='PNG')
+        return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+    @routes.post('/lattice/depth/video')
+    async def generate_depth_video(request):
+        """
+        Run DepthAnything V3 over a frame sequence in batches.
+
+        Request body:
+        {
+            "frames": ["base64_encoded_png", ...],
+            "model": "DA3-LARGE-1.1",
+            "batch_size": 8,  // Frames per inference call
+            "normalize": "window" | "global" | "frame",
+            "window": 16,  // Frames in the sliding range (window mode)
+            "ema": 0.0,  // 0..1 smoothing of the range between frames
+            "normals": false,  // Also return per-frame normal maps
+            "intrinsics": [[fx, 0, cx], [0, fy, cy], [0, 0, 1]]  // Optional, for normals
+        }
+
+        Streams newline-delimited JSON (application/x-ndjson), one line per
+        inferred batch:
+        {"chunk": 0, "start": 0, "frames": [
+            {"frame": 0, "depth": "base64_png", "depth_min": 0.4, "depth_max": 9.1,
+             "normal": "base64_png"}  // normal only when requested
+        ]}
+
+        depth_min/depth_max are the range the 8-bit frame was normalized
+        with. "global" needs the whole clip's range, so its chunks are sent
+        after the last batch has been inferred.
+
+        Final line:
+        {"status": "success", "done": true, "num_frames": 81, "depth_range": [min, max]}
+        or {"status": "error", "message": "..."} if inference fails midway.
+        """
+        try:
+            data = await request.json()
+
+            frames_b64 = data.get('frames') or []
+            model_name = data.get('model', 'DA3-LARGE-1.1')
+            batch_size = int(data.get('batch_size', DEFAULT_DEPTH_BATCH))
+            normalize_mode = data.get('normalize', 'window')
+            window = int(data.get('window', DEFAULT_NORMALIZE_WINDOW))
+            ema = float(data.get('ema', 0.0))
+            with_normals = bool(data.get('normals', False))
+            intrinsics = data.get('intrinsics')
+
+            if not frames_b64:
+                return web.json_response({
+                    "status": "error",
+                    "message": "No frames provided"
+                }, status=400)
+
+            if normalize_mode not in DEPTH_NORMALIZE_MODES:
+                return web.json_response({
+                    "status": "error",
+                    "message": f"Unknown normalize mode: {normalize_mode}"
+                }, status=400)
+
+            if batch_size < 1 or not 0.0 <= ema < 1.0:
+                return web.json_response({
+                    "status": "error",
+                    "message": "batch_size must be >= 1 and ema in [0, 1)"
+                }, status=400)
+
+            model = await run_in_depth_executor(_load_depth_model, model_name)
+            if model is None:
+                return web.json_response({
+                    "status": "error",
+                    "message": "DepthAnything V3 not available"
+                }, status=503)
+
+            from PIL import Image
+            import io
+
+            def decode_frame(frame_b64):
+                return np.array(Image.open(io.BytesIO(base64.b64decode(frame_b64))).convert('RGB'))
+
+            def encode_chunk(chunk_index, start, depths, normalizer):
+                chunk = {"chunk": chunk_index, "start": start, "frames": []}
+                # One batched normal pass over the chunk's float depth
+                normals = depth_to_normals(depths, intrinsics) if with_normals else None
+                for offset, depth in enumerate(depths):
+                    depth_u8, low, high = normalizer.normalize(depth)
+                    frame_result = {
+                        "frame": start + offset,
+                        "depth": _array_to_base64_png(depth_u8, 'L'),
+                        "depth_min": low,
+                        "depth_max": high
+                    }
+                    if normals is not None:
+                        frame_result["normal"] = _array_to_base64_png(encode_normals(normals[offset]), 'RGB')
+                    chunk["frames"].append(frame_result)
+                return chunk
+
+            # Inference runs on the depth executor; chunks stream as they finish
+            def run_sequence():
+                batches = infer_depth_batches(model, frames_b64, batch_size, decode=decode_frame)
+                clip_min, clip_max = float('inf'), float('-inf')
+
+                if normalize_mode == 'global':
+                    # Hold float16 depth until the clip range is known
+                    held = []
+                    for start, depths in batches:
+                        clip_min = min(clip_min, float(depths.min()))
+                        clip_max = max(clip_max, float(depths.max()))
+                        held.append((start, depths.astype(np.float16)))
+                    normalizer = TemporalDepthNormalizer(
+                        'global', ema=ema, depth_range=(clip_min, clip_max))
+                    for chunk_index, (start, depths) in enumerate(held):
+                        yield encode_chunk(chunk_index, start, depths.astype(np.float32), normalizer)
+                else:
+                    normalizer = TemporalDepthNormalizer(normalize_mode, window=window, ema=ema)
+                    for chunk_index, (start, depths) in enumerate(batches):
+                        clip_min = min(clip_min, float(depths.min()))
+                        clip_max = max(clip_max, float(depths.max()))
+                        yield encode_chunk(chunk_index, start, depths, normalizer)
+
+                yield {
+                    "status": "success",
+                    "done": True,
+                    "num_frames": len(frames_b64),
+                    "depth_range": [clip_min, clip_max]
+                }
+
+            return await _stream_ndjson(request, get_depth_executor(), run_sequence())
+
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return web.json_response({
+                "status": "error",
+                "message": str(e)
+            }, status=500)
+
     # =========================================================================
     # Normal Map Endpoint - NormalCrafter or algebraic depth-to-normal
     # =========================================================================
 
     _normal_model = None
+    # Why loading failed; later requests skip the retry (and its Hub download)
+    _normal_model_error = None
 
     def _load_normal_model():
-        """Lazy load NormalCrafter model"""
-        global _normal_model
+        """
+        Lazy load NormalCrafter (via ComfyUI-NormalCrafterWrapper when installed).
+
+        A failed load is remembered in _normal_model_error and not retried
+        until ComfyUI restarts.
+        """
+        global _normal_model, _normal_model_error
 
         if _normal_model is not None:
             return _normal_model
+        if _normal_model_error is not None:
+            return None
 
         try:
-            # Try loading NormalCrafter from ComfyUI custom nodes
-            import folder_paths
-            nc_path = os.path.join(folder_paths.get_folder_paths("custom_nodes")[0],
-                                   "ComfyUI-NormalCrafterWrapper")
-            if os.path.exists(nc_path):
-                import sys
-                sys.path.insert(0, nc_path)
-                # NormalCrafter loading would go here
-                print(f"[Lattice] Found NormalCrafter at {nc_path}")
-                # For now, we'll use algebraic depth-to-normal
-                return None
+            nc_path = None
+            weights = NORMALCRAFTER_WEIGHTS
+            try:
+                # Prefer the ComfyUI wrapper's normalcrafter package and local weights
+                import folder_paths
+                candidate = os.path.join(folder_paths.get_folder_paths("custom_nodes")[0],
+                                         "ComfyUI-NormalCrafterWrapper")
+                if os.path.exists(candidate):
+                    nc_path = candidate
+                local_weights = os.path.join(folder_paths.models_dir, "normalcrafter")
+                if os.path.exists(local_weights):
+                    weights = local_weights
+            except ImportError:
+                pass
+
+            _normal_model = load_normalcrafter(nc_path, weights=weights)
+            print(f"[Lattice] Loaded NormalCrafter{f' from {nc_path}' if nc_path else ''}")
+            return _normal_model
 
         except Exception as e:
+            _normal_model_error = str(e)
             print(f"[Lattice] Failed to load NormalCrafter: {e}")
 
         return None
 
-    def _depth_to_normal_algebraic(depth_np):
-        """
-        Convert depth map to normal map using Sobel gradients.
-        This is a fast algebraic approach that doesn't require a neural network.
-        """
-        from scipy import ndimage
-
-        # Normalize depth to 0-1
-        depth = depth_np.astype(np.float32)
-        if depth.max() > 1:
-            depth = depth / 255.0
-
-        # Compute gradients using Sobel filters
-        dz_dx = ndimage.sobel(depth, axis=1)  # Horizontal gradient
-        dz_dy = ndimage.sobel(depth, axis=0)  # Vertical gradient
-
-        # Construct normal vectors: N = normalize([-dz/dx, -dz/dy, 1])
-        normal = np.zeros((*depth.shape, 3), dtype=np.float32)
-        normal[..., 0] = -dz_dx
-        normal[..., 1] = -dz_dy
-        normal[..., 2] = 1.0
-
-        # Normalize
-        norm = np.linalg.norm(normal, axis=2, keepdims=True)
-        normal = normal / (norm + 1e-6)
-
-        # Convert from [-1, 1] to [0, 255] for PNG
-        normal_uint8 = ((normal + 1) * 0.5 * 255).astype(np.uint8)
-
-        return normal_uint8
-
     @routes.post('/lattice/normal')
     async def generate_normal(request):
         """
@@ -884,10 +1653,29 @@ try:
         {
             "image": "base64_encoded_png",  // RGB image
             "depth": "base64_encoded_png",  // Optional: pre-computed depth map
+            "depth_format": "png" | "png16" | "f16" | "f32",  // Encoding of "depth"
+            "depth_width": 1024,   // f16/f32 size (metadata width/height), else the image's
+            "depth_height": 768,   // Depth at another size is resized to the image
+            "depth_range": [min, max],  // Optional: map PNG depth back to model units
+            "intrinsics": [[fx, 0, cx], [0, fy, cy], [0, 0, 1]],  // Optional camera intrinsics
+            "scales": [1, 2, 4],  // Finite-difference steps (pixels) fused into the normals
             "method": "algebraic" | "normalcrafter",
-            "depth_model": "DA3-LARGE-1.1"  // If depth not provided
+            "max_res": 1024,  // NormalCrafter inference resolution (long side)
+            "depth_model": "DA3-LARGE-1.1",  // If depth not provided
+            "fast": false,  // Generated depth: low-res inference + guided upsampling
+            "fast_size": 280
         }
 
+        "depth" may be an 8- or 16-bit PNG, or base64 of the raw little-endian
+        float buffer returned by /lattice/depth with format f16/f32.
+        Normals are computed from camera-space positions, so PNG depth without
+        a depth_range is read as relative depth spanning 1-2 units.
+
+        "normalcrafter" predicts normals from the image with NormalCrafter.
+        When it isn't installed (or only depth was sent) the algebraic
+        normals are returned with "fallback": true and a message. See
+        /lattice/normal/video for clips.
+
         Returns:
         {
             "status": "success",
@@ -903,82 +1691,206 @@ try:
             import io
 
             method = data.get('method', 'algebraic')
+            depth_format = data.get('depth_format', 'png')
+
+            if depth_format not in DEPTH_FORMATS:
+                return web.json_response({
+                    "status": "error",
+                    "message": f"Unknown depth format: {depth_format}"
+                }, status=400)
 
             # Get or generate depth map
             depth_np = None
+            pil_image = None
+            depth_cached = False
+            intrinsics = data.get('intrinsics')
 
-            if 'depth' in data and data['depth']:
-                # Use provided depth map
-                depth_data = base64.b64decode(data['depth'])
-                depth_pil = Image.open(io.BytesIO(depth_data)).convert('L')
-                depth_np = np.array(depth_pil)
-
-            elif 'image' in data and data['image']:
-                # Generate depth from image
+            if 'image' in data and data['image']:
                 image_data = base64.b64decode(data['image'])
                 pil_image = Image.open(io.BytesIO(image_data)).convert('RGB')
 
-                # Try DepthAnything V3
-                model = _load_depth_model(data.get('depth_model', 'DA3-LARGE-1.1'))
-
-                if model is not None:
-                    temp_path = '/tmp/lattice_normal_input.png'
-                    pil_image.save(temp_path)
-                    result = model.inference([temp_path])
-                    depth_np = result['depth'][0]
+            # NormalCrafter predicts normals from the image directly
+            normals = None
+            fallback_message = None
+            if method == 'normalcrafter':
+                model = await run_in_depth_executor(_load_normal_model)
+                if model is not None and pil_image is not None:
+                    # Single frame through the video model
+                    runs = await run_in_depth_executor(lambda: list(normalcrafter_video(
+                        model, [np.array(pil_image)],
+                        max_res=int(data.get('max_res', DEFAULT_NORMAL_MAX_RES))
+                    )))
+                    normals = runs[0][1][0]
                 else:
-                    # Fallback to grayscale
-                    depth_np = np.array(pil_image.convert('L'))
+                    method = 'algebraic'
+                    fallback_message = ("NormalCrafter needs an image" if model is not None
+                                        else "NormalCrafter not available, used algebraic normals")
+
+            if normals is None:
+                # Depth for the algebraic normals
+                if 'depth' in data and data['depth']:
+                    # Use provided depth map at full precision
+                    depth_range = data.get('depth_range')
+                    if depth_range is None and depth_format not in RAW_DEPTH_DTYPES:
+                        depth_range = RELATIVE_DEPTH_RANGE
+                    try:
+                        depth_np = _decode_request_depth(
+                            data, depth_format,
+                            (pil_image.height, pil_image.width) if pil_image is not None else None,
+                            depth_range
+                        )
+                    except ValueError as e:
+                        return web.json_response({
+                            "status": "error",
+                            "message": str(e)
+                        }, status=400)
+
+                elif pil_image is not None:
+                    # Generate depth from image (reusing a cached depth pass)
+                    # Try DepthAnything V3
+                    result, depth_cached = await _infer_depth_cached(
+                        np.array(pil_image), data.get('depth_model', 'DA3-LARGE-1.1'), data)
+
+                    if result is not None:
+                        depth_np = result['depth']
+                        if 'intrinsics' in result and intrinsics is None:
+                            intrinsics = result['intrinsics']
+                    else:
+                        # Fallback to grayscale as relative depth
+                        low, high = RELATIVE_DEPTH_RANGE
+                        depth_np = low + np.array(pil_image.convert('L'), dtype=np.float32) / 255.0 * (high - low)
 
-            else:
-                return web.json_response({
-                    "status": "error",
-                    "message": "No image or depth map provided"
-                }, status=400)
-
-            # Generate normal map
-            if method == 'normalcrafter':
-                model = _load_normal_model()
-                if model is not None:
-                    # Use NormalCrafter (not yet implemented)
-                    pass
+                else:
+                    return web.json_response({
+                        "status": "error",
+                        "message": "No image or depth map provided"
+                    }, status=400)
 
-            # Default: algebraic depth-to-normal
-            normal_np = _depth_to_normal_algebraic(depth_np)
+                # Default: algebraic depth-to-normal from camera-space positions
+                scales = tuple(data.get('scales', DEFAULT_NORMAL_SCALES))
+                try:
+                    normals = await run_in_depth_executor(depth_to_normals, depth_np, intrinsics, scales)
+                except ValueError as e:
+                    return web.json_response({
+                        "status": "error",
+                        "message": str(e)
+                    }, status=400)
 
-            # Convert to base64 PNG
-            normal_pil = Image.fromarray(normal_np, mode='RGB')
-            buffer = io.BytesIO()
-            normal_pil.save(buffer, format='PNG')
-            normal_b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            normal_np = encode_normals(normals)
+            normal_b64 = _array_to_base64_png(normal_np, 'RGB')
 
-            # Also return depth if we generated it
+            # Also return the depth that was used as an 8-bit preview
             depth_b64 = None
             if depth_np is not None:
-                depth_normalized = depth_np
-                if depth_np.max() > 1:
-                    depth_normalized = depth_np
-                else:
-                    depth_normalized = (depth_np * 255).astype(np.uint8)
-
-                if depth_normalized.dtype != np.uint8:
-                    depth_normalized = depth_normalized.astype(np.uint8)
+                depth_b64, _ = encode_depth(depth_np.astype(np.float32), 'png')
 
-                depth_pil = Image.fromarray(depth_normalized, mode='L')
-                buffer = io.BytesIO()
-                depth_pil.save(buffer, format='PNG')
-                depth_b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-            return web.json_response({
+            response = {
                 "status": "success",
                 "normal": normal_b64,
                 "depth": depth_b64,
                 "method": method,
                 "metadata": {
                     "width": normal_np.shape[1],
-                    "height": normal_np.shape[0]
+                    "height": normal_np.shape[0],
+                    "depth_cached": depth_cached
                 }
-            })
+            }
+            if fallback_message:
+                response["fallback"] = True
+                response["message"] = fallback_message
+
+            return web.json_response(response)
+
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return web.json_response({
+                "status": "error",
+                "message": str(e)
+            }, status=500)
+
+    @routes.post('/lattice/normal/video')
+    async def generate_normal_video(request):
+        """
+        Temporally consistent normals for a frame sequence with NormalCrafter.
+
+        Request body:
+        {
+            "frames": ["base64_encoded_png", ...],
+            "window": 14,  // Frames per NormalCrafter pass
+            "overlap": 4,  // Frames blended between consecutive windows
+            "max_res": 1024,  // Inference resolution (long side)
+            "decode_chunk_size": 7  // Frames per VAE decode batch
+        }
+
+        Streams newline-delimited JSON (application/x-ndjson), one line per
+        finished run of frames (frames are final once no later window
+        overlaps them):
+        {"chunk": 0, "start": 0, "frames": [{"frame": 0, "normal": "base64_png"}]}
+
+        Final line:
+        {"status": "success", "done": true, "num_frames": 81}
+        or {"status": "error", "message": "..."} if inference fails midway.
+        """
+        try:
+            data = await request.json()
+
+            frames_b64 = data.get('frames') or []
+            window = int(data.get('window', DEFAULT_NORMAL_WINDOW))
+            overlap = int(data.get('overlap', DEFAULT_NORMAL_OVERLAP))
+
+            if not frames_b64:
+                return web.json_response({
+                    "status": "error",
+                    "message": "No frames provided"
+                }, status=400)
+
+            if window < 1 or not 0 <= overlap < window:
+                return web.json_response({
+                    "status": "error",
+                    "message": "window must be >= 1 and overlap in [0, window)"
+                }, status=400)
+
+            model = await run_in_depth_executor(_load_normal_model)
+            if model is None:
+                return web.json_response({
+                    "status": "error",
+                    "message": f"NormalCrafter not available: {_normal_model_error}"
+                }, status=503)
+
+            from PIL import Image
+            import io
+
+            def decode_frame(frame_b64):
+                return np.array(Image.open(io.BytesIO(base64.b64decode(frame_b64))).convert('RGB'))
+
+            # Inference runs on the depth executor; chunks stream as they finish
+            def run_sequence():
+                runs = normalcrafter_video(
+                    model, frames_b64,
+                    window=window,
+                    overlap=overlap,
+                    max_res=int(data.get('max_res', DEFAULT_NORMAL_MAX_RES)),
+                    decode_chunk_size=int(data.get('decode_chunk_size', DEFAULT_DECODE_CHUNK)),
+                    decode=decode_frame
+                )
+                for chunk_index, (start, normals) in enumerate(runs):
+                    yield {
+                        "chunk": chunk_index,
+                        "start": start,
+                        "frames": [
+                            {"frame": start + offset, "normal": _array_to_base64_png(encode_normals(normal), 'RGB')}
+                            for offset, normal in enumerate(normals)
+                        ]
+                    }
+
+                yield {
+                    "status": "success",
+                    "done": True,
+                    "num_frames": len(frames_b64)
+                }
+
+            return await _stream_ndjson(request, get_depth_executor(), run_sequence())
 
         except Exception as e:
             import traceback
@@ -992,6 +1904,146 @@ try:
     # Point Cloud Endpoint - Generate 3D point cloud from depth
     # =========================================================================
 
+    def _binary_response(payload, metadata):
+        """Serve raw bytes with JSON metadata in the X-Lattice-Metadata header"""
+        return web.Response(
+            body=payload,
+            content_type='application/octet-stream',
+            headers={
+                "X-Lattice-Metadata": json.dumps({"status": "success", **metadata}),
+                "Access-Control-Expose-Headers": "X-Lattice-Metadata"
+            }
+        )
+
+    POINTCLOUD_JSON_FORMATS = ('json', 'ply', 'npy')
+
+    def _pointcloud_json_payload(points_np, colors_np, output_format):
+        """Response fields for the point cloud formats that travel inside JSON"""
+        import io
+
+        if output_format == 'json':
+            return {
+                "points": points_np.tolist(),
+                "colors": colors_np.tolist()
+            }
+
+        if output_format == 'ply':
+            # ASCII PLY wrapped in JSON (kept for older clients)
+            ply_content = encode_ply_ascii(points_np, colors_np)
+            payload = ply_content.encode('utf-8')
+        else:
+            # NPY of [x, y, z, r, g, b] with colors in 0-1
+            combined = np.hstack([points_np, colors_np.astype(np.float32) / 255.0])
+            buffer = io.BytesIO()
+            np.save(buffer, combined)
+            payload = buffer.getvalue()
+
+        return {
+            "pointcloud": base64.b64encode(payload).decode('utf-8'),
+            "format": output_format
+        }
+
+    def _decode_request_depth(data, depth_format, image_shape=None, depth_range=None):
+        """
+        Decode data['depth'] and bring it to the image's size.
+
+        Raw f16/f32 buffers are read at depth_width x depth_height (the
+        width/height /lattice/depth returns in its metadata) or, without
+        those, at image_shape. Depth at any other size is resized to
+        image_shape so it lines up pixel for pixel with the image.
+
+        Raises:
+            ValueError: from decode_depth()
+        """
+        shape = image_shape
+        if 'depth_width' in data and 'depth_height' in data:
+            shape = (int(data['depth_height']), int(data['depth_width']))
+        depth_np = decode_depth(data['depth'], depth_format, shape=shape, depth_range=depth_range)
+        if image_shape is not None:
+            depth_np = resize_depth(depth_np, int(image_shape[0]), int(image_shape[1]))
+        return depth_np
+
+    async def _resolve_depth(data, image_np):
+        """
+        Depth for a point cloud or mesh request on image_np.
+
+        Decodes data['depth'] (per data['depth_format']/'depth_range') when
+        given, otherwise reuses the float depth cached by an earlier request
+        on the same image with the same depth_model and mode (fast/tiled),
+        inferring it only if nothing is cached.
+
+        Returns:
+            (depth, intrinsics, depth_key, error_response). depth_key
+            identifies the depth source for cache keys; error_response is a
+            ready-made JSON error, or None on success.
+        """
+        intrinsics = data.get('intrinsics')
+
+        if data.get('depth'):
+            depth_format = data.get('depth_format', 'png')
+            if depth_format not in DEPTH_FORMATS:
+                return None, None, None, web.json_response({
+                    "status": "error",
+                    "message": f"Unknown depth format: {depth_format}"
+                }, status=400)
+
+            # Full-precision depth: 0-1 for PNGs (or depth_range), raw floats as-is
+            try:
+                depth_np = _decode_request_depth(data, depth_format, image_np.shape[:2], data.get('depth_range'))
+            except ValueError as e:
+                return None, None, None, web.json_response({
+                    "status": "error",
+                    "message": str(e)
+                }, status=400)
+            return depth_np, intrinsics, [data['depth'], depth_format, data.get('depth_range')], None
+
+        image_key = image_hash(image_np)
+        model_name = data.get('depth_model', 'DA3-LARGE-1.1')
+        result, _ = await _infer_depth_cached(image_np, model_name, data, image_key)
+        if result is None:
+            return None, None, None, web.json_response({
+                "status": "error",
+                "message": "No depth provided and DepthAnything V3 not available"
+            }, status=503)
+
+        if intrinsics is None and 'intrinsics' in result:
+            intrinsics = result['intrinsics'].tolist()
+        return result['depth'], intrinsics, [depth_cache_key(image_key, model_name, _depth_mode(data))], None
+
+    SPLAT_FORMATS = ('splat', 'splat_ply')
+
+    async def _splat_response(data, rgba_np, depth_np, intrinsics, output_format):
+        """Gaussian splats for a /lattice/pointcloud request, as raw bytes"""
+        import asyncio
+
+        normals = await run_in_depth_executor(
+            depth_to_normals, depth_np, intrinsics,
+            tuple(data.get('scales', DEFAULT_NORMAL_SCALES))
+        )
+        voxel_size = data.get('voxel_size')
+
+        def build():
+            splats = gaussians_from_depth(
+                depth_np, rgba_np,
+                intrinsics=intrinsics,
+                normals=normals,
+                subsample=max(1, data.get('subsample', 1)),
+                voxel_size=float(voxel_size) if voxel_size else None,
+                max_splats=int(data.get('max_points') or DEFAULT_SPLAT_BUDGET)
+            )
+            encoder = encode_splat if output_format == 'splat' else encode_splat_ply
+            return splats, encoder(splats)
+
+        splats, payload = await asyncio.get_event_loop().run_in_executor(None, build)
+
+        return _binary_response(payload, {
+            "format": output_format,
+            "num_points": len(splats['positions']),
+            "source_points": splats['source_points'],
+            "voxel_size": splats['voxel_size'],
+            "bounds": compute_bounds(splats['positions'])
+        })
+
     @routes.post('/lattice/pointcloud')
     async def generate_pointcloud(request):
         """
@@ -1000,10 +2052,18 @@ try:
         Request body:
         {
             "image": "base64_encoded_png",   // RGB image for colors
-            "depth": "base64_encoded_png",   // Depth map
+            "depth": "base64_encoded_png",   // Optional: depth map (see below)
+            "depth_format": "png" | "png16" | "f16" | "f32",  // Encoding of "depth"
+            "depth_width": 504, "depth_height": 378,  // f16/f32 size if not the image's
+            "depth_range": [min, max],  // Optional: map PNG depth back to model units
             "intrinsics": [[fx, 0, cx], [0, fy, cy], [0, 0, 1]],  // Optional camera intrinsics
-            "format": "ply" | "json" | "npy",
-            "subsample": 1  // Take every Nth point (for performance)
+            "format": "ply" | "json" | "npy" | "ply_binary" | "raw" | "splat" | "splat_ply",
+            "subsample": 1,  // Take every Nth point (for performance)
+            "voxel_size": 0.01,  // Optional: merge points per voxel (mean position/color)
+            "lod": "auto" | 0..lod_depth,  // Optional: serve one octree level
+            "max_points": 200000,  // Optional: point budget for "auto" LOD
+            "lod_depth": 10,  // Finest octree level
+            "cloud_id": "..."  // Fetch another level of a previous LOD response
         }
 
         Returns:
@@ -1011,8 +2071,32 @@ try:
             "status": "success",
             "pointcloud": "base64_encoded_ply" or JSON array,
             "num_points": 1000000,
-            "bounds": {"min": [x,y,z], "max": [x,y,z]}
+            "bounds": {"min": [x,y,z], "max": [x,y,z]},
+            "cloud_id": "...", "lod": 8, "lod_levels": [1, 5, ...]  // LOD requests only
         }
+
+        LOD requests build an octree once and return a coarse level; finer
+        levels are then fetched with {"cloud_id", "lod"} without re-sending
+        the image and depth.
+
+        PNG depth (8- or 16-bit) decodes to 0-1, or to depth_range when given
+        (the depth_min/depth_max metadata of /lattice/depth). f16/f32 depth
+        is base64 of the raw little-endian buffer at the image's size and is
+        used as-is. Without "depth", the float depth cached by an earlier
+        depth/normal/geometry request on the same image is reused (with its
+        intrinsics), and DepthAnything only runs if nothing is cached.
+
+        The "ply_binary" and "raw" formats return application/octet-stream
+        instead, with the metadata above (minus "pointcloud") as JSON in the
+        X-Lattice-Metadata response header. "raw" is interleaved float32 XYZ +
+        uint8 RGBA at 16 bytes per point, loadable as a Float32Array view.
+
+        "splat" (packed 32-byte .splat records) and "splat_ply" (reference
+        3DGS PLY) export Gaussian splats instead of points: scale from each
+        pixel's depth footprint, orientation from the depth normals, color
+        and opacity from the image (RGBA PNGs keep their alpha). Samples
+        are voxel-merged to at most "max_points" splats (default 500000),
+        or per "voxel_size" when given. Splat formats don't use LOD.
         """
         try:
             data = await request.json()
@@ -1020,129 +2104,368 @@ try:
             from PIL import Image
             import io
 
-            # Decode image and depth
-            if 'image' not in data or 'depth' not in data:
-                return web.json_response({
-                    "status": "error",
-                    "message": "Both image and depth are required"
-                }, status=400)
+            output_format = data.get('format', 'json')
+            cloud_id = data.get('cloud_id')
+            lod = data.get('lod')
+            max_points = data.get('max_points')
+            lod_info = {}
+
+            if cloud_id:
+                # Follow-up request for another level of a cached octree
+                octree = get_cached_octree(cloud_id)
+                if octree is None:
+                    return web.json_response({
+                        "status": "error",
+                        "message": f"Point cloud expired or unknown: {cloud_id}"
+                    }, status=404)
 
-            image_data = base64.b64decode(data['image'])
-            depth_data = base64.b64decode(data['depth'])
+            else:
+                # Decode image and depth
+                if 'image' not in data:
+                    return web.json_response({
+                        "status": "error",
+                        "message": "An image is required"
+                    }, status=400)
 
-            image_pil = Image.open(io.BytesIO(image_data)).convert('RGB')
-            depth_pil = Image.open(io.BytesIO(depth_data)).convert('L')
+                image_data = base64.b64decode(data['image'])
+                image_pil = Image.open(io.BytesIO(image_data))
+                rgba_np = np.array(image_pil.convert('RGBA')) if output_format in SPLAT_FORMATS else None
+                image_np = np.array(image_pil.convert('RGB'))
 
-            image_np = np.array(image_pil)
-            depth_np = np.array(depth_pil).astype(np.float32)
+                depth_np, intrinsics, depth_key, error = await _resolve_depth(data, image_np)
+                if error is not None:
+                    return error
 
-            # Normalize depth to 0-1 range
-            if depth_np.max() > 1:
-                depth_np = depth_np / 255.0
+                if output_format in SPLAT_FORMATS:
+                    return await _splat_response(data, rgba_np, depth_np, intrinsics, output_format)
 
-            height, width = depth_np.shape
-            output_format = data.get('format', 'json')
-            subsample = max(1, data.get('subsample', 1))
+                subsample = max(1, data.get('subsample', 1))
 
-            # Get or estimate camera intrinsics
-            intrinsics = data.get('intrinsics')
-            if intrinsics is None:
-                # Estimate reasonable intrinsics
-                fx = fy = max(width, height)  # Assume ~90 degree FOV
-                cx, cy = width / 2, height / 2
-                intrinsics = [[fx, 0, cx], [0, fy, cy], [0, 0, 1]]
-
-            fx, fy = intrinsics[0][0], intrinsics[1][1]
-            cx, cy = intrinsics[0][2], intrinsics[1][2]
-
-            # Generate point cloud
-            points = []
-            colors = []
-
-            for y in range(0, height, subsample):
-                for x in range(0, width, subsample):
-                    z = depth_np[y, x]
-                    if z > 0.01:  # Skip near-zero depth
-                        # Back-project to 3D
-                        x3d = (x - cx) * z / fx
-                        y3d = (y - cy) * z / fy
-                        z3d = z
-
-                        points.append([x3d, y3d, z3d])
-                        colors.append(image_np[y, x].tolist())
-
-            points_np = np.array(points, dtype=np.float32)
-            colors_np = np.array(colors, dtype=np.uint8)
-
-            # Calculate bounds
-            if len(points_np) > 0:
-                bounds = {
-                    "min": points_np.min(axis=0).tolist(),
-                    "max": points_np.max(axis=0).tolist()
+                # Vectorized back-projection (intrinsics estimated if not provided)
+                points_np, colors_np = backproject_depth(
+                    depth_np,
+                    image_np,
+                    intrinsics=intrinsics,
+                    subsample=subsample
+                )
+
+                # Optional voxel-grid downsampling (mean position/color per voxel)
+                voxel_size = data.get('voxel_size')
+                if voxel_size:
+                    points_np, colors_np = voxel_downsample(points_np, colors_np, float(voxel_size))
+
+                octree = None
+                if lod is not None or max_points is not None:
+                    octree = PointCloudOctree(
+                        points_np, colors_np,
+                        max_depth=data.get('lod_depth', DEFAULT_OCTREE_DEPTH)
+                    )
+                    cloud_id = hashlib.sha1(json.dumps(
+                        [data['image'], depth_key, intrinsics,
+                         subsample, voxel_size, octree.max_depth]
+                    ).encode('utf-8')).hexdigest()
+                    cache_octree(cloud_id, octree)
+
+            if octree is not None:
+                # Serve one LOD level: explicit, or the finest within the point budget
+                if lod is None or lod == 'auto':
+                    level = octree.level_for_budget(int(max_points or DEFAULT_LOD_BUDGET))
+                else:
+                    level = min(max(int(lod), 0), octree.max_depth)
+
+                points_np, colors_np = octree.level(level)
+                lod_info = {
+                    "cloud_id": cloud_id,
+                    "lod": level,
+                    "lod_levels": octree.level_counts()
                 }
-            else:
-                bounds = {"min": [0, 0, 0], "max": [0, 0, 0]}
+
+            bounds = compute_bounds(points_np)
 
             # Format output
-            if output_format == 'json':
+            if output_format in POINTCLOUD_JSON_FORMATS:
                 return web.json_response({
                     "status": "success",
-                    "points": points_np.tolist(),
-                    "colors": colors_np.tolist(),
-                    "num_points": len(points),
-                    "bounds": bounds
+                    **_pointcloud_json_payload(points_np, colors_np, output_format),
+                    "num_points": len(points_np),
+                    "bounds": bounds,
+                    **lod_info
                 })
 
-            elif output_format == 'ply':
-                # Generate PLY file
-                ply_header = f"""ply
-format ascii 1.0
-element vertex {len(points)}
-property float x
-property float y
-property float z
-property uchar red
-property uchar green
-property uchar blue
-end_header
-"""
-                ply_data = []
-                for i, (pt, col) in enumerate(zip(points_np, colors_np)):
-                    ply_data.append(f"{pt[0]:.6f} {pt[1]:.6f} {pt[2]:.6f} {col[0]} {col[1]} {col[2]}")
+            elif output_format == 'ply_binary':
+                # binary_little_endian PLY served as raw bytes
+                return _binary_response(encode_ply_binary(points_np, colors_np), {
+                    "format": "ply_binary",
+                    "num_points": len(points_np),
+                    "bounds": bounds,
+                    **lod_info
+                })
 
-                ply_content = ply_header + "\n".join(ply_data)
-                ply_b64 = base64.b64encode(ply_content.encode('utf-8')).decode('utf-8')
+            elif output_format == 'raw':
+                # Interleaved float32 XYZ + uint8 RGBA, 16 bytes per point
+                return _binary_response(encode_raw_buffer(points_np, colors_np), {
+                    "format": "raw",
+                    "num_points": len(points_np),
+                    "stride": RAW_POINT_STRIDE,
+                    "layout": {"position": {"offset": 0, "type": "float32", "size": 3},
+                               "color": {"offset": 12, "type": "uint8", "size": 4}},
+                    "bounds": bounds,
+                    **lod_info
+                })
 
+            else:
                 return web.json_response({
-                    "status": "success",
-                    "pointcloud": ply_b64,
-                    "format": "ply",
-                    "num_points": len(points),
-                    "bounds": bounds
-                })
+                    "status": "error",
+                    "message": f"Unknown format: {output_format}"
+                }, status=400)
 
-            elif output_format == 'npy':
-                # Generate NPY binary
-                combined = np.hstack([points_np, colors_np.astype(np.float32) / 255.0])
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return web.json_response({
+                "status": "error",
+                "message": str(e)
+            }, status=500)
 
-                buffer = io.BytesIO()
-                np.save(buffer, combined)
-                npy_b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    MESH_FORMATS = ('glb', 'ply')
+
+    @routes.post('/lattice/mesh')
+    async def generate_mesh(request):
+        """
+        Decimated triangle mesh from image + depth, as binary glTF or PLY.
+
+        Request body:
+        {
+            "image": "base64_encoded_png",  // RGB image for vertex colors
+            "depth": "...", "depth_format": "png", "depth_range": [min, max],  // As /lattice/pointcloud
+            "intrinsics": [[fx, 0, cx], [0, fy, cy], [0, 0, 1]],  // Optional
+            "format": "glb" | "ply",
+            "step": 1,  // Grid spacing in pixels
+            "discontinuity": 0.1,  // Relative depth jump that splits the surface
+            "tolerance": 0.005,  // Max relative depth error of merged blocks (0 = full grid)
+            "max_level": 6,  // Largest merged block is 2^max_level cells
+            "normals": false  // Per-vertex normals from the depth
+        }
 
+        Returns the mesh as application/octet-stream (model/gltf-binary
+        layout for "glb", binary_little_endian PLY for "ply"), with
+        {"status", "format", "num_vertices", "num_faces", "grid_vertices",
+        "bounds"} as JSON in the X-Lattice-Metadata response header.
+
+        Depth is resolved exactly as for /lattice/pointcloud: decoded from
+        "depth" when given, else reused from the depth cache, else inferred.
+        Triangles spanning a depth discontinuity are dropped so foreground
+        and background don't join with stretched "rubber sheet" faces;
+        near-planar regions collapse to large triangles. GLB vertices stay
+        in camera space with a root rotation to glTF's Y-up axes.
+        """
+        try:
+            data = await request.json()
+
+            import asyncio
+            from PIL import Image
+            import io
+
+            output_format = data.get('format', 'glb')
+            if output_format not in MESH_FORMATS:
                 return web.json_response({
-                    "status": "success",
-                    "pointcloud": npy_b64,
-                    "format": "npy",
-                    "num_points": len(points),
-                    "bounds": bounds
-                })
+                    "status": "error",
+                    "message": f"Unknown mesh format: {output_format}"
+                }, status=400)
 
-            else:
+            if 'image' not in data:
                 return web.json_response({
                     "status": "error",
-                    "message": f"Unknown format: {output_format}"
+                    "message": "An image is required"
+                }, status=400)
+
+            image_data = base64.b64decode(data['image'])
+            image_np = np.array(Image.open(io.BytesIO(image_data)).convert('RGB'))
+
+            depth_np, intrinsics, _, error = await _resolve_depth(data, image_np)
+            if error is not None:
+                return error
+
+            normals = None
+            if data.get('normals', False):
+                normals = await run_in_depth_executor(
+                    depth_to_normals, depth_np, intrinsics,
+                    tuple(data.get('scales', DEFAULT_NORMAL_SCALES))
+                )
+
+            loop = asyncio.get_event_loop()
+            mesh = await loop.run_in_executor(None, lambda: mesh_from_depth(
+                depth_np, image_np,
+                intrinsics=intrinsics,
+                step=int(data.get('step', 1)),
+                discontinuity=float(data.get('discontinuity', DEFAULT_MESH_DISCONTINUITY)),
+                tolerance=float(data.get('tolerance', DEFAULT_MESH_TOLERANCE)),
+                max_level=int(data.get('max_level', DEFAULT_MESH_MAX_LEVEL)),
+                normals=normals
+            ))
+
+            encoder = encode_glb if output_format == 'glb' else encode_mesh_ply
+            payload = await loop.run_in_executor(None, encoder, mesh)
+
+            return _binary_response(payload, {
+                "format": output_format,
+                "num_vertices": len(mesh['vertices']),
+                "num_faces": len(mesh['faces']),
+                "grid_vertices": mesh['grid_vertices'],
+                "bounds": compute_bounds(mesh['vertices'])
+            })
+
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return web.json_response({
+                "status": "error",
+                "message": str(e)
+            }, status=500)
+
+    @routes.post('/lattice/geometry')
+    async def generate_geometry(request):
+        """
+        Depth, normals and point cloud for one image from a single depth pass.
+
+        Request body:
+        {
+            "image": "base64_encoded_png",
+            "model": "DA3-LARGE-1.1",
+            "fast": false, "fast_size": 280,  // As /lattice/depth
+            "tiled": false, "tile_size": 1024, "tile_overlap": 128,
+            "depth_format": "png" | "png16" | "f16" | "f32",
+            "intrinsics": [[fx, 0, cx], [0, fy, cy], [0, 0, 1]],  // Optional, else the model's
+            "normals": true,
+            "scales": [1, 2, 4],  // Normal finite-difference steps
+            "pointcloud": true,
+            "pointcloud_format": "json" | "ply" | "npy",
+            "subsample": 1,
+            "voxel_size": 0.01  // Optional
+        }
+
+        Returns:
+        {
+            "status": "success",
+            "image_id": "...",  // Content hash; the float depth stays cached under it
+            "depth": "...",  // PNG, or base64 of the raw buffer for f16/f32
+            "depth_metadata": {"format": "png16", "depth_min": ..., "depth_max": ...},
+            "normal": "base64_encoded_png",
+            "pointcloud": {"points": [...], "colors": [...], "num_points": N, "bounds": {...}},
+            "intrinsics": [[...]],
+            "cached": false  // true if the depth came from the cache
+        }
+
+        The float depth is kept in the depth result cache, so later
+        /lattice/depth, /lattice/normal or /lattice/pointcloud calls on the
+        same image skip inference.
+        """
+        try:
+            data = await request.json()
+
+            image_b64 = data.get('image')
+            if not image_b64:
+                return web.json_response({
+                    "status": "error",
+                    "message": "No image provided"
+                }, status=400)
+
+            depth_format = data.get('depth_format', 'png')
+            pointcloud_format = data.get('pointcloud_format', 'json')
+
+            if depth_format not in DEPTH_FORMATS:
+                return web.json_response({
+                    "status": "error",
+                    "message": f"Unknown depth format: {depth_format}"
+                }, status=400)
+
+            if pointcloud_format not in POINTCLOUD_JSON_FORMATS:
+                return web.json_response({
+                    "status": "error",
+                    "message": f"Unknown point cloud format: {pointcloud_format}"
+                }, status=400)
+
+            if data.get('fast', False) and data.get('tiled', False):
+                return web.json_response({
+                    "status": "error",
+                    "message": "fast and tiled modes are exclusive"
                 }, status=400)
 
+            from PIL import Image
+            import io
+            import asyncio
+
+            image_np = np.array(Image.open(io.BytesIO(base64.b64decode(image_b64))).convert('RGB'))
+            model_name = data.get('model', 'DA3-LARGE-1.1')
+
+            result, cached = await _infer_depth_cached(image_np, model_name, data)
+            if result is None:
+                return web.json_response({
+                    "status": "error",
+                    "message": "DepthAnything V3 not available"
+                }, status=503)
+
+            depth_np = result['depth']
+            intrinsics = data.get('intrinsics')
+            if intrinsics is None and 'intrinsics' in result:
+                intrinsics = result['intrinsics'].tolist()
+
+            def build_pointcloud():
+                points_np, colors_np = backproject_depth(
+                    depth_np, image_np,
+                    intrinsics=intrinsics,
+                    subsample=max(1, data.get('subsample', 1))
+                )
+                if data.get('voxel_size'):
+                    points_np, colors_np = voxel_downsample(points_np, colors_np, float(data['voxel_size']))
+                return {
+                    **_pointcloud_json_payload(points_np, colors_np, pointcloud_format),
+                    "num_points": len(points_np),
+                    "bounds": compute_bounds(points_np)
+                }
+
+            # Normals (torch, depth executor) and the point cloud (numpy,
+            # default executor) both derive from the same float depth
+            loop = asyncio.get_event_loop()
+            tasks = []
+            if data.get('normals', True):
+                tasks.append(run_in_depth_executor(
+                    depth_to_normals, depth_np, intrinsics,
+                    tuple(data.get('scales', DEFAULT_NORMAL_SCALES))
+                ))
+            if data.get('pointcloud', True):
+                tasks.append(loop.run_in_executor(None, build_pointcloud))
+            outputs = list(await asyncio.gather(*tasks))
+
+            depth_payload, depth_info = encode_depth(depth_np, depth_format)
+            if isinstance(depth_payload, bytes):
+                depth_payload = base64.b64encode(depth_payload).decode('utf-8')
+
+            response = {
+                "status": "success",
+                "image_id": image_hash(image_np),
+                "depth": depth_payload,
+                "depth_metadata": {"format": depth_format, **depth_info},
+                "intrinsics": intrinsics,
+                "cached": cached,
+                "metadata": {
+                    "model": model_name,
+                    "width": int(image_np.shape[1]),
+                    "height": int(image_np.shape[0])
+                }
+            }
+            if data.get('normals', True):
+                response["normal"] = _array_to_base64_png(encode_normals(outputs.pop(0)), 'RGB')
+            if data.get('pointcloud', True):
+                response["pointcloud"] = outputs.pop(0)
+
+            return web.json_response(response)
+
+        except ValueError as e:
+            return web.json_response({
+                "status": "error",
+                "message": str(e)
+            }, status=400)
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -1294,6 +2617,134 @@ Consider:
 - Parallax opportunities based on depth layers
 """
 
+    # Schema for constrained decoding; mirrors the structure in the prompt
+    # above and the required fields of the frontend's intent types
+    _VLM_POINT_2D = {"type": ["object", "null"], "properties": {"x": {"type": "number"}, "y": {"type": "number"}},
+                     "required": ["x", "y"]}
+    VLM_INTENT_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "description": {"type": "string"},
+            "confidence": {"type": "number"},
+            "cameraIntents": {"type": "array", "items": {
+                "type": "object",
+                "properties": {
+                    "type": {"enum": ["dolly", "truck", "pedestal", "pan", "tilt", "roll", "orbit", "drift",
+                                      "handheld", "crane", "zoom", "follow_path"]},
+                    "intensity": {"enum": ["very_subtle", "subtle", "medium", "strong", "dramatic"]},
+                    "axis": {"enum": ["x", "y", "z", "all"]},
+                    "durationFrames": {"type": "integer"},
+                    "suggestedEasing": {"enum": ["linear", "easeIn", "easeOut", "easeInOut", "bounce", "elastic"]}
+                },
+                "required": ["type", "intensity"]
+            }},
+            "splineIntents": {"type": "array", "items": {
+                "type": "object",
+                "properties": {
+                    "usage": {"enum": ["camera_path", "emitter_path", "text_path", "layer_path"]},
+                    "smoothness": {"type": "number"},
+                    "complexity": {"type": "integer"},
+                    "worldSpace": {"type": "boolean"},
+                    "suggestedPoints": {"type": "array", "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "string"},
+                            "x": {"type": "number"},
+                            "y": {"type": "number"},
+                            "depth": {"type": "number"},
+                            "handleIn": _VLM_POINT_2D,
+                            "handleOut": _VLM_POINT_2D,
+                            "type": {"enum": ["smooth", "corner", "symmetric"]}
+                        },
+                        "required": ["id", "x", "y"]
+                    }},
+                    "closed": {"type": "boolean"}
+                },
+                "required": ["usage", "suggestedPoints"]
+            }},
+            "layerIntents": {"type": "array", "items": {
+                "type": "object",
+                "properties": {
+                    "motionType": {"enum": ["parallax", "float", "sway", "breathe", "drift", "noise", "pulse",
+                                            "rotate", "follow_path"]},
+                    "amplitude": {"type": "number"},
+                    "frequency": {"type": "number"}
+                },
+                "required": ["motionType"]
+            }}
+        },
+        "required": ["description", "confidence", "cameraIntents", "splineIntents", "layerIntents"]
+    }
+
+    # Generation runs on one worker thread; the first request starts it
+    _vlm_worker = VLMWorker(_load_vlm_model)
+
+    async def _stream_vlm(request, vlm_request, stream_format):
+        """Stream a VLM request's tokens and parsed intents as NDJSON or SSE"""
+        import asyncio
+
+        try:
+            chunks = _vlm_worker.stream(vlm_request)
+        except VLMQueueFull as e:
+            return web.json_response({
+                "status": "error",
+                "message": str(e),
+                "queue": _vlm_worker.stats()
+            }, status=503)
+
+        if stream_format == 'sse':
+            content_type = "text/event-stream"
+            frame = lambda item: f"data: {json.dumps(item)}\n\n"
+        else:
+            content_type = "application/x-ndjson"
+            frame = lambda item: json.dumps(item) + "\n"
+
+        response = web.StreamResponse(headers={"Content-Type": content_type, "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        async def write(item):
+            await response.write(frame(item).encode('utf-8'))
+
+        parser = IntentStreamParser()
+        text = ""
+        try:
+            async for chunk in chunks:
+                text += chunk
+                await write({"token": chunk})
+                for event in parser.feed(chunk):
+                    await write(event)
+
+            response_text = text.strip()
+            await write({
+                "status": "success",
+                "response": response_text,
+                "parsed": parse_intent_json(response_text),
+                "model": vlm_request.model_name,
+                "request_id": vlm_request.request_id
+            })
+
+        except ConnectionResetError:
+            # Client went away mid-stream
+            vlm_request.cancel()
+            return response
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                message = "VLM request timed out"
+            else:
+                if not isinstance(e, (VLMUnavailable, VLMCancelled)):
+                    import traceback
+                    traceback.print_exc()
+                message = str(e)
+            error = {"status": "error", "message": message, "request_id": vlm_request.request_id}
+            if isinstance(e, VLMUnavailable):
+                error["fallback"] = True
+            await write(error)
+        finally:
+            await chunks.aclose()
+
+        await response.write_eof()
+        return response
+
     @routes.post('/lattice/vlm')
     async def analyze_with_vlm(request):
         """
@@ -1305,7 +2756,12 @@ Consider:
             "prompt": "User's motion description or request",
             "model": "qwen2-vl" | "qwen3-vl" | "qwen-vl",
             "max_tokens": 2048,
-            "temperature": 0.7
+            "temperature": 0.7,
+            "timeout": 300,  // Seconds queued + generating before giving up
+            "request_id": "...",  // Optional: id for /lattice/vlm/cancel
+            "stream": false | true | "ndjson" | "sse",
+            "max_visual_tokens": 1024,  // Image token budget (null = native resolution)
+            "constrained": true  // Constrain output to the intent JSON schema
         }
 
         Returns:
@@ -1313,8 +2769,32 @@ Consider:
             "status": "success",
             "response": "Raw model response text",
             "parsed": { ... structured intent if JSON parseable ... },
-            "model": "qwen2-vl"
+            "model": "qwen2-vl",
+            "request_id": "..."
         }
+
+        Generation happens on the VLM worker thread, never on the event
+        loop; concurrent requests with the same model and temperature are
+        batched. A full queue returns 503, a timeout 504, and a cancelled
+        request 499.
+
+        Images are downscaled once to the largest size on the model's patch
+        grid (28px for Qwen2-VL) whose visual-token count fits
+        max_visual_tokens; the processed pixels are cached per image, so
+        repeat prompts on the same frame skip preprocessing.
+
+        With "constrained" (the default), decoding is masked to
+        VLM_INTENT_SCHEMA, so the response is always parseable JSON with
+        valid enum values, and generation stops when the object closes.
+
+        With "stream", the response is newline-delimited JSON (or
+        Server-Sent Events for "sse", one "data:" line per item) as tokens
+        are generated:
+            {"token": "..."}                              raw text chunk
+            {"intent": "cameraIntents", "index": 0, "value": {...}}
+            {"field": "description", "value": "..."}
+        and finally the usual response object (or {"status": "error", ...}).
+        Intent and field items appear as soon as their JSON closes.
         """
         try:
             data = await request.json()
@@ -1324,108 +2804,74 @@ Consider:
             temperature = data.get('temperature', 0.7)
             user_prompt = data.get('prompt', 'Analyze this image and suggest compelling camera movements and animation paths.')
 
-            # Load model
-            model, processor = _load_vlm_model(model_name)
-
-            if model is None or processor is None:
-                return web.json_response({
-                    "status": "error",
-                    "message": "VLM model not available. Please install Qwen-VL or configure model path.",
-                    "fallback": True,
-                    "response": None
-                }, status=503)
-
             # Decode image if provided
             from PIL import Image as PILImage
             import io
-            import torch
+            import asyncio
 
             image = None
+            image_key = None
             if 'image' in data and data['image']:
                 image_data = base64.b64decode(data['image'])
                 image = PILImage.open(io.BytesIO(image_data)).convert('RGB')
-
-            # Construct messages for the model
-            messages = []
-
-            if image:
-                # Vision + text input
-                content = [
-                    {"type": "image", "image": image},
-                    {"type": "text", "text": f"{VLM_SYSTEM_PROMPT}\n\nUser request: {user_prompt}"}
-                ]
-            else:
-                # Text-only input
-                content = [
-                    {"type": "text", "text": f"{VLM_SYSTEM_PROMPT}\n\nUser request: {user_prompt}"}
-                ]
-
-            messages.append({"role": "user", "content": content})
-
-            # Process input
-            text_input = processor.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True
+                image_key = image_hash(np.asarray(image))
+
+            vlm_request = VLMRequest(
+                model_name,
+                f"User request: {user_prompt}",
+                system=VLM_SYSTEM_PROMPT,
+                image=image,
+                image_key=image_key,
+                max_visual_tokens=data.get('max_visual_tokens', DEFAULT_VISUAL_TOKENS),
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                schema=VLM_INTENT_SCHEMA if data.get('constrained', True) else None,
+                timeout=float(data.get('timeout', DEFAULT_VLM_TIMEOUT)),
+                request_id=data.get('request_id')
             )
 
-            if image:
-                inputs = processor(
-                    text=[text_input],
-                    images=[image],
-                    return_tensors="pt",
-                    padding=True
-                )
-            else:
-                inputs = processor(
-                    text=[text_input],
-                    return_tensors="pt",
-                    padding=True
-                )
-
-            # Move to device
-            device = next(model.parameters()).device
-            inputs = {k: v.to(device) for k, v in inputs.items()}
-
-            # Generate response
-            with torch.no_grad():
-                outputs = model.generate(
-                    **inputs,
-                    max_new_tokens=max_tokens,
-                    do_sample=temperature > 0,
-                    temperature=temperature if temperature > 0 else None,
-                    pad_token_id=processor.tokenizer.pad_token_id,
-                    eos_token_id=processor.tokenizer.eos_token_id,
-                )
+            stream = data.get('stream', False)
+            if stream:
+                return await _stream_vlm(request, vlm_request, 'sse' if stream == 'sse' else 'ndjson')
 
-            # Decode response
-            response_text = processor.decode(outputs[0], skip_special_tokens=True)
-
-            # Try to extract just the assistant response
-            if "assistant" in response_text.lower():
-                response_text = response_text.split("assistant")[-1].strip()
+            try:
+                response_text = await _vlm_worker.run(vlm_request)
+            except VLMUnavailable:
+                return web.json_response({
+                    "status": "error",
+                    "message": "VLM model not available. Please install Qwen-VL or configure model path.",
+                    "fallback": True,
+                    "response": None
+                }, status=503)
+            except VLMQueueFull as e:
+                return web.json_response({
+                    "status": "error",
+                    "message": str(e),
+                    "queue": _vlm_worker.stats()
+                }, status=503)
+            except asyncio.TimeoutError:
+                return web.json_response({
+                    "status": "error",
+                    "message": "VLM request timed out",
+                    "request_id": vlm_request.request_id
+                }, status=504)
+            except VLMCancelled as e:
+                return web.json_response({
+                    "status": "error",
+                    "message": str(e),
+                    "request_id": vlm_request.request_id
+                }, status=499)
 
-            # Remove any leading/trailing markers
-            response_text = response_text.strip()
+            # Remove any leading markers
             if response_text.startswith(":"):
                 response_text = response_text[1:].strip()
 
-            # Try to parse as JSON
-            parsed = None
-            try:
-                # Find JSON in response
-                import re
-                json_match = re.search(r'\{[\s\S]*\}', response_text)
-                if json_match:
-                    parsed = json.loads(json_match.group())
-            except (json.JSONDecodeError, AttributeError):
-                pass
-
             return web.json_response({
                 "status": "success",
                 "response": response_text,
-                "parsed": parsed,
-                "model": model_name
+                "parsed": parse_intent_json(response_text),
+                "model": model_name,
+                "request_id": vlm_request.request_id
             })
 
         except Exception as e:
@@ -1436,6 +2882,28 @@ Consider:
                 "message": str(e)
             }, status=500)
 
+    @routes.post('/lattice/vlm/cancel')
+    async def cancel_vlm(request):
+        """
+        Cancel a queued or running /lattice/vlm request.
+
+        Request body: {"request_id": "..."}
+        """
+        try:
+            data = await request.json()
+            if not _vlm_worker.cancel(data.get('request_id', '')):
+                return web.json_response({
+                    "status": "error",
+                    "message": "Unknown or finished request"
+                }, status=404)
+            return web.json_response({"status": "success"})
+
+        except Exception as e:
+            return web.json_response({
+                "status": "error",
+                "message": str(e)
+            }, status=500)
+
     @routes.get('/lattice/vlm/status')
     async def vlm_status(request):
         """Check VLM model status and available models."""
@@ -1477,6 +2945,10 @@ Consider:
                 "transformers_available": transformers_available,
                 "model_loaded": _vlm_model is not None,
                 "current_model": _vlm_model_name,
+                "queue": _vlm_worker.stats(),
+                # Shared system-prompt KV cache: hits, prefix size, prefill timings
+                "prefix_cache": _vlm_worker.prefix_cache.stats(),
+                "vision_cache": _vlm_worker.vision_cache.stats(),
                 "available_models": available_models,
                 "huggingface_models": [
                     {"name": "Qwen2-VL-2B-Instruct", "id": "Qwen/Qwen2-VL-2B-Instruct", "vram": "~6GB"},
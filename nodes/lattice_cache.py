@@ -0,0 +1,104 @@
+"""
+Lattice Cache
+
+Thread-safe LRU cache shared by the backend engines (SAM embeddings, mask
+and superpixel indexes, octrees, depth results, VLM vision inputs).
+
+A cache is bounded by an entry count, a byte budget, or both. Byte sizes
+come from nbytes(), which understands numpy arrays, torch tensors, PIL
+images and dicts/lists/tuples of them; subclasses override size_of() when
+their entries need a different estimate.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+def nbytes(value: Any) -> int:
+    """Approximate memory held by a (possibly nested) array/tensor/image value."""
+    if hasattr(value, 'element_size') and hasattr(value, 'nelement'):
+        return value.element_size() * value.nelement()
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if hasattr(value, 'getbands') and hasattr(value, 'size'):
+        # PIL image: decoded pixel buffer
+        return value.size[0] * value.size[1] * len(value.getbands())
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+
+class LRUCache:
+    """
+    Least-recently-used cache with an optional entry limit and byte budget.
+
+    Entries larger than the whole byte budget are not stored. get() and
+    put() are safe to call from the executor threads and the event loop.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+        """
+        Args:
+            max_entries: Keep at most this many entries (None: unbounded)
+            max_bytes: Keep at most this many bytes, per size_of() (None: unbounded)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def size_of(self, value: Any) -> int:
+        """Bytes charged against max_bytes for one entry."""
+        return nbytes(value) if self.max_bytes is not None else 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.size_of(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            while self._entries and (
+                (self.max_bytes is not None and self._bytes > self.max_bytes) or
+                (self.max_entries is not None and len(self._entries) > self.max_entries)
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,1000 @@
+"""
+Lattice Depth Engine
+
+Model-side helpers for the /lattice/depth and /lattice/normal routes in
+compositor_node.py.
+
+Inference runs on in-memory images (no shared temp files) inside a
+dedicated single-worker executor. Each request therefore sees only its
+own input, the model is never entered from two threads at once, and the
+aiohttp event loop stays free while the GPU works.
+
+Sequences are inferred in batches, and TemporalDepthNormalizer keeps the
+8-bit depth range stable across frames (global, sliding-window or per-frame
+range with optional EMA smoothing) so clips don't flicker.
+
+Depth leaves the server as an 8-bit preview, a 16-bit PNG or raw
+float16/float32, and decode_depth() reads any of them back so normal and
+point cloud passes keep full precision.
+
+Large plates can be inferred tile by tile (infer_depth_tiled), so peak
+memory follows the tile size instead of the image size. Fast mode goes the
+other way: run the network at a reduced processing resolution and restore
+edges with a guided filter.
+
+depth_to_normals() turns float depth plus intrinsics into camera-space
+normals for single frames or whole frame stacks in batched torch ops.
+
+normalcrafter_video() runs NormalCrafter over clips in overlapping,
+cross-faded windows for temporally consistent learned normals.
+
+DepthResultCache keeps float depth per image content hash, model and mode,
+so the depth, normal, point cloud and fused geometry routes share one
+inference.
+"""
+
+import asyncio
+import inspect
+import logging
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from typing import Optional, Dict, Any, Callable, Iterator, List, Tuple
+
+try:
+    from .lattice_cache import LRUCache
+except ImportError:
+    # Imported as a top-level module (tests, scripts/)
+    from lattice_cache import LRUCache
+
+logger = logging.getLogger("lattice.depth")
+
+# One worker: depth models are not thread-safe and share one device
+_depth_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lattice-depth")
+
+
+def get_depth_executor() -> ThreadPoolExecutor:
+    """Executor that owns all depth model loading and inference."""
+    return _depth_executor
+
+
+async def run_in_depth_executor(fn: Callable, *args) -> Any:
+    """Run fn(*args) on the depth executor without blocking the event loop."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_depth_executor, fn, *args)
+
+
+def _inference_from_files(model: Any, images: List[np.ndarray], **options) -> Dict[str, Any]:
+    """Fallback for wrappers whose inference() only takes paths: private temp files."""
+    from PIL import Image
+
+    paths = []
+    try:
+        for image in images:
+            fd, path = tempfile.mkstemp(prefix="lattice_depth_", suffix=".png")
+            os.close(fd)
+            Image.fromarray(image).save(path)
+            paths.append(path)
+        return model.inference(paths, **options)
+    finally:
+        for path in paths:
+            os.unlink(path)
+
+
+def _inference_takes_arrays(model: Any) -> bool:
+    """
+    Whether model.inference() accepts in-memory images.
+
+    Wrappers can say so with an inference_accepts_arrays attribute.
+    Otherwise the annotation of inference()'s first parameter decides: only
+    an annotation that names str/paths without arrays or images marks a
+    path-only wrapper. Unannotated wrappers are assumed to take arrays,
+    like DA3's own API. The answer is stored on the model.
+    """
+    accepts = getattr(model, 'inference_accepts_arrays', None)
+    if accepts is not None:
+        return bool(accepts)
+
+    accepts = True
+    try:
+        params = list(inspect.signature(model.inference).parameters.values())
+    except (TypeError, ValueError):
+        params = []
+    if params and params[0].annotation is not inspect.Parameter.empty:
+        annotation = params[0].annotation
+        text = annotation if isinstance(annotation, str) else repr(annotation)
+        accepts = any(name in text for name in ('ndarray', 'array', 'Image', 'Tensor', 'Any'))
+
+    if not accepts:
+        print(f"[Lattice] {type(model).__name__}.inference() takes file paths only, using private temp files")
+    try:
+        model.inference_accepts_arrays = accepts
+    except AttributeError:
+        pass
+    return accepts
+
+
+def infer_depth(model: Any, images: List[Any], **options) -> Dict[str, Any]:
+    """
+    Run DepthAnything V3 on in-memory images.
+
+    Wrappers whose inference() only takes paths (see
+    _inference_takes_arrays) get private temp files instead. Errors from
+    inference() itself propagate.
+
+    Args:
+        model: Loaded DepthAnything V3 model
+        images: RGB images as [H, W, 3] uint8 arrays or PIL images
+        **options: Passed through to model.inference() (e.g. process_res)
+
+    Returns:
+        The model's result dict ('depth': [N, H, W] float32, optional 'conf'
+        and 'intrinsics')
+    """
+    import torch
+
+    arrays = [np.asarray(image.convert('RGB')) if hasattr(image, 'convert') else image for image in images]
+
+    with torch.inference_mode():
+        if not _inference_takes_arrays(model):
+            return _inference_from_files(model, arrays, **options)
+        return model.inference(arrays, **options)
+
+
+# =============================================================================
+# Sequence inference and temporal normalization
+# =============================================================================
+
+DEPTH_NORMALIZE_MODES = ("frame", "window", "global")
+DEFAULT_DEPTH_BATCH = 8
+DEFAULT_NORMALIZE_WINDOW = 16
+
+
+def infer_depth_batches(
+    model: Any,
+    frames: List[Any],
+    batch_size: int = DEFAULT_DEPTH_BATCH,
+    decode: Optional[Callable[[Any], np.ndarray]] = None
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Run depth over a frame sequence in batches.
+
+    Frames are decoded lazily per batch so only one batch of RGB input is
+    resident at a time.
+
+    Args:
+        model: Loaded DepthAnything V3 model
+        frames: Frame sources (arrays, or anything decode() accepts)
+        batch_size: Frames per inference call
+        decode: Optional callable turning a frame source into an RGB array
+
+    Yields:
+        (start_index, depth [B, H, W] float32) per batch
+    """
+    batch_size = max(1, int(batch_size))
+    for start in range(0, len(frames), batch_size):
+        batch = frames[start:start + batch_size]
+        if decode is not None:
+            batch = [decode(frame) for frame in batch]
+        result = infer_depth(model, batch)
+        yield start, np.asarray(result['depth'], dtype=np.float32)
+
+
+class TemporalDepthNormalizer:
+    """
+    Maps float depth to 8-bit with a range that is stable across frames.
+
+    Modes:
+        frame: each frame's own min/max (flickers on moving content)
+        window: min/max over the last `window` frames' ranges
+        global: one fixed range for the clip (depth_range must be set)
+
+    With ema > 0 the range is additionally smoothed as
+    range_t = ema * range_{t-1} + (1 - ema) * range_t.
+    """
+
+    def __init__(
+        self,
+        mode: str = "window",
+        window: int = DEFAULT_NORMALIZE_WINDOW,
+        ema: float = 0.0,
+        depth_range: Optional[Tuple[float, float]] = None
+    ):
+        if mode not in DEPTH_NORMALIZE_MODES:
+            raise ValueError(f"Unknown normalize mode: {mode}")
+        if mode == "global" and depth_range is None:
+            raise ValueError("global normalization needs depth_range")
+        if not 0.0 <= ema < 1.0:
+            raise ValueError("ema must be in [0, 1)")
+
+        self.mode = mode
+        self.ema = float(ema)
+        self.depth_range = depth_range
+        self._recent = deque(maxlen=max(1, int(window)))
+        self._smoothed: Optional[Tuple[float, float]] = None
+
+    def update(self, depth: np.ndarray) -> Tuple[float, float]:
+        """Record one frame and return the (min, max) range to normalize it with."""
+        if self.mode == "global":
+            low, high = self.depth_range
+        else:
+            low, high = float(depth.min()), float(depth.max())
+            if self.mode == "window":
+                self._recent.append((low, high))
+                low = min(r[0] for r in self._recent)
+                high = max(r[1] for r in self._recent)
+
+        if self.ema > 0 and self._smoothed is not None:
+            low = self.ema * self._smoothed[0] + (1 - self.ema) * low
+            high = self.ema * self._smoothed[1] + (1 - self.ema) * high
+        self._smoothed = (low, high)
+        return low, high
+
+    def normalize(self, depth: np.ndarray) -> Tuple[np.ndarray, float, float]:
+        """Returns (uint8 depth, range min, range max) for the next frame."""
+        low, high = self.update(depth)
+        scaled = (depth - low) / (high - low + 1e-6)
+        return (np.clip(scaled, 0.0, 1.0) * 255).astype(np.uint8), low, high
+
+
+# =============================================================================
+# Depth encodings
+# =============================================================================
+
+# png: 8-bit preview, png16: 16-bit PNG, f16/f32: raw little-endian floats
+DEPTH_FORMATS = ("png", "png16", "f16", "f32")
+RAW_DEPTH_DTYPES = {"f16": np.dtype("<f2"), "f32": np.dtype("<f4")}
+# Units assumed for PNG depth with no known range (near plane at half the far)
+RELATIVE_DEPTH_RANGE = (1.0, 2.0)
+
+
+def quantize_depth(
+    depth: np.ndarray,
+    bits: int = 8,
+    depth_range: Optional[Tuple[float, float]] = None
+) -> Tuple[np.ndarray, float, float]:
+    """
+    Map float depth onto the full 8- or 16-bit integer range.
+
+    Returns:
+        (uint8 or uint16 array, range min, range max)
+    """
+    if depth_range is None:
+        low, high = float(depth.min()), float(depth.max())
+    else:
+        low, high = float(depth_range[0]), float(depth_range[1])
+    dtype = np.uint16 if bits == 16 else np.uint8
+    scale = np.iinfo(dtype).max
+    scaled = np.clip((depth - low) / (high - low + 1e-6), 0.0, 1.0)
+    return (scaled * scale + 0.5).astype(dtype), low, high
+
+
+def encode_depth(depth: np.ndarray, fmt: str = "png") -> Tuple[Any, Dict[str, Any]]:
+    """
+    Encode float depth for transport.
+
+    Args:
+        depth: [H, W] float depth
+        fmt: One of DEPTH_FORMATS
+
+    Returns:
+        (payload, info). PNG formats give a base64 string and the range the
+        integers map back to (depth = min + v / max_int * (max - min)); raw
+        formats give bytes plus dtype/shape.
+    """
+    import base64
+    import io
+    from PIL import Image
+
+    if fmt in RAW_DEPTH_DTYPES:
+        dtype = RAW_DEPTH_DTYPES[fmt]
+        return np.ascontiguousarray(depth, dtype=dtype).tobytes(), {
+            "dtype": "float16" if fmt == "f16" else "float32",
+            "byte_order": "little",
+            "width": int(depth.shape[1]),
+            "height": int(depth.shape[0]),
+            "depth_min": float(depth.min()),
+            "depth_max": float(depth.max())
+        }
+
+    if fmt not in ("png", "png16"):
+        raise ValueError(f"Unknown depth format: {fmt}")
+
+    quantized, low, high = quantize_depth(depth, bits=16 if fmt == "png16" else 8)
+    # Pillow infers I;16 from uint16 and L from uint8 arrays
+    quantized = quantized.astype(np.uint16 if fmt == "png16" else np.uint8, copy=False)
+    buffer = io.BytesIO()
+    Image.fromarray(quantized).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8"), {
+        "bit_depth": 16 if fmt == "png16" else 8,
+        "depth_min": low,
+        "depth_max": high
+    }
+
+
+def decode_depth(
+    depth_b64: str,
+    fmt: str = "png",
+    shape: Optional[Tuple[int, int]] = None,
+    depth_range: Optional[Tuple[float, float]] = None
+) -> np.ndarray:
+    """
+    Decode a transported depth map to float32.
+
+    PNGs (8- or 16-bit, detected from the file) decode to 0..1, or to
+    depth_range when given. Raw f16/f32 buffers keep their values and need
+    shape (height, width).
+
+    Raises:
+        ValueError: unknown format, or raw buffer that doesn't match shape
+    """
+    import base64
+    import io
+    from PIL import Image
+
+    raw = base64.b64decode(depth_b64)
+
+    if fmt in RAW_DEPTH_DTYPES:
+        if shape is None:
+            raise ValueError(f"{fmt} depth needs width and height")
+        dtype = RAW_DEPTH_DTYPES[fmt]
+        height, width = int(shape[0]), int(shape[1])
+        if len(raw) != height * width * dtype.itemsize:
+            raise ValueError(f"{fmt} depth buffer is {len(raw)} bytes, expected {height}x{width}")
+        return np.frombuffer(raw, dtype=dtype).reshape(height, width).astype(np.float32)
+
+    if fmt not in ("png", "png16"):
+        raise ValueError(f"Unknown depth format: {fmt}")
+
+    pil_image = Image.open(io.BytesIO(raw))
+    if pil_image.mode in ("I;16", "I;16B", "I;16L", "I"):
+        depth = np.array(pil_image).astype(np.float32) / 65535.0
+    else:
+        depth = np.array(pil_image.convert("L")).astype(np.float32) / 255.0
+
+    if depth_range is not None:
+        low, high = float(depth_range[0]), float(depth_range[1])
+        depth = low + depth * (high - low)
+    return depth
+
+
+# =============================================================================
+# Tiled high-resolution inference
+# =============================================================================
+
+DEFAULT_TILE_SIZE = 1024
+DEFAULT_TILE_OVERLAP = 128
+# Pixels sampled per tile when fitting its scale/shift
+ALIGN_SAMPLES = 65536
+
+
+def resize_depth(depth: np.ndarray, height: int, width: int) -> np.ndarray:
+    """Bilinear resize of a float depth map (no-op if already that size)."""
+    if depth.shape == (height, width):
+        return depth.astype(np.float32, copy=False)
+    from PIL import Image
+    resized = Image.fromarray(depth.astype(np.float32), mode='F').resize((width, height), Image.BILINEAR)
+    return np.array(resized, dtype=np.float32)
+
+
+def rescale_intrinsics(intrinsics: Any, scale_x: float, scale_y: float) -> np.ndarray:
+    """3x3 camera matrix for an image resized by (scale_x, scale_y)."""
+    intrinsics = np.array(intrinsics, dtype=np.float64)
+    intrinsics[0, :] *= scale_x
+    intrinsics[1, :] *= scale_y
+    intrinsics[2, :] = [0.0, 0.0, 1.0]
+    return intrinsics
+
+
+def tile_starts(length: int, tile: int, overlap: int) -> List[int]:
+    """Tile origins covering [0, length) with at least `overlap` shared pixels."""
+    if length <= tile:
+        return [0]
+    stride = max(1, tile - overlap)
+    count = int(np.ceil((length - tile) / stride)) + 1
+    # Spread tiles evenly so the last one ends exactly at the border
+    return [int(round(i * (length - tile) / (count - 1))) for i in range(count)]
+
+
+def _feather_ramp(length: int, overlap: int, ramp_start: bool, ramp_end: bool) -> np.ndarray:
+    """1D blend weights: linear ramps over the overlap on interior sides."""
+    weights = np.ones(length, dtype=np.float32)
+    ramp_len = min(overlap, length // 2)
+    if ramp_len > 0:
+        ramp = (np.arange(ramp_len, dtype=np.float32) + 1) / (ramp_len + 1)
+        if ramp_start:
+            weights[:ramp_len] = ramp
+        if ramp_end:
+            weights[-ramp_len:] = np.minimum(weights[-ramp_len:], ramp[::-1])
+    return weights
+
+
+def fit_scale_shift(source: np.ndarray, target: np.ndarray) -> Tuple[float, float]:
+    """
+    Least-squares scale/shift so that scale * source + shift ~= target.
+
+    Falls back to a median ratio when the fit is degenerate (flat tiles or a
+    non-positive scale).
+    """
+    source = source.ravel().astype(np.float64)
+    target = target.ravel().astype(np.float64)
+    if source.size > ALIGN_SAMPLES:
+        step = source.size // ALIGN_SAMPLES
+        source, target = source[::step], target[::step]
+
+    design = np.stack([source, np.ones_like(source)], axis=1)
+    (scale, shift), *_ = np.linalg.lstsq(design, target, rcond=None)
+    if not np.isfinite(scale) or scale <= 1e-6:
+        scale = float(np.median(target) / (np.median(source) + 1e-6))
+        shift = 0.0
+    return float(scale), float(shift)
+
+
+def infer_depth_at_size(model: Any, image_np: np.ndarray, size: int) -> Dict[str, Any]:
+    """
+    Infer one image with the network's processing resolution set to size.
+
+    DA3 resizes every input to its process_res (504 by default), so tiles
+    and reduced-resolution passes must pass their own size or they are
+    resampled to the default. Wrappers whose inference() takes no
+    process_res get a copy downscaled to size instead.
+
+    Returns:
+        infer_depth()'s result, with depth at the processing resolution
+    """
+    from PIL import Image
+
+    try:
+        return infer_depth(model, [image_np], process_res=int(size))
+    except TypeError:
+        height, width = image_np.shape[:2]
+        factor = min(1.0, size / max(height, width))
+        if factor < 1.0:
+            low_w, low_h = max(1, round(width * factor)), max(1, round(height * factor))
+            image_np = np.asarray(Image.fromarray(image_np).resize((low_w, low_h), Image.BILINEAR))
+        return infer_depth(model, [image_np])
+
+
+def infer_depth_tiled(
+    model: Any,
+    image_np: np.ndarray,
+    tile_size: int = DEFAULT_TILE_SIZE,
+    overlap: int = DEFAULT_TILE_OVERLAP
+) -> Dict[str, Any]:
+    """
+    Full-resolution depth for large images with memory bounded by tile_size.
+
+    A global pass on the image downscaled to tile_size gives the overall
+    depth layout. Each overlapping tile is then inferred at native
+    resolution, aligned to the upsampled global depth with a per-tile
+    scale/shift fit, and feather-blended into the output.
+
+    Args:
+        model: Loaded DepthAnything V3 model
+        image_np: [H, W, 3] uint8 RGB image
+        tile_size: Tile edge in pixels (also the global pass's long side)
+        overlap: Pixels shared by neighbouring tiles
+
+    Returns:
+        Result dict shaped like infer_depth()'s: 'depth' [1, H, W], plus
+        'intrinsics' rescaled from the global pass when the model gives them,
+        and 'tiles' (number of tiles run)
+    """
+    height, width = image_np.shape[:2]
+    tile_size = max(64, int(tile_size))
+    overlap = max(0, min(int(overlap), tile_size // 2))
+
+    # Global low-res pass sets the scale every tile is aligned to
+    factor = min(1.0, tile_size / max(height, width))
+    global_result = infer_depth_at_size(model, image_np, tile_size)
+    global_depth = np.asarray(global_result['depth'][0], dtype=np.float32)
+    low_h, low_w = global_depth.shape
+    reference = resize_depth(global_depth, height, width)
+
+    result: Dict[str, Any] = {"tiles": 0}
+    if 'intrinsics' in global_result:
+        result['intrinsics'] = rescale_intrinsics(global_result['intrinsics'][0], width / low_w, height / low_h)[None]
+
+    if factor >= 1.0:
+        # Image fits in one tile: the global pass is already full resolution
+        result['depth'] = reference[None]
+        result['tiles'] = 1
+        return result
+
+    depth_sum = np.zeros((height, width), dtype=np.float32)
+    weight_sum = np.zeros((height, width), dtype=np.float32)
+    ys = tile_starts(height, tile_size, overlap)
+    xs = tile_starts(width, tile_size, overlap)
+
+    for y in ys:
+        for x in xs:
+            y1, x1 = min(y + tile_size, height), min(x + tile_size, width)
+            tile_result = infer_depth_at_size(model, np.ascontiguousarray(image_np[y:y1, x:x1]), tile_size)
+            tile_depth = resize_depth(np.asarray(tile_result['depth'][0]), y1 - y, x1 - x)
+
+            scale, shift = fit_scale_shift(tile_depth, reference[y:y1, x:x1])
+            weights = np.outer(
+                _feather_ramp(y1 - y, overlap, y > 0, y1 < height),
+                _feather_ramp(x1 - x, overlap, x > 0, x1 < width)
+            )
+            depth_sum[y:y1, x:x1] += (tile_depth * scale + shift) * weights
+            weight_sum[y:y1, x:x1] += weights
+            result['tiles'] += 1
+
+    result['depth'] = (depth_sum / np.maximum(weight_sum, 1e-6))[None]
+    return result
+
+
+# =============================================================================
+# Fast mode: low-res inference with guided upsampling
+# =============================================================================
+
+# DA3 processing resolution (long side) for fast mode; full mode uses the
+# model's default of 504. Multiple of the ViT patch size (14).
+DEFAULT_FAST_SIZE = 280
+DEFAULT_GUIDED_RADIUS = 8
+DEFAULT_GUIDED_EPS = 1e-4
+
+
+def box_mean(x: np.ndarray, radius: int) -> np.ndarray:
+    """Mean over a (2r+1)^2 window via summed-area tables, clipped at borders."""
+    height, width = x.shape
+    table = np.zeros((height + 1, width + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(x, axis=0, dtype=np.float64), axis=1, out=table[1:, 1:])
+
+    y0 = np.clip(np.arange(height) - radius, 0, height)
+    y1 = np.clip(np.arange(height) + radius + 1, 0, height)
+    x0 = np.clip(np.arange(width) - radius, 0, width)
+    x1 = np.clip(np.arange(width) + radius + 1, 0, width)
+
+    sums = (table[y1][:, x1] - table[y0][:, x1] - table[y1][:, x0] + table[y0][:, x0])
+    counts = np.outer(y1 - y0, x1 - x0)
+    return (sums / counts).astype(np.float32)
+
+
+def _guide_luminance(image_np: np.ndarray) -> np.ndarray:
+    """RGB uint8 -> float32 luminance in 0..1."""
+    return (image_np[..., :3].astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)) / 255.0
+
+
+def guided_upsample(
+    depth_low: np.ndarray,
+    image_np: np.ndarray,
+    radius: int = DEFAULT_GUIDED_RADIUS,
+    eps: float = DEFAULT_GUIDED_EPS
+) -> np.ndarray:
+    """
+    Edge-aware upsampling of low-res depth guided by the full-res RGB image.
+
+    Fast guided filter (He & Sun 2015): the local linear model
+    depth = a * I + b is fitted at low resolution, a and b are upsampled
+    bilinearly, and applied to the full-resolution luminance I so depth
+    edges snap to image edges.
+
+    Args:
+        depth_low: [h, w] float depth
+        image_np: [H, W, 3] uint8 RGB guide
+        radius: Window radius in full-resolution pixels
+        eps: Regularization; larger values smooth more across weak edges
+
+    Returns:
+        [H, W] float32 depth
+    """
+    height, width = image_np.shape[:2]
+    low_h, low_w = depth_low.shape
+    guide = _guide_luminance(image_np)
+    guide_low = resize_depth(guide, low_h, low_w)
+    depth_low = depth_low.astype(np.float32)
+
+    # Fit in normalized depth units so eps is scale-independent
+    low, high = float(depth_low.min()), float(depth_low.max())
+    span = max(high - low, 1e-6)
+    target = (depth_low - low) / span
+
+    r = max(1, int(round(radius * low_w / width)))
+    mean_i = box_mean(guide_low, r)
+    mean_p = box_mean(target, r)
+    cov_ip = box_mean(guide_low * target, r) - mean_i * mean_p
+    var_i = box_mean(guide_low * guide_low, r) - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    a = box_mean(a, r)
+    b = box_mean(b, r)
+
+    result = resize_depth(a, height, width) * guide + resize_depth(b, height, width)
+    return result * span + low
+
+
+def infer_depth_fast(
+    model: Any,
+    image_np: np.ndarray,
+    max_size: int = DEFAULT_FAST_SIZE,
+    radius: int = DEFAULT_GUIDED_RADIUS,
+    eps: float = DEFAULT_GUIDED_EPS
+) -> Dict[str, Any]:
+    """
+    Preview-quality depth: run the network at a reduced processing
+    resolution, then restore full resolution with guided_upsample().
+
+    DA3 resizes every input to its process_res (504 by default) internally,
+    so the saving has to come from a smaller process_res, not from
+    downscaling the image first. Wrappers whose inference() takes no
+    process_res get a copy downscaled to max_size instead.
+
+    Args:
+        max_size: Processing resolution (long side) for the network
+
+    Returns:
+        Result dict shaped like infer_depth()'s ('depth' [1, H, W], plus
+        rescaled 'intrinsics' when the model gives them)
+    """
+    height, width = image_np.shape[:2]
+    low_result = infer_depth_at_size(model, image_np, max_size)
+
+    # Depth comes back at the processing resolution
+    depth_low = np.asarray(low_result['depth'][0], dtype=np.float32)
+    low_h, low_w = depth_low.shape
+    result: Dict[str, Any] = {'depth': guided_upsample(depth_low, image_np, radius, eps)[None]}
+    if 'intrinsics' in low_result:
+        result['intrinsics'] = rescale_intrinsics(low_result['intrinsics'][0], width / low_w, height / low_h)[None]
+    return result
+
+
+# =============================================================================
+# Depth to normals
+# =============================================================================
+
+# Finite-difference step sizes (pixels) fused into one normal map
+DEFAULT_NORMAL_SCALES = (1, 2, 4)
+DEFAULT_NORMAL_BATCH = 4
+# Relative depth jump across a stencil at which a scale's weight halves
+NORMAL_EDGE_TOLERANCE = 0.05
+
+
+def _intrinsics_stack(intrinsics: Any, frames: int, width: int, height: int) -> np.ndarray:
+    """[N, 3, 3] float32 camera matrices from one matrix, one per frame, or None."""
+    if intrinsics is None:
+        # Same default as lattice_pointcloud.estimate_intrinsics
+        focal = float(max(width, height))
+        intrinsics = [[focal, 0.0, width / 2], [0.0, focal, height / 2], [0.0, 0.0, 1.0]]
+    matrices = np.asarray(intrinsics, dtype=np.float32)
+    if matrices.shape == (3, 3):
+        matrices = np.repeat(matrices[None], frames, axis=0)
+    if matrices.shape != (frames, 3, 3):
+        raise ValueError(f"intrinsics must be 3x3 or {frames}x3x3")
+    return np.ascontiguousarray(matrices)
+
+
+def _one_sided_gradient(z: "torch.Tensor", scale: int, axis: int) -> "torch.Tensor":
+    """
+    Depth derivative along one image axis (2 = u, 1 = v) from samples
+    `scale` pixels apart, taking per pixel whichever of the forward/backward
+    difference changes less so stencils don't reach across depth edges.
+    """
+    import torch
+    import torch.nn.functional as F
+
+    padding = (scale, scale, 0, 0) if axis == 2 else (0, 0, scale, scale)
+    padded = F.pad(z.unsqueeze(1), padding, mode='replicate').squeeze(1)
+    length = z.shape[axis]
+
+    forward = padded.narrow(axis, 2 * scale, length) - z
+    backward = z - padded.narrow(axis, 0, length)
+    # Replicate padding zeroes the outward difference at borders
+    use_forward = (forward.abs() <= backward.abs()) & (forward != 0)
+    use_forward |= backward == 0
+    return torch.where(use_forward, forward, backward) / scale
+
+
+def depth_to_normals(
+    depth: np.ndarray,
+    intrinsics: Any = None,
+    scales: Tuple[int, ...] = DEFAULT_NORMAL_SCALES,
+    device: Optional[str] = None,
+    batch_size: int = DEFAULT_NORMAL_BATCH
+) -> np.ndarray:
+    """
+    Surface normals from float depth via camera-space positions.
+
+    For P(u, v) = z * ((u - cx) / fx, (v - cy) / fy, 1) the normal
+    dP/du x dP/dv reduces to
+
+        (-fx * z_u, -fy * z_v, (u - cx) * z_u + (v - cy) * z_v + z)
+
+    so only depth derivatives are needed, and results don't depend on the
+    depth's units or the image size. Derivatives are one-sided (the side
+    without a depth edge) at several pixel scales; the per-scale normals are
+    fused, weighting fine scales higher and discounting scales whose stencil
+    still crosses a discontinuity.
+
+    Runs batched in torch on the GPU when available, otherwise on CPU threads.
+
+    Args:
+        depth: [H, W] or [N, H, W] float depth (larger = farther)
+        intrinsics: 3x3 or [N, 3, 3] camera matrix; estimated if None
+        scales: Finite-difference steps in pixels to fuse
+        device: Torch device; defaults to cuda when available
+        batch_size: Frames per batch
+
+    Returns:
+        [H, W, 3] or [N, H, W, 3] float32 unit normals in the depth map's
+        convention (+X right, +Y down, surfaces facing the camera have +Z)
+    """
+    import torch
+
+    depth = np.asarray(depth, dtype=np.float32)
+    single = depth.ndim == 2
+    if single:
+        depth = depth[None]
+    frames, height, width = depth.shape
+    matrices = _intrinsics_stack(intrinsics, frames, width, height)
+    scales = tuple(max(1, int(s)) for s in scales) or (1,)
+    batch_size = max(1, int(batch_size))
+
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    normals_out = np.empty((frames, height, width, 3), dtype=np.float32)
+
+    with torch.inference_mode():
+        u = torch.arange(width, dtype=torch.float32, device=device).view(1, 1, width)
+        v = torch.arange(height, dtype=torch.float32, device=device).view(1, height, 1)
+
+        for start in range(0, frames, batch_size):
+            z = torch.from_numpy(depth[start:start + batch_size]).to(device)
+            k = torch.from_numpy(matrices[start:start + batch_size]).to(device)
+            fx, fy = k[:, 0, 0].view(-1, 1, 1), k[:, 1, 1].view(-1, 1, 1)
+            u_c = u - k[:, 0, 2].view(-1, 1, 1)
+            v_c = v - k[:, 1, 2].view(-1, 1, 1)
+            inv_z = 1.0 / z.clamp_min(1e-6)
+
+            fused = torch.zeros((3, *z.shape), dtype=torch.float32, device=device)
+            for scale in scales:
+                z_u = _one_sided_gradient(z, scale, axis=2)
+                z_v = _one_sided_gradient(z, scale, axis=1)
+
+                nx = -fx * z_u
+                ny = -fy * z_v
+                nz = u_c * z_u + v_c * z_v + z
+
+                # Unit length, times this scale's weight: down-weight
+                # stencils that still span a large relative depth change
+                jump = (z_u.abs() + z_v.abs()) * inv_z / NORMAL_EDGE_TOLERANCE
+                weight = (1.0 / scale) / (1.0 + jump * jump)
+                weight *= torch.rsqrt(nx * nx + ny * ny + nz * nz + 1e-20)
+
+                fused[0] += nx * weight
+                fused[1] += ny * weight
+                fused[2] += nz * weight
+
+            # Flat/degenerate pixels fall back to facing the camera
+            fused[2] += 1e-12
+            fused *= torch.rsqrt((fused * fused).sum(0))
+            normals_out[start:start + batch_size] = fused.permute(1, 2, 3, 0).cpu().numpy()
+
+    return normals_out[0] if single else normals_out
+
+
+def encode_normals(normals: np.ndarray) -> np.ndarray:
+    """Unit normals in [-1, 1] -> uint8 RGB (n + 1) / 2 * 255."""
+    return ((np.clip(normals, -1.0, 1.0) + 1.0) * 127.5 + 0.5).astype(np.uint8)
+
+
+# =============================================================================
+# Depth result cache
+# =============================================================================
+
+DEPTH_CACHE_BYTES = 512 * 1024 * 1024
+
+
+def depth_cache_key(image_key: str, model_name: str, mode: str = "full") -> str:
+    """Cache key for one image under one model and inference mode."""
+    return f"{image_key}:{model_name}:{mode}"
+
+
+class DepthResultCache(LRUCache):
+    """
+    LRU cache of float depth results with a byte budget, keyed by
+    depth_cache_key() so any route that decodes the same image with the
+    same model and mode can skip inference.
+
+    Entries are dicts: 'depth' [H, W] float32, plus 'intrinsics' (3x3),
+    'conf' [H, W] and 'tiles' when the inference produced them.
+    """
+
+    def __init__(self, max_bytes: int = DEPTH_CACHE_BYTES):
+        super().__init__(max_bytes=max_bytes)
+
+
+_depth_cache = DepthResultCache()
+
+
+def get_depth_cache() -> DepthResultCache:
+    """Process-wide depth result cache."""
+    return _depth_cache
+
+
+def single_result(result: Dict[str, Any], size: Optional[Tuple[int, int]] = None) -> Dict[str, np.ndarray]:
+    """
+    First frame of a model result as a cacheable dict of arrays.
+
+    With size (height, width), depth and confidence are resized to it and
+    the intrinsics rescaled to match, so the entry lines up with the input
+    image rather than the model's processing resolution.
+    """
+    depth = np.asarray(result['depth'][0], dtype=np.float32)
+    low_h, low_w = depth.shape
+    height, width = size if size is not None else (low_h, low_w)
+
+    entry = {'depth': resize_depth(depth, height, width)}
+    if result.get('intrinsics') is not None:
+        entry['intrinsics'] = rescale_intrinsics(result['intrinsics'][0], width / low_w, height / low_h)
+    if result.get('conf') is not None:
+        entry['conf'] = resize_depth(np.asarray(result['conf'][0], dtype=np.float32), height, width)
+    if 'tiles' in result:
+        entry['tiles'] = result['tiles']
+    return entry
+
+
+# =============================================================================
+# NormalCrafter video normals
+# =============================================================================
+
+NORMALCRAFTER_WEIGHTS = "Yanrui95/NormalCrafter"
+NORMALCRAFTER_BASE = "stabilityai/stable-video-diffusion-img2vid-xt"
+DEFAULT_NORMAL_WINDOW = 14
+DEFAULT_NORMAL_OVERLAP = 4
+DEFAULT_NORMAL_MAX_RES = 1024
+DEFAULT_DECODE_CHUNK = 7
+
+
+def load_normalcrafter(
+    wrapper_path: Optional[str] = None,
+    weights: str = NORMALCRAFTER_WEIGHTS,
+    base: str = NORMALCRAFTER_BASE,
+    device: Optional[str] = None
+) -> Any:
+    """
+    Build the NormalCrafter pipeline (SVD with the NormalCrafter UNet).
+
+    Args:
+        wrapper_path: ComfyUI-NormalCrafterWrapper checkout providing the
+            `normalcrafter` package; searched on sys.path if None
+        weights: NormalCrafter UNet repo id or local directory
+        base: Stable Video Diffusion repo id or local directory
+        device: Torch device; defaults to cuda when available
+
+    Raises:
+        ImportError: normalcrafter/diffusers are not importable
+    """
+    import sys
+    import torch
+
+    if wrapper_path and wrapper_path not in sys.path:
+        sys.path.insert(0, wrapper_path)
+
+    from normalcrafter.normal_crafter_ppl import NormalCrafterPipeline
+    from normalcrafter.unet import DiffusersUNetSpatioTemporalConditionModelNormalCrafter
+
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.float16 if device.startswith("cuda") else torch.float32
+
+    unet = DiffusersUNetSpatioTemporalConditionModelNormalCrafter.from_pretrained(
+        weights, subfolder="unet", low_cpu_mem_usage=True)
+    pipe = NormalCrafterPipeline.from_pretrained(
+        base, unet=unet, torch_dtype=dtype,
+        variant="fp16" if dtype == torch.float16 else None)
+    return pipe.to(device)
+
+
+def _normalcrafter_size(height: int, width: int, max_res: int) -> Tuple[int, int]:
+    """Inference size: long side capped at max_res, both sides multiples of 64."""
+    factor = min(1.0, max_res / max(height, width))
+    return (max(64, int(round(height * factor / 64)) * 64),
+            max(64, int(round(width * factor / 64)) * 64))
+
+
+def _normalcrafter_window(
+    pipe: Any,
+    frames: List[np.ndarray],
+    size: Tuple[int, int],
+    decode_chunk_size: int
+) -> np.ndarray:
+    """Normals for one window of frames at their own resolution, [T, H, W, 3] in [-1, 1]."""
+    import torch
+    from PIL import Image
+
+    height, width = frames[0].shape[:2]
+    inputs = np.stack([
+        np.asarray(Image.fromarray(frame).resize((size[1], size[0]), Image.BICUBIC))
+        for frame in frames
+    ]).astype(np.float32) / 255.0
+
+    with torch.inference_mode():
+        output = pipe(
+            inputs,
+            decode_chunk_size=decode_chunk_size,
+            time_step_size=len(frames),
+            window_size=len(frames)
+        ).frames[0]
+
+    output = np.clip(np.asarray(output, dtype=np.float32), -1.0, 1.0)
+    if output.shape[1:3] != (height, width):
+        output = np.stack([
+            np.stack([resize_depth(normal[..., c], height, width) for c in range(3)], axis=-1)
+            for normal in output
+        ])
+    return output
+
+
+def normalcrafter_video(
+    pipe: Any,
+    frames: List[Any],
+    window: int = DEFAULT_NORMAL_WINDOW,
+    overlap: int = DEFAULT_NORMAL_OVERLAP,
+    max_res: int = DEFAULT_NORMAL_MAX_RES,
+    decode_chunk_size: int = DEFAULT_DECODE_CHUNK,
+    decode: Optional[Callable[[Any], np.ndarray]] = None
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Temporally consistent normals for a clip with NormalCrafter.
+
+    The clip is processed in windows of `window` frames sharing `overlap`
+    frames with their neighbours. Overlapping predictions are blended with
+    linear cross-fade weights and renormalized, and frames are yielded as
+    soon as no later window touches them, so only the frames of about one
+    window are held at a time.
+
+    Args:
+        pipe: Pipeline from load_normalcrafter()
+        frames: Frame sources (arrays, or anything decode() accepts)
+        window: Frames per pipeline call
+        overlap: Frames shared by consecutive windows
+        max_res: Long side of the inference resolution
+        decode_chunk_size: Frames per VAE decode batch
+        decode: Optional callable turning a frame source into an RGB array
+
+    Yields:
+        (start_index, normals [T, H, W, 3] float32 unit vectors) per
+        finished run of frames
+    """
+    total = len(frames)
+    window = max(1, min(int(window), total))
+    overlap = max(0, min(int(overlap), window - 1))
+    starts = tile_starts(total, window, overlap)
+
+    pending_sum: Dict[int, np.ndarray] = {}
+    pending_weight: Dict[int, float] = {}
+    size = None
+    emitted = 0
+
+    for index, start in enumerate(starts):
+        stop = min(start + window, total)
+        batch = frames[start:stop]
+        if decode is not None:
+            batch = [decode(frame) for frame in batch]
+        if size is None:
+            size = _normalcrafter_size(*batch[0].shape[:2], max_res)
+
+        normals = _normalcrafter_window(pipe, batch, size, decode_chunk_size)
+        weights = _feather_ramp(stop - start, overlap, index > 0, index < len(starts) - 1)
+        for offset, (normal, weight) in enumerate(zip(normals, weights)):
+            frame_index = start + offset
+            if frame_index in pending_sum:
+                pending_sum[frame_index] += normal * weight
+                pending_weight[frame_index] += float(weight)
+            else:
+                pending_sum[frame_index] = normal * weight
+                pending_weight[frame_index] = float(weight)
+
+        # Frames before the next window's start are final
+        final_until = starts[index + 1] if index + 1 < len(starts) else total
+        if final_until > emitted:
+            done = np.stack([
+                pending_sum.pop(i) / pending_weight.pop(i)
+                for i in range(emitted, final_until)
+            ])
+            done /= np.linalg.norm(done, axis=-1, keepdims=True) + 1e-8
+            yield emitted, done.astype(np.float32)
+            emitted = final_until
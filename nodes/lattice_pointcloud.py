@@ -0,0 +1,989 @@
+"""
+Lattice Point Cloud Engine
+
+Vectorized depth back-projection shared by the /lattice/pointcloud route and
+any batch/sequence callers. Everything here is pure NumPy so it can be used
+(and benchmarked) without a running ComfyUI server.
+
+The same back-projection also feeds mesh_from_depth(), a grid-triangulated
+mesh with quadtree decimation, exported as binary PLY or glTF, and
+gaussians_from_depth(), oriented Gaussian splats exported as .splat or 3DGS
+PLY for initialization/viewing.
+
+Conventions:
+- Depth maps are [H, W] float arrays, larger values = farther away
+- Intrinsics are 3x3 pinhole matrices [[fx, 0, cx], [0, fy, cy], [0, 0, 1]]
+- Points are float32 [N, 3] camera-space XYZ, colors are uint8 [N, 3] RGB
+"""
+
+import logging
+import numpy as np
+from typing import Optional, Dict, Any, List, Tuple
+
+try:
+    from .lattice_cache import LRUCache
+except ImportError:
+    # Imported as a top-level module (tests, scripts/)
+    from lattice_cache import LRUCache
+
+logger = logging.getLogger("lattice.pointcloud")
+
+# Depth values at or below this are treated as "no data"
+MIN_VALID_DEPTH = 0.01
+
+
+def estimate_intrinsics(width: int, height: int) -> List[List[float]]:
+    """
+    Estimate reasonable pinhole intrinsics when none are supplied.
+
+    Uses a focal length equal to the longest image side (~53 degree FOV)
+    with the principal point at the image center.
+    """
+    fx = fy = float(max(width, height))
+    cx, cy = width / 2, height / 2
+    return [[fx, 0.0, cx], [0.0, fy, cy], [0.0, 0.0, 1.0]]
+
+
+def backproject_depth(
+    depth: np.ndarray,
+    image: Optional[np.ndarray] = None,
+    intrinsics: Optional[List[List[float]]] = None,
+    subsample: int = 1,
+    min_depth: float = MIN_VALID_DEPTH
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Back-project a depth map into a camera-space point cloud.
+
+    Args:
+        depth: [H, W] depth map
+        image: Optional [H, W, 3] uint8 RGB image for per-point colors
+        intrinsics: 3x3 camera matrix, estimated from the image size if None
+        subsample: Take every Nth pixel in both directions
+        min_depth: Pixels with depth <= this are dropped
+
+    Returns:
+        Tuple of (points [N, 3] float32, colors [N, 3] uint8 or None)
+    """
+    depth = np.asarray(depth, dtype=np.float32)
+    height, width = depth.shape
+    subsample = max(1, int(subsample))
+
+    if intrinsics is None:
+        intrinsics = estimate_intrinsics(width, height)
+
+    fx, fy = float(intrinsics[0][0]), float(intrinsics[1][1])
+    cx, cy = float(intrinsics[0][2]), float(intrinsics[1][2])
+
+    # Pixel coordinate grid at the requested stride
+    xs = np.arange(0, width, subsample, dtype=np.float32)
+    ys = np.arange(0, height, subsample, dtype=np.float32)
+    u, v = np.meshgrid(xs, ys)
+
+    z = depth[::subsample, ::subsample]
+    valid = z > min_depth
+
+    z_valid = z[valid]
+    points = np.empty((z_valid.shape[0], 3), dtype=np.float32)
+    points[:, 0] = (u[valid] - cx) * z_valid / fx
+    points[:, 1] = (v[valid] - cy) * z_valid / fy
+    points[:, 2] = z_valid
+
+    colors = None
+    if image is not None:
+        colors = np.ascontiguousarray(
+            image[::subsample, ::subsample, :3][valid], dtype=np.uint8
+        )
+
+    return points, colors
+
+
+def compute_bounds(points: np.ndarray) -> Dict[str, Any]:
+    """Axis-aligned bounds of a point cloud as JSON-friendly lists."""
+    if len(points) == 0:
+        return {"min": [0, 0, 0], "max": [0, 0, 0]}
+
+    return {
+        "min": points.min(axis=0).tolist(),
+        "max": points.max(axis=0).tolist()
+    }
+
+
+# ============================================================================
+# Density Control - voxel grid and octree LOD
+# ============================================================================
+
+# Default point budget for the initial (coarse) octree level
+DEFAULT_LOD_BUDGET = 200_000
+
+# Octree depth 10 = 1024 cells per axis at the finest level
+DEFAULT_OCTREE_DEPTH = 10
+MAX_OCTREE_DEPTH = 16
+
+# Number of octrees kept for follow-up "finer level" requests
+OCTREE_CACHE_SIZE = 8
+
+
+def _cell_sums(inverse: np.ndarray, num_cells: int, values: np.ndarray) -> np.ndarray:
+    """Per-cell column sums of values ([N, C]) via bincount."""
+    sums = np.empty((num_cells, values.shape[1]), dtype=np.float64)
+    for channel in range(values.shape[1]):
+        sums[:, channel] = np.bincount(inverse, weights=values[:, channel], minlength=num_cells)
+    return sums
+
+
+def _voxel_cells(points: np.ndarray, voxel_size: float) -> Tuple[np.ndarray, int]:
+    """
+    Voxel id of every point, numbered over the occupied voxels only.
+
+    Integer cell coordinates are packed into one int64 key with explicit
+    strides while the grid fits in int64; larger grids (tiny voxels over a
+    wide extent) are grouped by whole coordinate rows instead.
+
+    Returns:
+        Tuple of (inverse [N] int64 voxel ids, number of occupied voxels)
+    """
+    points = np.asarray(points, dtype=np.float64)
+    cells = np.floor((points - points.min(axis=0)) / voxel_size)
+    extent = cells.max(axis=0) + 1
+    if not np.all(np.isfinite(extent)) or extent.max() >= 2 ** 62:
+        raise ValueError("voxel_size is too small for the extent of the points")
+
+    cells = cells.astype(np.int64)
+    if float(np.prod(extent)) < 2 ** 62:
+        strides = np.array([extent[1] * extent[2], extent[2], 1], dtype=np.int64)
+        unique_keys, inverse = np.unique(cells @ strides, return_inverse=True)
+    else:
+        unique_keys, inverse = np.unique(cells, axis=0, return_inverse=True)
+    return inverse.reshape(-1), len(unique_keys)
+
+
+def voxel_downsample(
+    points: np.ndarray,
+    colors: Optional[np.ndarray] = None,
+    voxel_size: float = 0.01
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Replace all points in each occupied voxel by their mean position/color.
+
+    Args:
+        points: [N, 3] float32 positions
+        colors: Optional [N, 3] uint8 colors
+        voxel_size: Voxel edge length in point-cloud units
+
+    Returns:
+        Tuple of (points [M, 3] float32, colors [M, 3] uint8 or None)
+    """
+    if voxel_size <= 0:
+        raise ValueError("voxel_size must be positive")
+    if len(points) == 0:
+        return points, colors
+
+    inverse, num_cells = _voxel_cells(points, voxel_size)
+
+    counts = np.bincount(inverse, minlength=num_cells)[:, None]
+    out_points = (_cell_sums(inverse, num_cells, points) / counts).astype(np.float32)
+
+    out_colors = None
+    if colors is not None:
+        out_colors = np.rint(_cell_sums(inverse, num_cells, colors) / counts).astype(np.uint8)
+
+    return out_points, out_colors
+
+
+class PointCloudOctree:
+    """
+    Level-of-detail octree over a point cloud.
+
+    Level L partitions the cubic bounds into 2^L cells per axis and stores
+    one mean point per occupied cell. Levels are built bottom-up once, by
+    merging each cell's eight children, so serving any level later is just
+    a division of precomputed sums.
+    """
+
+    def __init__(
+        self,
+        points: np.ndarray,
+        colors: Optional[np.ndarray] = None,
+        max_depth: int = DEFAULT_OCTREE_DEPTH
+    ):
+        """
+        Build the octree.
+
+        Args:
+            points: [N, 3] float32 positions
+            colors: Optional [N, 3] uint8 colors
+            max_depth: Finest level (2^max_depth cells per axis)
+        """
+        self.max_depth = int(min(max(max_depth, 0), MAX_OCTREE_DEPTH))
+        self.has_colors = colors is not None
+        self.num_source_points = len(points)
+
+        if len(points) > 0:
+            self.origin = points.min(axis=0).astype(np.float64)
+            self.size = float(max((points.max(axis=0) - self.origin).max(), 1e-6))
+        else:
+            self.origin = np.zeros(3)
+            self.size = 1.0
+
+        # Per level: (counts [M], position sums [M, 3], color sums [M, 3] or None)
+        self._levels: List[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]] = [None] * (self.max_depth + 1)
+        self._build(points, colors)
+
+    def _build(self, points: np.ndarray, colors: Optional[np.ndarray]) -> None:
+        cells_per_axis = 1 << self.max_depth
+        cells = ((points - self.origin) / self.size * cells_per_axis).astype(np.int64)
+        np.clip(cells, 0, cells_per_axis - 1, out=cells)
+
+        # Finest level aggregates raw points; each coarser level aggregates
+        # the sums/counts of the level below (its children)
+        position_values, color_values, child_counts = points, colors, None
+
+        for level in range(self.max_depth, -1, -1):
+            if level < self.max_depth:
+                cells = cells >> 1
+
+            keys = (cells[:, 0] << (2 * level)) | (cells[:, 1] << level) | cells[:, 2]
+            unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            num_cells = len(unique_keys)
+
+            counts = np.bincount(inverse, weights=child_counts, minlength=num_cells)
+            position_sums = _cell_sums(inverse, num_cells, position_values)
+            color_sums = None
+            if color_values is not None:
+                color_sums = _cell_sums(inverse, num_cells, color_values)
+
+            self._levels[level] = (counts, position_sums, color_sums)
+
+            cells = cells[first]
+            position_values, color_values, child_counts = position_sums, color_sums, counts
+
+    @property
+    def num_levels(self) -> int:
+        return self.max_depth + 1
+
+    def level_counts(self) -> List[int]:
+        """Number of points at each level, coarsest first."""
+        return [len(counts) for counts, _, _ in self._levels]
+
+    def level_for_budget(self, max_points: int) -> int:
+        """Finest level whose point count fits in max_points (at least 0)."""
+        best = 0
+        for level, count in enumerate(self.level_counts()):
+            if count <= max_points:
+                best = level
+        return best
+
+    def level(self, level: int) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Mean points (and colors) for one level."""
+        level = int(min(max(level, 0), self.max_depth))
+        counts, position_sums, color_sums = self._levels[level]
+        counts = np.maximum(counts, 1)[:, None]
+
+        points = (position_sums / counts).astype(np.float32)
+        colors = None
+        if color_sums is not None:
+            colors = np.rint(color_sums / counts).astype(np.uint8)
+        return points, colors
+
+
+_octree_cache = LRUCache(max_entries=OCTREE_CACHE_SIZE)
+
+
+def cache_octree(cloud_id: str, octree: PointCloudOctree) -> None:
+    """Keep an octree for follow-up level requests (LRU, OCTREE_CACHE_SIZE entries)."""
+    _octree_cache.put(cloud_id, octree)
+
+
+def get_cached_octree(cloud_id: str) -> Optional[PointCloudOctree]:
+    """Look up a previously built octree, or None if it was evicted."""
+    return _octree_cache.get(cloud_id)
+
+
+# ============================================================================
+# Encoders
+# ============================================================================
+
+# Raw interleaved layout: float32 x, y, z followed by uint8 r, g, b, a.
+# 16 bytes per point keeps every float 4-byte aligned, so the client can
+# view the whole buffer as a Float32Array (stride 4) and a Uint8Array
+# (stride 16, offset 12) without copying.
+RAW_POINT_DTYPE = np.dtype([
+    ('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+    ('r', 'u1'), ('g', 'u1'), ('b', 'u1'), ('a', 'u1'),
+])
+RAW_POINT_STRIDE = RAW_POINT_DTYPE.itemsize
+
+
+def _ply_header(num_points: int, encoding: str, with_colors: bool) -> str:
+    """Build a PLY header for an XYZ(RGB) vertex list."""
+    lines = [
+        "ply",
+        f"format {encoding} 1.0",
+        f"element vertex {num_points}",
+        "property float x",
+        "property float y",
+        "property float z",
+    ]
+    if with_colors:
+        lines += ["property uchar red", "property uchar green", "property uchar blue"]
+    lines.append("end_header")
+    return "\n".join(lines) + "\n"
+
+
+def encode_ply_binary(points: np.ndarray, colors: Optional[np.ndarray] = None) -> bytes:
+    """Encode points (and optional colors) as a binary_little_endian PLY."""
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if colors is not None:
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+
+    vertices = np.empty(len(points), dtype=np.dtype(fields))
+    vertices['x'], vertices['y'], vertices['z'] = points[:, 0], points[:, 1], points[:, 2]
+    if colors is not None:
+        vertices['red'], vertices['green'], vertices['blue'] = colors[:, 0], colors[:, 1], colors[:, 2]
+
+    header = _ply_header(len(points), "binary_little_endian", colors is not None)
+    return header.encode('ascii') + vertices.tobytes()
+
+
+def encode_ply_ascii(points: np.ndarray, colors: Optional[np.ndarray] = None) -> str:
+    """Encode points (and optional colors) as an ASCII PLY string."""
+    import io
+
+    buffer = io.StringIO()
+    buffer.write(_ply_header(len(points), "ascii", colors is not None))
+
+    if colors is not None:
+        np.savetxt(buffer, np.column_stack([points, colors]),
+                   fmt=['%.6f'] * 3 + ['%d'] * 3)
+    else:
+        np.savetxt(buffer, points, fmt='%.6f')
+
+    return buffer.getvalue()
+
+
+def encode_raw_buffer(points: np.ndarray, colors: Optional[np.ndarray] = None) -> bytes:
+    """
+    Encode points as an interleaved float32 XYZ + uint8 RGBA buffer.
+
+    See RAW_POINT_DTYPE for the layout. Points without colors are white.
+    """
+    buffer = np.empty(len(points), dtype=RAW_POINT_DTYPE)
+    buffer['x'], buffer['y'], buffer['z'] = points[:, 0], points[:, 1], points[:, 2]
+
+    if colors is not None:
+        buffer['r'], buffer['g'], buffer['b'] = colors[:, 0], colors[:, 1], colors[:, 2]
+    else:
+        buffer['r'] = buffer['g'] = buffer['b'] = 255
+    buffer['a'] = 255
+
+    return buffer.tobytes()
+
+
+# ============================================================================
+# Mesh from depth - grid triangulation with quadtree decimation
+# ============================================================================
+
+# Relative depth jump ((max - min) / min) across a grid triangle that marks
+# a discontinuity; such triangles are dropped instead of stretched
+DEFAULT_MESH_DISCONTINUITY = 0.1
+# Max relative depth error of a merged block against the surface it replaces
+DEFAULT_MESH_TOLERANCE = 0.005
+# Largest merged block is 2^level grid cells on a side
+DEFAULT_MESH_MAX_LEVEL = 6
+
+
+def _block_perimeter(size: int) -> np.ndarray:
+    """
+    (row, col) offsets around a size x size block: down the left edge, along
+    the bottom, up the right edge, back along the top. Fans over this order
+    face the camera.
+    """
+    steps = np.arange(size)
+    return np.concatenate([
+        np.stack([steps, np.zeros(size, dtype=int)], axis=1),
+        np.stack([np.full(size, size), steps], axis=1),
+        np.stack([size - steps, np.full(size, size)], axis=1),
+        np.stack([np.zeros(size, dtype=int), size - steps], axis=1),
+    ])
+
+
+def _planar_error(z_blocks: np.ndarray, inv_blocks: np.ndarray) -> np.ndarray:
+    """
+    Max relative depth error of two triangles (00, 10, 01) and (01, 10, 11)
+    spanning each [K, s+1, s+1] block. Inverse depth is interpolated, which
+    is exact for planes under perspective projection.
+    """
+    s = z_blocks.shape[1] - 1
+    a = np.linspace(0.0, 1.0, s + 1, dtype=np.float32)[:, None]  # row fraction
+    b = np.linspace(0.0, 1.0, s + 1, dtype=np.float32)[None, :]  # column fraction
+    c00 = inv_blocks[:, 0, 0, None, None]
+    c01 = inv_blocks[:, 0, s, None, None]
+    c10 = inv_blocks[:, s, 0, None, None]
+    c11 = inv_blocks[:, s, s, None, None]
+
+    first = c00 + a * (c10 - c00) + b * (c01 - c00)
+    second = c11 + (1 - a) * (c01 - c11) + (1 - b) * (c10 - c11)
+    interpolated = np.where(a + b <= 1.0, first, second)
+    return np.abs(z_blocks * interpolated - 1.0).max(axis=(1, 2))
+
+
+def mesh_from_depth(
+    depth: np.ndarray,
+    image: Optional[np.ndarray] = None,
+    intrinsics: Optional[List[List[float]]] = None,
+    step: int = 1,
+    discontinuity: float = DEFAULT_MESH_DISCONTINUITY,
+    tolerance: float = DEFAULT_MESH_TOLERANCE,
+    max_level: int = DEFAULT_MESH_MAX_LEVEL,
+    normals: Optional[np.ndarray] = None,
+    min_depth: float = MIN_VALID_DEPTH
+) -> Dict[str, Any]:
+    """
+    Triangle mesh over the depth grid with error-bounded decimation.
+
+    Every step-th pixel is a grid vertex, back-projected exactly like
+    backproject_depth(). Square blocks of 2^L cells (largest first) collapse
+    to two triangles when every pixel they cover lies within `tolerance`
+    relative depth of them. Blocks bordering finer ones are fanned from
+    their center through every vertex on their edges, so there are no
+    T-junction cracks. Leftover single cells are split into two triangles,
+    each dropped if it spans a depth discontinuity or an invalid pixel.
+
+    Args:
+        depth: [H, W] depth map
+        image: Optional [H, W, 3] uint8 RGB image for vertex colors
+        intrinsics: 3x3 camera matrix, estimated from the image size if None
+        step: Grid spacing in pixels
+        discontinuity: Relative depth jump that breaks a triangle
+        tolerance: Max relative depth error of a merged block (0 disables merging)
+        max_level: Largest merged block is 2^max_level cells on a side
+        normals: Optional [H, W, 3] normal map (depth_to_normals convention)
+            for per-vertex normals
+        min_depth: Pixels with depth <= this are holes
+
+    Returns:
+        Dict with 'vertices' [V, 3] float32, 'faces' [F, 3] uint32, 'colors'
+        [V, 3] uint8 or None, 'normals' [V, 3] float32 or None, and
+        'grid_vertices' (vertex count of the undecimated grid)
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    depth = np.asarray(depth, dtype=np.float32)
+    height, width = depth.shape
+    step = max(1, int(step))
+    if intrinsics is None:
+        intrinsics = estimate_intrinsics(width, height)
+
+    z = depth[::step, ::step]
+    grid_h, grid_w = z.shape
+    valid = z > min_depth
+    empty = {
+        "vertices": np.zeros((0, 3), dtype=np.float32),
+        "faces": np.zeros((0, 3), dtype=np.uint32),
+        "colors": None if image is None else np.zeros((0, 3), dtype=np.uint8),
+        "normals": None if normals is None else np.zeros((0, 3), dtype=np.float32),
+        "grid_vertices": int(valid.sum())
+    }
+    if grid_h < 2 or grid_w < 2:
+        return empty
+
+    cells = min(grid_h, grid_w) - 1
+    level = max(0, min(int(max_level), int(np.log2(cells)))) if tolerance > 0 else 0
+    size = 1 << level
+
+    # Pad the grid to whole top-level blocks; padding is invalid
+    cells_h = -(-(grid_h - 1) // size) * size
+    cells_w = -(-(grid_w - 1) // size) * size
+    z_pad = np.zeros((cells_h + 1, cells_w + 1), dtype=np.float32)
+    z_pad[:grid_h, :grid_w] = z
+    valid_pad = np.zeros_like(z_pad, dtype=bool)
+    valid_pad[:grid_h, :grid_w] = valid
+    inv_pad = np.where(valid_pad, 1.0 / np.maximum(z_pad, min_depth), 0.0).astype(np.float32)
+
+    covered = np.zeros((cells_h, cells_w), dtype=bool)
+    used = np.zeros_like(valid_pad)
+    blocks = []
+
+    # Merged blocks, coarsest first
+    for block_level in range(level, 0, -1):
+        s = 1 << block_level
+        block_valid = sliding_window_view(valid_pad, (s + 1, s + 1))[::s, ::s].all(axis=(2, 3))
+        rows, cols = np.nonzero(block_valid & ~covered[::s, ::s])
+        if len(rows) == 0:
+            continue
+
+        z_blocks = sliding_window_view(z_pad, (s + 1, s + 1))[::s, ::s][rows, cols]
+        inv_blocks = sliding_window_view(inv_pad, (s + 1, s + 1))[::s, ::s][rows, cols]
+        flat = _planar_error(z_blocks, inv_blocks) <= tolerance
+        rows, cols = rows[flat], cols[flat]
+        if len(rows) == 0:
+            continue
+
+        covered.reshape(cells_h // s, s, cells_w // s, s)[rows, :, cols, :] = True
+        top, left = rows * s, cols * s
+        used[top, left] = used[top + s, left] = used[top, left + s] = used[top + s, left + s] = True
+        blocks.append((s, top, left))
+
+    # Single cells: two triangles each, kept per triangle
+    r0, c0 = np.nonzero(~covered)
+    corner_z = [z_pad[r0, c0], z_pad[r0, c0 + 1], z_pad[r0 + 1, c0], z_pad[r0 + 1, c0 + 1]]
+    corner_ok = [valid_pad[r0, c0], valid_pad[r0, c0 + 1], valid_pad[r0 + 1, c0], valid_pad[r0 + 1, c0 + 1]]
+
+    cell_faces = []
+    # (00, 10, 01) and (01, 10, 11) as (corner index, row offset, col offset)
+    for triangle in (((0, 0, 0), (2, 1, 0), (1, 0, 1)), ((1, 0, 1), (2, 1, 0), (3, 1, 1))):
+        tri_z = np.stack([corner_z[i] for i, _, _ in triangle])
+        keep = np.logical_and.reduce([corner_ok[i] for i, _, _ in triangle])
+        keep &= (tri_z.max(axis=0) - tri_z.min(axis=0)) <= discontinuity * tri_z.min(axis=0)
+        face = [(r0[keep] + dr, c0[keep] + dc) for _, dr, dc in triangle]
+        for vertex_row, vertex_col in face:
+            used[vertex_row, vertex_col] = True
+        cell_faces.append(face)
+
+    # Merged blocks: two triangles, or a fan when finer neighbours added
+    # vertices along an edge
+    block_faces = []
+    for s, top, left in blocks:
+        perimeter = _block_perimeter(s)
+        perimeter_used = used[top[:, None] + perimeter[:, 0], left[:, None] + perimeter[:, 1]]
+        simple = perimeter_used.sum(axis=1) == 4
+
+        t, l = top[simple], left[simple]
+        block_faces.append([(t, l), (t + s, l), (t, l + s)])
+        block_faces.append([(t, l + s), (t + s, l), (t + s, l + s)])
+
+        fan = ~simple
+        if not fan.any():
+            continue
+        t, l, mask = top[fan], left[fan], perimeter_used[fan]
+        center_row, center_col = t + s // 2, l + s // 2
+        used[center_row, center_col] = True
+
+        # Next used perimeter position after each one (wrapping to corner 0)
+        count = len(perimeter)
+        index = np.where(mask, np.arange(count), count)
+        following = np.minimum.accumulate(index[:, ::-1], axis=1)[:, ::-1]
+        following = np.concatenate([following[:, 1:], np.full((len(t), 1), count)], axis=1)
+        following[following == count] = 0
+
+        block_index, position = np.nonzero(mask)
+        nxt = following[block_index, position]
+        block_faces.append([
+            (center_row[block_index], center_col[block_index]),
+            (t[block_index] + perimeter[position, 0], l[block_index] + perimeter[position, 1]),
+            (t[block_index] + perimeter[nxt, 0], l[block_index] + perimeter[nxt, 1]),
+        ])
+
+    # Compact vertex indices over the used grid points
+    vertex_rows, vertex_cols = np.nonzero(used)
+    index_grid = np.full(used.shape, -1, dtype=np.int64)
+    index_grid[vertex_rows, vertex_cols] = np.arange(len(vertex_rows))
+
+    faces = [
+        np.stack([index_grid[rows, cols] for rows, cols in face], axis=1)
+        for face in cell_faces + block_faces if len(face[0][0])
+    ]
+    if not faces:
+        return empty
+
+    fx, fy = float(intrinsics[0][0]), float(intrinsics[1][1])
+    cx, cy = float(intrinsics[0][2]), float(intrinsics[1][2])
+    u = (vertex_cols * step).astype(np.float32)
+    v = (vertex_rows * step).astype(np.float32)
+    vertex_z = z_pad[vertex_rows, vertex_cols]
+
+    vertices = np.empty((len(vertex_rows), 3), dtype=np.float32)
+    vertices[:, 0] = (u - cx) * vertex_z / fx
+    vertices[:, 1] = (v - cy) * vertex_z / fy
+    vertices[:, 2] = vertex_z
+
+    pixel_rows, pixel_cols = vertex_rows * step, vertex_cols * step
+    colors = None
+    if image is not None:
+        colors = np.ascontiguousarray(image[pixel_rows, pixel_cols, :3], dtype=np.uint8)
+    vertex_normals = None
+    if normals is not None:
+        # Normal maps point along +Z for camera-facing surfaces; in camera
+        # space those surfaces face -Z
+        vertex_normals = -np.asarray(normals, dtype=np.float32)[pixel_rows, pixel_cols]
+
+    return {
+        "vertices": vertices,
+        "faces": np.concatenate(faces).astype(np.uint32),
+        "colors": colors,
+        "normals": vertex_normals,
+        "grid_vertices": int(valid.sum())
+    }
+
+
+def encode_mesh_ply(mesh: Dict[str, Any]) -> bytes:
+    """Encode a mesh_from_depth() result as a binary_little_endian PLY."""
+    vertices, faces = mesh["vertices"], mesh["faces"]
+    colors, normals = mesh.get("colors"), mesh.get("normals")
+
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    lines = [
+        "ply",
+        "format binary_little_endian 1.0",
+        f"element vertex {len(vertices)}",
+        "property float x",
+        "property float y",
+        "property float z",
+    ]
+    if normals is not None:
+        fields += [('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4')]
+        lines += ["property float nx", "property float ny", "property float nz"]
+    if colors is not None:
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+        lines += ["property uchar red", "property uchar green", "property uchar blue"]
+    lines += [f"element face {len(faces)}", "property list uchar uint vertex_indices", "end_header"]
+
+    vertex_data = np.empty(len(vertices), dtype=np.dtype(fields))
+    vertex_data['x'], vertex_data['y'], vertex_data['z'] = vertices.T
+    if normals is not None:
+        vertex_data['nx'], vertex_data['ny'], vertex_data['nz'] = normals.T
+    if colors is not None:
+        vertex_data['red'], vertex_data['green'], vertex_data['blue'] = colors.T
+
+    face_data = np.empty(len(faces), dtype=np.dtype([('count', 'u1'), ('indices', '<u4', (3,))]))
+    face_data['count'] = 3
+    face_data['indices'] = faces
+
+    header = "\n".join(lines) + "\n"
+    return header.encode('ascii') + vertex_data.tobytes() + face_data.tobytes()
+
+
+# glTF constants
+_GLTF_ARRAY_BUFFER = 34962
+_GLTF_ELEMENT_ARRAY_BUFFER = 34963
+_GLTF_FLOAT = 5126
+_GLTF_UNSIGNED_BYTE = 5121
+_GLTF_UNSIGNED_INT = 5125
+
+
+def encode_glb(mesh: Dict[str, Any]) -> bytes:
+    """
+    Encode a mesh_from_depth() result as binary glTF 2.0 (.glb).
+
+    Vertex data stays in the point cloud's camera space (+Y down, +Z
+    forward); the scene node rotates it 180 degrees about X into glTF's
+    +Y up, -Z forward convention so it displays upright in any viewer.
+    """
+    import json
+    import struct
+
+    vertices, faces = mesh["vertices"], mesh["faces"]
+    colors, normals = mesh.get("colors"), mesh.get("normals")
+
+    blob = bytearray()
+    buffer_views: List[Dict[str, Any]] = []
+    accessors: List[Dict[str, Any]] = []
+
+    def add_accessor(data: np.ndarray, target: int, component_type: int, kind: str, **extra) -> int:
+        raw = np.ascontiguousarray(data).tobytes()
+        buffer_views.append({
+            "buffer": 0, "byteOffset": len(blob), "byteLength": len(raw), "target": target
+        })
+        blob.extend(raw)
+        blob.extend(b"\x00" * (-len(blob) % 4))
+        accessors.append({
+            "bufferView": len(buffer_views) - 1,
+            "componentType": component_type,
+            "count": int(len(data)),
+            "type": kind,
+            **extra
+        })
+        return len(accessors) - 1
+
+    positions = vertices.astype(np.float32)
+    attributes = {"POSITION": add_accessor(
+        positions, _GLTF_ARRAY_BUFFER, _GLTF_FLOAT, "VEC3",
+        min=positions.min(axis=0).tolist() if len(positions) else [0, 0, 0],
+        max=positions.max(axis=0).tolist() if len(positions) else [0, 0, 0]
+    )}
+    if normals is not None:
+        attributes["NORMAL"] = add_accessor(normals.astype(np.float32), _GLTF_ARRAY_BUFFER, _GLTF_FLOAT, "VEC3")
+    if colors is not None:
+        # RGBA keeps the vertex stride 4-byte aligned as glTF requires
+        rgba = np.concatenate([colors, np.full((len(colors), 1), 255, dtype=np.uint8)], axis=1)
+        attributes["COLOR_0"] = add_accessor(rgba, _GLTF_ARRAY_BUFFER, _GLTF_UNSIGNED_BYTE, "VEC4", normalized=True)
+    indices = add_accessor(faces.astype(np.uint32).ravel(), _GLTF_ELEMENT_ARRAY_BUFFER, _GLTF_UNSIGNED_INT, "SCALAR")
+
+    document = {
+        "asset": {"version": "2.0", "generator": "Lattice Compositor"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0, "rotation": [1.0, 0.0, 0.0, 0.0]}],
+        "meshes": [{"primitives": [{"attributes": attributes, "indices": indices, "material": 0, "mode": 4}]}],
+        "materials": [{
+            "pbrMetallicRoughness": {"metallicFactor": 0.0, "roughnessFactor": 1.0},
+            "doubleSided": True
+        }],
+        "buffers": [{"byteLength": len(blob)}],
+        "bufferViews": buffer_views,
+        "accessors": accessors
+    }
+
+    json_chunk = json.dumps(document, separators=(',', ':')).encode('utf-8')
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    total = 12 + 8 + len(json_chunk) + 8 + len(blob)
+
+    return b"".join([
+        struct.pack("<4sII", b"glTF", 2, total),
+        struct.pack("<I4s", len(json_chunk), b"JSON"), json_chunk,
+        struct.pack("<I4s", len(blob), b"BIN\x00"), bytes(blob),
+    ])
+
+
+# ============================================================================
+# Gaussian splats - 3DGS initialization from depth
+# ============================================================================
+
+# Default cap on exported splats; voxel merging coarsens until it fits
+DEFAULT_SPLAT_BUDGET = 500_000
+# Gaussian std-dev in the surface plane, as a fraction of the sample's
+# footprint; ~0.6 makes neighbouring splats overlap without visible holes
+SPLAT_FOOTPRINT_SIGMA = 0.6
+# Std-dev along the normal relative to the in-plane one (thin surfels)
+SPLAT_THICKNESS = 0.1
+# Cap on the 1 / cos(view angle) stretch of grazing-angle splats
+SPLAT_MAX_STRETCH = 5.0
+
+# antimatter15-style .splat record: float32 position and linear scale,
+# uint8 RGBA, and a uint8 quaternion (w, x, y, z) mapped from [-1, 1]
+SPLAT_DTYPE = np.dtype([
+    ('position', '<f4', (3,)),
+    ('scale', '<f4', (3,)),
+    ('color', 'u1', (4,)),
+    ('rotation', 'u1', (4,)),
+])
+
+# Zeroth-order spherical harmonic basis, color = 0.5 + SH_C0 * f_dc
+SH_C0 = 0.28209479177387814
+
+
+def _basis_to_quaternion(m: np.ndarray) -> np.ndarray:
+    """[N, 4] unit quaternions (w, x, y, z) for [N, 3, 3] rotation matrices."""
+    m00, m11, m22 = m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]
+    q = np.empty((len(m), 4), dtype=np.float64)
+
+    # Branch per element on the largest of (trace, diagonal) for stability
+    trace = m00 + m11 + m22
+    choice = np.argmax(np.stack([trace, m00, m11, m22], axis=1), axis=1)
+
+    w = choice == 0
+    s = np.sqrt(np.maximum(trace[w] + 1.0, 1e-12)) * 2
+    q[w] = np.stack([0.25 * s, (m[w, 2, 1] - m[w, 1, 2]) / s,
+                     (m[w, 0, 2] - m[w, 2, 0]) / s, (m[w, 1, 0] - m[w, 0, 1]) / s], axis=1)
+    x = choice == 1
+    s = np.sqrt(np.maximum(1.0 + m00[x] - m11[x] - m22[x], 1e-12)) * 2
+    q[x] = np.stack([(m[x, 2, 1] - m[x, 1, 2]) / s, 0.25 * s,
+                     (m[x, 0, 1] + m[x, 1, 0]) / s, (m[x, 0, 2] + m[x, 2, 0]) / s], axis=1)
+    y = choice == 2
+    s = np.sqrt(np.maximum(1.0 + m11[y] - m00[y] - m22[y], 1e-12)) * 2
+    q[y] = np.stack([(m[y, 0, 2] - m[y, 2, 0]) / s, (m[y, 0, 1] + m[y, 1, 0]) / s,
+                     0.25 * s, (m[y, 1, 2] + m[y, 2, 1]) / s], axis=1)
+    z = choice == 3
+    s = np.sqrt(np.maximum(1.0 + m22[z] - m00[z] - m11[z], 1e-12)) * 2
+    q[z] = np.stack([(m[z, 1, 0] - m[z, 0, 1]) / s, (m[z, 0, 2] + m[z, 2, 0]) / s,
+                     (m[z, 1, 2] + m[z, 2, 1]) / s, 0.25 * s], axis=1)
+
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    q[q[:, 0] < 0] *= -1
+    return q.astype(np.float32)
+
+
+def _merge_splats(
+    positions: np.ndarray,
+    normals: np.ndarray,
+    areas: np.ndarray,
+    rgba: np.ndarray,
+    voxel_size: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Merge splat samples per voxel: area-weighted mean position, normal and
+    color, with the areas summed so the merged splat covers its sources.
+    """
+    inverse, num_cells = _voxel_cells(positions, voxel_size)
+
+    weights = areas.astype(np.float64)
+    total = np.bincount(inverse, weights=weights, minlength=num_cells)
+    norm = np.maximum(total, 1e-20)[:, None]
+
+    def weighted(values: np.ndarray) -> np.ndarray:
+        return _cell_sums(inverse, num_cells, values * weights[:, None]) / norm
+
+    merged_normals = weighted(normals)
+    merged_normals /= np.maximum(np.linalg.norm(merged_normals, axis=1, keepdims=True), 1e-12)
+    return (
+        weighted(positions).astype(np.float32),
+        merged_normals.astype(np.float32),
+        total.astype(np.float32),
+        np.rint(weighted(rgba)).astype(np.uint8)
+    )
+
+
+def gaussians_from_depth(
+    depth: np.ndarray,
+    image: Optional[np.ndarray] = None,
+    intrinsics: Optional[List[List[float]]] = None,
+    normals: Optional[np.ndarray] = None,
+    subsample: int = 1,
+    voxel_size: Optional[float] = None,
+    max_splats: Optional[int] = DEFAULT_SPLAT_BUDGET,
+    min_depth: float = MIN_VALID_DEPTH
+) -> Dict[str, Any]:
+    """
+    Initialize 3D Gaussian splats (oriented surfels) from a depth map.
+
+    Each sampled pixel becomes a flat Gaussian lying in the local surface:
+    its in-plane std-dev is SPLAT_FOOTPRINT_SIGMA of the pixel footprint
+    (z * subsample / f), stretched by 1 / cos(view angle) along the tilt
+    direction so slanted surfaces stay covered, and SPLAT_THICKNESS of that
+    along the normal. Color and opacity come from the RGB(A) image; fully
+    transparent pixels are skipped.
+
+    Samples are merged per voxel (voxel_size, or the smallest size that
+    fits max_splats), summing their footprint areas so merged splats still
+    cover the surface.
+
+    Args:
+        depth: [H, W] depth map
+        image: Optional [H, W, 3|4] uint8 RGB(A) image (opaque grey if None)
+        intrinsics: 3x3 camera matrix, estimated from the image size if None
+        normals: Optional [H, W, 3] normal map (depth_to_normals convention);
+            splats face the camera if None
+        subsample: Take every Nth pixel in both directions
+        voxel_size: Merge samples per voxel of this size
+        max_splats: Upper bound on the splat count (None for no bound)
+        min_depth: Pixels with depth <= this are dropped
+
+    Returns:
+        Dict with 'positions' [N, 3], 'scales' [N, 3] (linear std-devs),
+        'rotations' [N, 4] (w, x, y, z), 'normals' [N, 3] float32, 'colors'
+        [N, 4] uint8 RGBA, 'voxel_size' (the merge size used, or None) and
+        'source_points'
+    """
+    depth = np.asarray(depth, dtype=np.float32)
+    height, width = depth.shape
+    subsample = max(1, int(subsample))
+    if intrinsics is None:
+        intrinsics = estimate_intrinsics(width, height)
+
+    positions, _ = backproject_depth(depth, None, intrinsics, subsample, min_depth)
+    valid = depth[::subsample, ::subsample] > min_depth
+
+    if image is None:
+        rgba = np.full((len(positions), 4), (200, 200, 200, 255), dtype=np.uint8)
+    else:
+        pixels = np.asarray(image, dtype=np.uint8)[::subsample, ::subsample][valid]
+        rgba = np.full((len(positions), 4), 255, dtype=np.uint8)
+        rgba[:, :pixels.shape[1]] = pixels[:, :4]
+
+    # Unit view rays; camera-facing normals point back along them
+    rays = positions / np.maximum(np.linalg.norm(positions, axis=1, keepdims=True), 1e-12)
+    if normals is not None:
+        # Normal maps point along +Z for camera-facing surfaces; in camera
+        # space those surfaces face -Z
+        surface = -np.asarray(normals, dtype=np.float32)[::subsample, ::subsample][valid]
+        surface /= np.maximum(np.linalg.norm(surface, axis=1, keepdims=True), 1e-12)
+    else:
+        surface = -rays
+
+    opaque = rgba[:, 3] > 0
+    positions, rays, surface, rgba = positions[opaque], rays[opaque], surface[opaque], rgba[opaque]
+    source_points = len(positions)
+
+    focal = 0.5 * (float(intrinsics[0][0]) + float(intrinsics[1][1]))
+    footprint = positions[:, 2] * subsample / focal
+    cos_view = np.clip(np.abs(np.einsum('ij,ij->i', surface, rays)), 1.0 / SPLAT_MAX_STRETCH, 1.0)
+    areas = footprint ** 2 / cos_view
+
+    # Bound the count: coarsen the voxel grid until the merge fits
+    if voxel_size is None and max_splats is not None and source_points > max_splats:
+        voxel_size = float(np.sqrt(areas.sum() / max_splats))
+    if voxel_size:
+        while True:
+            merged = _merge_splats(positions, surface, areas, rgba, voxel_size)
+            if max_splats is None or len(merged[0]) <= max_splats:
+                break
+            voxel_size *= 1.25
+        positions, surface, areas, rgba = merged
+        rays = positions / np.maximum(np.linalg.norm(positions, axis=1, keepdims=True), 1e-12)
+        cos_view = np.clip(np.abs(np.einsum('ij,ij->i', surface, rays)), 1.0 / SPLAT_MAX_STRETCH, 1.0)
+
+    # Tangent frame: t1 along the view ray's tilt in the surface plane (the
+    # stretched axis), t2 = n x t1, so [t1, t2, n] is a proper rotation
+    tilt = rays - np.einsum('ij,ij->i', rays, surface)[:, None] * surface
+    tilt_norm = np.linalg.norm(tilt, axis=1, keepdims=True)
+    fallback = np.cross(surface, np.array([0.0, 1.0, 0.0], dtype=np.float32))
+    fallback_norm = np.linalg.norm(fallback, axis=1, keepdims=True)
+    fallback = np.where(fallback_norm > 1e-6, fallback / np.maximum(fallback_norm, 1e-12),
+                        np.array([1.0, 0.0, 0.0], dtype=np.float32))
+    t1 = np.where(tilt_norm > 1e-6, tilt / np.maximum(tilt_norm, 1e-12), fallback)
+    t2 = np.cross(surface, t1)
+    rotations = _basis_to_quaternion(np.stack([t1, t2, surface], axis=2))
+
+    # Area = (sigma_1 * sigma_2) / SIGMA^2 with sigma_1 / sigma_2 = 1 / cos
+    sigma = SPLAT_FOOTPRINT_SIGMA * np.sqrt(areas * cos_view)
+    scales = np.stack([sigma / cos_view, sigma, sigma * SPLAT_THICKNESS], axis=1).astype(np.float32)
+
+    return {
+        "positions": np.ascontiguousarray(positions, dtype=np.float32),
+        "scales": scales,
+        "rotations": rotations,
+        "normals": np.ascontiguousarray(surface, dtype=np.float32),
+        "colors": np.ascontiguousarray(rgba, dtype=np.uint8),
+        "voxel_size": voxel_size,
+        "source_points": source_points
+    }
+
+
+def encode_splat(splats: Dict[str, Any]) -> bytes:
+    """
+    Encode gaussians_from_depth() output as a packed 32-byte-per-splat .splat.
+
+    Splats are ordered by descending size x opacity, which the common web
+    viewers rely on for progressive loading.
+    """
+    scales = splats["scales"]
+    importance = -scales[:, 0] * scales[:, 1] * scales[:, 2] * splats["colors"][:, 3]
+    order = np.argsort(importance, kind='stable')
+
+    records = np.empty(len(order), dtype=SPLAT_DTYPE)
+    records['position'] = splats["positions"][order]
+    records['scale'] = scales[order]
+    records['color'] = splats["colors"][order]
+    records['rotation'] = np.clip(np.rint(splats["rotations"][order] * 128 + 128), 0, 255)
+    return records.tobytes()
+
+
+def encode_splat_ply(splats: Dict[str, Any]) -> bytes:
+    """
+    Encode gaussians_from_depth() output as a binary 3DGS PLY.
+
+    Uses the reference 3DGS layout (all float32): position, normal, DC
+    spherical-harmonic color, logit opacity, log scales and a (w, x, y, z)
+    rotation.
+    """
+    names = (['x', 'y', 'z', 'nx', 'ny', 'nz', 'f_dc_0', 'f_dc_1', 'f_dc_2', 'opacity']
+             + ['scale_0', 'scale_1', 'scale_2', 'rot_0', 'rot_1', 'rot_2', 'rot_3'])
+    count = len(splats["positions"])
+
+    colors = splats["colors"].astype(np.float32) / 255.0
+    opacity = np.clip(colors[:, 3], 1e-4, 1 - 1e-4)
+
+    data = np.empty((count, len(names)), dtype='<f4')
+    data[:, 0:3] = splats["positions"]
+    data[:, 3:6] = splats["normals"]
+    data[:, 6:9] = (colors[:, :3] - 0.5) / SH_C0
+    data[:, 9] = np.log(opacity / (1 - opacity))
+    data[:, 10:13] = np.log(np.maximum(splats["scales"], 1e-12))
+    data[:, 13:17] = splats["rotations"]
+
+    header = "\n".join(
+        ["ply", "format binary_little_endian 1.0", f"element vertex {count}"]
+        + [f"property float {name}" for name in names]
+        + ["end_header"]
+    ) + "\n"
+    return header.encode('ascii') + data.tobytes()
@@ -0,0 +1,851 @@
+"""
+Lattice Segmentation Engine
+
+Model-side helpers for the /lattice/segment routes in compositor_node.py.
+
+Image embeddings:
+SAM's image encoder is by far the most expensive part of a prediction, and
+the mask editor sends many prompts against the same frame. EmbeddingCache
+keeps encoder outputs keyed by a hash of the decoded image so follow-up
+prompts only run the prompt encoder and mask decoder.
+
+Browser-side decoding:
+image_embedding() exposes the (cached) encoder output as a float16 array
+and export_decoder_onnx() writes SAM's prompt encoder + mask decoder as
+an ONNX model, so the frontend can preview masks locally at mouse-move
+rates without a server round trip per click.
+
+Batched prompts:
+predict_prompt_groups() runs many independent prompt groups (points/labels
+and/or a box, one object each) against one image embedding in a single
+batched mask-decoder forward.
+
+CPU fallback:
+When no SAM model is available, region_grow_mask() selects the connected
+region of similar color around each clicked point, and SuperpixelIndex
+precomputes SLIC/felzenszwalb superpixels once per image so follow-up
+clicks are answered on the superpixel graph instead of per pixel.
+
+Mask index:
+MaskIndex keeps a "segment everything" result per image: masks sorted by
+area, each cropped to its bounding box, plus a label raster of the
+smallest mask covering every pixel. Point lookups ("which masks contain
+(x, y)") then need no model call at all.
+
+Mask encoding:
+encode_mask() serializes masks as a full-frame PNG (legacy), a PNG of
+just the bounding box, or COCO-style compressed RLE.
+
+Video propagation:
+propagate_video_masks() drives the SAM2 video predictor: prompts on one or
+more keyframes are propagated through the clip with the predictor's memory
+bank, yielding masks frame by frame as they are produced.
+
+Threading:
+set_image_cached() swaps per-image state on the shared image predictor,
+so every call that touches it (prompts, auto masks, embeddings, decoder
+export) runs on one worker thread via run_in_segment_executor(). Video
+predictor loading and propagation share that worker, so the two SAM
+models never compete for the device.
+"""
+
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from typing import Optional, Dict, Any, Callable, Iterator, List, Tuple
+
+try:
+    from .lattice_cache import LRUCache
+except ImportError:
+    # Imported as a top-level module (tests, scripts/)
+    from lattice_cache import LRUCache
+
+logger = logging.getLogger("lattice.segmentation")
+
+# One worker: the image predictor holds one image's state at a time
+_segment_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lattice-segment")
+
+
+def get_segment_executor() -> ThreadPoolExecutor:
+    """Executor that owns all SAM model loading and inference."""
+    return _segment_executor
+
+
+async def run_in_segment_executor(fn: Callable, *args) -> Any:
+    """Run fn(*args) on the segmentation executor without blocking the event loop."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_segment_executor, fn, *args)
+
+# Default memory budget for cached image embeddings (SAM ViT-H is ~4MB/image)
+EMBEDDING_CACHE_BYTES = 256 * 1024 * 1024
+
+# Predictor attributes holding per-image encoder state. segment_anything's
+# SamPredictor and sam2's SAM2ImagePredictor use different names.
+_PREDICTOR_STATE_ATTRS = {
+    "sam": ("features", "original_size", "input_size", "is_image_set"),
+    "sam2": ("_features", "_orig_hw", "_is_image_set", "_is_batch"),
+}
+
+
+def image_hash(image_np: np.ndarray) -> str:
+    """Content hash of a decoded image (shape + dtype + pixels)."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image_np.shape}{image_np.dtype}".encode('ascii'))
+    digest.update(np.ascontiguousarray(image_np).data)
+    return digest.hexdigest()
+
+
+def _predictor_kind(predictor: Any) -> str:
+    return "sam2" if hasattr(predictor, "_features") else "sam"
+
+
+class EmbeddingCache(LRUCache):
+    """
+    LRU cache of SAM image-encoder state with a byte budget.
+
+    Entries are whatever the predictor stores after set_image() (features
+    plus the size bookkeeping needed to map prompts into model space), so a
+    cache hit restores the predictor exactly as if set_image() had run.
+    """
+
+    def __init__(self, max_bytes: int = EMBEDDING_CACHE_BYTES):
+        super().__init__(max_bytes=max_bytes)
+
+
+_embedding_cache = EmbeddingCache()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Process-wide image embedding cache."""
+    return _embedding_cache
+
+
+def set_image_cached(predictor: Any, image_np: np.ndarray, key: Optional[str] = None) -> bool:
+    """
+    Equivalent of predictor.set_image(image_np) backed by the embedding cache.
+
+    Args:
+        predictor: SamPredictor or SAM2ImagePredictor
+        image_np: [H, W, 3] uint8 RGB image
+        key: Precomputed image_hash(image_np), if the caller already has it
+
+    Returns:
+        True if the embedding came from the cache, False if the encoder ran
+    """
+    attrs = _PREDICTOR_STATE_ATTRS[_predictor_kind(predictor)]
+    key = key or image_hash(image_np)
+
+    state = _embedding_cache.get(key)
+    if state is not None:
+        for name, value in state.items():
+            setattr(predictor, name, value)
+        return True
+
+    predictor.set_image(image_np)
+    _embedding_cache.put(key, {name: getattr(predictor, name) for name in attrs if hasattr(predictor, name)})
+    return False
+
+
+def image_embedding(predictor: Any, image_np: np.ndarray, key: Optional[str] = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """
+    Image encoder output for an image, as float16.
+
+    Args:
+        predictor: SamPredictor or SAM2ImagePredictor
+        image_np: [H, W, 3] uint8 RGB image
+        key: Precomputed image_hash(image_np)
+
+    Returns:
+        Tuple of (embedding [1, C, h, w] float16, metadata). The metadata has
+        the sizes a decoder needs to map prompts into model space.
+    """
+    import torch
+
+    cached = set_image_cached(predictor, image_np, key)
+
+    if _predictor_kind(predictor) == "sam2":
+        embedding = predictor._features["image_embed"]
+        info = {"original_size": list(predictor._orig_hw[0])}
+    else:
+        embedding = predictor.features
+        info = {
+            "original_size": list(predictor.original_size),
+            "input_size": list(predictor.input_size),
+            "image_size": predictor.model.image_encoder.img_size
+        }
+
+    array = embedding.detach().to(device="cpu", dtype=torch.float16).numpy()
+    return array, {**info, "shape": list(array.shape), "dtype": "float16", "cached": cached}
+
+
+def export_decoder_onnx(predictor: Any, path: str, opset: int = 17) -> None:
+    """
+    Export SAM's prompt encoder + mask decoder to ONNX.
+
+    Uses segment_anything's SamOnnxModel wrapper, which has the same
+    inputs as the official web demo: image_embeddings, point_coords,
+    point_labels, mask_input, has_mask_input and orig_im_size. The point
+    count is dynamic. Only segment_anything (SAM v1) predictors are supported.
+    """
+    import torch
+    from segment_anything.utils.onnx import SamOnnxModel
+
+    if _predictor_kind(predictor) != "sam":
+        raise NotImplementedError("ONNX decoder export requires a segment_anything SAM model")
+
+    sam = predictor.model
+    onnx_model = SamOnnxModel(sam, return_single_mask=True)
+
+    embed_dim = sam.prompt_encoder.embed_dim
+    embed_size = sam.prompt_encoder.image_embedding_size
+    mask_input_size = [4 * x for x in embed_size]
+
+    # Export on the serving device; the ONNX graph itself is device independent
+    device = next(sam.parameters()).device
+    dummy_inputs = {
+        "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
+        "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float),
+        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+        "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
+        "has_mask_input": torch.tensor([1], dtype=torch.float),
+        "orig_im_size": torch.tensor([1080, 1920], dtype=torch.float),
+    }
+    dummy_inputs = {name: value.to(device) for name, value in dummy_inputs.items()}
+
+    export_kwargs = dict(
+        export_params=True,
+        opset_version=opset,
+        do_constant_folding=True,
+        input_names=list(dummy_inputs.keys()),
+        output_names=["masks", "iou_predictions", "low_res_masks"],
+        dynamic_axes={
+            "point_coords": {1: "num_points"},
+            "point_labels": {1: "num_points"},
+        },
+    )
+
+    onnx_model.eval()
+    with open(path, "wb") as f:
+        try:
+            # SamOnnxModel targets the TorchScript exporter; newer torch defaults to dynamo
+            torch.onnx.export(onnx_model, tuple(dummy_inputs.values()), f, dynamo=False, **export_kwargs)
+        except TypeError:
+            # torch < 2.5 has no dynamo argument
+            torch.onnx.export(onnx_model, tuple(dummy_inputs.values()), f, **export_kwargs)
+
+# ============================================================================
+# Batched prompt groups
+# ============================================================================
+
+def _pad_point_groups(groups: List[Dict[str, Any]]) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+    """
+    Stack per-group point prompts into [B, N, 2] coords and [B, N] labels.
+
+    Groups with fewer points are padded with label -1, which SAM's prompt
+    encoder treats as "not a point". Returns (None, None) if no group has points.
+    """
+    max_points = max(len(g.get('points') or []) for g in groups)
+    if max_points == 0:
+        return None, None
+
+    coords = np.zeros((len(groups), max_points, 2), dtype=np.float32)
+    labels = np.full((len(groups), max_points), -1, dtype=np.int32)
+
+    for i, group in enumerate(groups):
+        points = group.get('points') or []
+        if points:
+            coords[i, :len(points)] = points
+            labels[i, :len(points)] = group.get('labels') or [1] * len(points)
+
+    return coords, labels
+
+
+def _predict_batch(
+    predictor: Any,
+    coords: Optional[np.ndarray],
+    labels: Optional[np.ndarray],
+    boxes: Optional[np.ndarray],
+    multimask_output: bool
+) -> Tuple[np.ndarray, np.ndarray]:
+    """One batched decoder forward. Returns masks [B, C, H, W] and scores [B, C]."""
+    if _predictor_kind(predictor) == "sam2":
+        masks, scores, _ = predictor.predict(
+            point_coords=coords,
+            point_labels=labels,
+            box=boxes,
+            multimask_output=multimask_output,
+        )
+        if masks.ndim == 3:
+            masks, scores = masks[None], scores[None]
+        return masks.astype(bool), np.asarray(scores, dtype=np.float32)
+
+    import torch
+
+    device = predictor.device
+    point_coords = point_labels = box_tensor = None
+
+    if coords is not None:
+        point_coords = predictor.transform.apply_coords_torch(
+            torch.as_tensor(coords, device=device), predictor.original_size
+        )
+        point_labels = torch.as_tensor(labels, device=device)
+    if boxes is not None:
+        box_tensor = predictor.transform.apply_boxes_torch(
+            torch.as_tensor(boxes, device=device), predictor.original_size
+        )
+
+    with torch.no_grad():
+        masks, scores, _ = predictor.predict_torch(
+            point_coords,
+            point_labels,
+            boxes=box_tensor,
+            multimask_output=multimask_output,
+        )
+
+    return masks.cpu().numpy(), scores.float().cpu().numpy()
+
+
+def predict_prompt_groups(
+    predictor: Any,
+    image_np: np.ndarray,
+    groups: List[Dict[str, Any]],
+    multimask_output: bool = True
+) -> List[Tuple[np.ndarray, float]]:
+    """
+    Segment several independent objects in one image.
+
+    All groups share one (cached) image embedding. SAM can only batch boxes
+    for all or none of the prompts, so groups with a box and groups without
+    run as (at most) two decoder forwards.
+
+    Args:
+        predictor: SamPredictor or SAM2ImagePredictor
+        image_np: [H, W, 3] uint8 RGB image
+        groups: [{"points": [[x, y], ...], "labels": [1, 0, ...], "box": [x1, y1, x2, y2]}, ...]
+        multimask_output: Let SAM propose 3 masks per group and keep the best
+
+    Returns:
+        List of (mask [H, W] bool, score) in the same order as groups
+    """
+    set_image_cached(predictor, image_np)
+
+    results: List[Optional[Tuple[np.ndarray, float]]] = [None] * len(groups)
+    with_box = [i for i, g in enumerate(groups) if g.get('box') is not None]
+    without_box = [i for i, g in enumerate(groups) if g.get('box') is None]
+
+    for indices in (with_box, without_box):
+        if not indices:
+            continue
+
+        batch = [groups[i] for i in indices]
+        coords, labels = _pad_point_groups(batch)
+        boxes = None
+        if indices is with_box:
+            boxes = np.array([g['box'] for g in batch], dtype=np.float32)
+
+        masks, scores = _predict_batch(predictor, coords, labels, boxes, multimask_output)
+        best = scores.argmax(axis=1)
+
+        for row, group_index in enumerate(indices):
+            results[group_index] = (masks[row, best[row]], float(scores[row, best[row]]))
+
+    return results
+
+
+# ============================================================================
+# Mask encoding
+# ============================================================================
+
+# "png": full-frame 8-bit PNG, "png_cropped": 1-bit PNG of the bounds only,
+# "rle": COCO compressed run-length encoding of the full frame
+MASK_FORMATS = ("png", "png_cropped", "rle")
+
+
+def mask_bounds(mask: np.ndarray) -> Dict[str, int]:
+    """Tight bounding box of a binary mask (the full frame if empty)."""
+    rows = np.any(mask, axis=1)
+    cols = np.any(mask, axis=0)
+
+    if not np.any(rows) or not np.any(cols):
+        return {"x": 0, "y": 0, "width": mask.shape[1], "height": mask.shape[0]}
+
+    rmin, rmax = np.where(rows)[0][[0, -1]]
+    cmin, cmax = np.where(cols)[0][[0, -1]]
+    return {
+        "x": int(cmin),
+        "y": int(rmin),
+        "width": int(cmax - cmin + 1),
+        "height": int(rmax - rmin + 1)
+    }
+
+
+def rle_counts(mask: np.ndarray) -> np.ndarray:
+    """Column-major run lengths, starting with a (possibly empty) run of zeros."""
+    flat = np.asarray(mask, dtype=bool).ravel(order='F')
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate([[0], changes, [flat.size]])
+    counts = np.diff(boundaries)
+    if flat.size and flat[0]:
+        counts = np.concatenate([[0], counts])
+    return counts
+
+
+def encode_mask_rle(mask: np.ndarray) -> Dict[str, Any]:
+    """
+    COCO compressed RLE ({"size": [h, w], "counts": str}).
+
+    Same string format as pycocotools' rleToString: each count (delta-coded
+    against the count two runs back) in 5-bit groups offset by 48.
+    """
+    counts = rle_counts(mask).tolist()
+    chars = []
+
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+
+    return {"size": [int(mask.shape[0]), int(mask.shape[1])], "counts": "".join(chars)}
+
+
+def _encode_png(mask: np.ndarray, mode: str) -> str:
+    from PIL import Image
+
+    if mode == '1':
+        pil_mask = Image.fromarray(np.ascontiguousarray(mask, dtype=bool))
+    else:
+        pil_mask = Image.fromarray(mask.astype(np.uint8) * 255, mode='L')
+
+    buffer = io.BytesIO()
+    pil_mask.save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+def encode_mask(mask: np.ndarray, mask_format: str = "png") -> Tuple[Any, Dict[str, int]]:
+    """
+    Encode a binary mask for a segmentation response.
+
+    Args:
+        mask: [H, W] bool mask
+        mask_format: One of MASK_FORMATS
+
+    Returns:
+        Tuple of (encoded mask, bounds). For "png_cropped" the PNG covers
+        only the bounds rectangle; place it at (bounds.x, bounds.y).
+    """
+    bounds = mask_bounds(mask)
+
+    if mask_format == "png":
+        return _encode_png(mask, 'L'), bounds
+
+    if mask_format == "png_cropped":
+        x, y = bounds["x"], bounds["y"]
+        crop = mask[y:y + bounds["height"], x:x + bounds["width"]]
+        return _encode_png(crop, '1'), bounds
+
+    if mask_format == "rle":
+        return encode_mask_rle(mask), bounds
+
+    raise ValueError(f"Unknown mask format: {mask_format}")
+
+
+# ============================================================================
+# Segment-everything mask index
+# ============================================================================
+
+# Number of per-image mask indexes kept
+MASK_INDEX_CACHE_SIZE = 8
+
+
+class MaskIndex:
+    """
+    Point-queryable index over automatic ("segment everything") masks.
+
+    Masks are sorted by area, largest first, and a mask's id is its position
+    in that order. Each mask is stored cropped to its bounds, so a lookup is
+    a vectorized bounding-box test followed by one pixel read per candidate.
+    The label raster holds the id of the smallest mask covering each pixel,
+    the usual hover-highlight target.
+    """
+
+    def __init__(self, masks: List[Dict[str, Any]], shape: Tuple[int, int]):
+        """
+        Build the index.
+
+        Args:
+            masks: [{"mask": [H, W] bool, "area": int, "score": float, "stability": float}, ...]
+            shape: (height, width) of the source image
+        """
+        self.shape = tuple(shape)
+        self.entries: List[Dict[str, Any]] = []
+        ordered = sorted(masks, key=lambda m: m['area'], reverse=True)
+
+        boxes = np.zeros((len(ordered), 4), dtype=np.int32)
+        raster_dtype = np.int16 if len(ordered) < np.iinfo(np.int16).max else np.int32
+        self.label_raster = np.full(self.shape, -1, dtype=raster_dtype)
+
+        for mask_id, mask_data in enumerate(ordered):
+            mask = np.asarray(mask_data['mask'], dtype=bool)
+            bounds = mask_bounds(mask)
+            x, y, w, h = bounds["x"], bounds["y"], bounds["width"], bounds["height"]
+            crop = mask[y:y + h, x:x + w]
+
+            boxes[mask_id] = (x, y, x + w, y + h)
+            # Smaller masks are painted later and end up on top
+            self.label_raster[y:y + h, x:x + w][crop] = mask_id
+
+            self.entries.append({
+                "area": int(mask_data['area']),
+                "score": float(mask_data.get('score', 1.0)),
+                "stability": float(mask_data.get('stability', 1.0)),
+                "bounds": bounds,
+                "crop": crop
+            })
+
+        self.boxes = boxes
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def mask(self, mask_id: int) -> np.ndarray:
+        """Full-frame bool mask for one id."""
+        entry = self.entries[mask_id]
+        bounds = entry["bounds"]
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[bounds["y"]:bounds["y"] + bounds["height"], bounds["x"]:bounds["x"] + bounds["width"]] = entry["crop"]
+        return mask
+
+    def top(self, x: int, y: int) -> int:
+        """Id of the smallest mask containing (x, y), or -1."""
+        if not (0 <= x < self.shape[1] and 0 <= y < self.shape[0]):
+            return -1
+        return int(self.label_raster[y, x])
+
+    def lookup(self, x: int, y: int) -> List[int]:
+        """Ids of all masks containing (x, y), smallest (innermost) first."""
+        inside = (
+            (self.boxes[:, 0] <= x) & (x < self.boxes[:, 2]) &
+            (self.boxes[:, 1] <= y) & (y < self.boxes[:, 3])
+        )
+
+        hits = []
+        for mask_id in np.flatnonzero(inside)[::-1]:
+            x0, y0 = self.boxes[mask_id, 0], self.boxes[mask_id, 1]
+            if self.entries[mask_id]["crop"][y - y0, x - x0]:
+                hits.append(int(mask_id))
+        return hits
+
+
+_mask_index_cache = LRUCache(max_entries=MASK_INDEX_CACHE_SIZE)
+
+
+def cache_mask_index(key: str, index: MaskIndex) -> None:
+    """Keep a mask index for an image hash (LRU, MASK_INDEX_CACHE_SIZE entries)."""
+    _mask_index_cache.put(key, index)
+
+
+def get_mask_index(key: str) -> Optional[MaskIndex]:
+    """Mask index for an image hash, or None if none was built (or it was evicted)."""
+    return _mask_index_cache.get(key)
+
+
+def clear_model_caches() -> None:
+    """Drop everything derived from the current segmentation model."""
+    _embedding_cache.clear()
+    _mask_index_cache.clear()
+
+
+# ============================================================================
+# CPU fallback - connected region growing and superpixel index
+# ============================================================================
+
+# Number of superpixel indexes kept (one per image/algorithm/parameters)
+SUPERPIXEL_CACHE_SIZE = 8
+
+
+def _seed_pixel(image_np: np.ndarray, point: List[float]) -> Tuple[int, int]:
+    """Clamp a click position to valid (row, col) pixel coordinates."""
+    x = min(max(int(point[0]), 0), image_np.shape[1] - 1)
+    y = min(max(int(point[1]), 0), image_np.shape[0] - 1)
+    return y, x
+
+
+def _grow_from_seed(image_i32: np.ndarray, row: int, col: int, tolerance: float) -> np.ndarray:
+    """Connected component of pixels within tolerance of the seed color."""
+    from scipy import ndimage
+
+    # Squared integer distance avoids a float sqrt over the whole frame
+    diff = image_i32 - image_i32[row, col]
+    similar = np.einsum('ijk,ijk->ij', diff, diff) <= tolerance * tolerance
+
+    components, _ = ndimage.label(similar)
+    return components == components[row, col]
+
+
+def region_grow_mask(
+    image_np: np.ndarray,
+    points: List[List[float]],
+    labels: Optional[List[int]] = None,
+    tolerance: float = 30
+) -> np.ndarray:
+    """
+    Select the connected similar-color region under each clicked point.
+
+    Foreground points (label 1) add their region, background points
+    (label 0) remove theirs.
+
+    Args:
+        image_np: [H, W, 3] uint8 RGB image
+        points: [[x, y], ...] click positions
+        labels: 1 = foreground, 0 = background (default all foreground)
+        tolerance: Maximum RGB distance from the seed color
+
+    Returns:
+        [H, W] bool mask
+    """
+    labels = labels or [1] * len(points)
+    image_i32 = image_np[..., :3].astype(np.int32)
+
+    mask = np.zeros(image_np.shape[:2], dtype=bool)
+    for label in (1, 0):
+        for point, point_label in zip(points, labels):
+            if point_label != label:
+                continue
+            region = _grow_from_seed(image_i32, *_seed_pixel(image_np, point), tolerance)
+            if label:
+                mask |= region
+            else:
+                mask &= ~region
+
+    return mask
+
+
+class SuperpixelIndex:
+    """
+    Superpixel over-segmentation of one image for fast click selection.
+
+    Built once per image: a label raster, the mean color of each superpixel
+    and the superpixel adjacency graph. A click then grows a selection over
+    neighbouring superpixels of similar mean color in O(superpixels + edges),
+    and the mask is a single lookup through the label raster.
+    """
+
+    def __init__(self, image_np: np.ndarray, algorithm: str = "slic", n_segments: int = 1500):
+        """
+        Build the index (requires scikit-image).
+
+        Args:
+            image_np: [H, W, 3] uint8 RGB image
+            algorithm: 'slic' or 'felzenszwalb'
+            n_segments: Approximate superpixel count (SLIC; sets the scale for felzenszwalb)
+        """
+        from skimage.segmentation import slic, felzenszwalb
+
+        image = image_np[..., :3]
+        if algorithm == "felzenszwalb":
+            scale = max(image.shape[0] * image.shape[1] / max(n_segments, 1) / 4, 1)
+            raster = felzenszwalb(image, scale=scale, sigma=0.8, min_size=20)
+        elif algorithm == "slic":
+            raster = slic(image, n_segments=n_segments, compactness=10, start_label=0)
+        else:
+            raise ValueError(f"Unknown superpixel algorithm: {algorithm}")
+
+        # Relabel to a dense 0..S-1 range
+        _, raster = np.unique(raster, return_inverse=True)
+        self.labels = raster.reshape(image.shape[:2]).astype(np.int32)
+        self.num_superpixels = int(self.labels.max()) + 1
+
+        flat = self.labels.ravel()
+        counts = np.bincount(flat, minlength=self.num_superpixels)[:, None]
+        self.mean_colors = np.stack([
+            np.bincount(flat, weights=image[..., c].ravel(), minlength=self.num_superpixels)
+            for c in range(3)
+        ], axis=1) / np.maximum(counts, 1)
+
+        self.adjacency = self._build_adjacency()
+
+    def _build_adjacency(self):
+        """Sparse symmetric adjacency between 4-connected superpixels."""
+        from scipy import sparse
+
+        pairs = []
+        for a, b in ((self.labels[:, :-1], self.labels[:, 1:]), (self.labels[:-1, :], self.labels[1:, :])):
+            boundary = a != b
+            pairs.append(np.stack([a[boundary], b[boundary]], axis=1))
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+
+        n = self.num_superpixels
+        ones = np.ones(len(pairs), dtype=np.int8)
+        graph = sparse.coo_matrix((ones, (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+        return (graph + graph.T).tocsr()
+
+    def grow(self, superpixel: int, tolerance: float) -> np.ndarray:
+        """Boolean [S] selection: similar-colored superpixels connected to the seed."""
+        from scipy.sparse import csgraph
+
+        distance = np.linalg.norm(self.mean_colors - self.mean_colors[superpixel], axis=1)
+        candidates = distance <= tolerance
+
+        # Components of the graph restricted to candidates; keep the seed's
+        nodes = np.flatnonzero(candidates)
+        subgraph = self.adjacency[nodes][:, nodes]
+        _, component = csgraph.connected_components(subgraph, directed=False)
+
+        seed_component = component[np.searchsorted(nodes, superpixel)]
+        selected = np.zeros(self.num_superpixels, dtype=bool)
+        selected[nodes[component == seed_component]] = True
+        return selected
+
+    def select(
+        self,
+        points: List[List[float]],
+        labels: Optional[List[int]] = None,
+        tolerance: float = 30
+    ) -> np.ndarray:
+        """Union/subtract grown superpixel selections for each click; returns an [H, W] bool mask."""
+        labels = labels or [1] * len(points)
+        selected = np.zeros(self.num_superpixels, dtype=bool)
+
+        for label in (1, 0):
+            for point, point_label in zip(points, labels):
+                if point_label != label:
+                    continue
+                row, col = _seed_pixel(self.labels, point)
+                region = self.grow(self.labels[row, col], tolerance)
+                if label:
+                    selected |= region
+                else:
+                    selected &= ~region
+
+        return selected[self.labels]
+
+
+_superpixel_cache = LRUCache(max_entries=SUPERPIXEL_CACHE_SIZE)
+
+
+def get_superpixel_index(
+    image_np: np.ndarray,
+    algorithm: str = "slic",
+    n_segments: int = 1500,
+    key: Optional[str] = None
+) -> SuperpixelIndex:
+    """Superpixel index for an image, built on first use and kept in a small LRU."""
+    cache_key = (key or image_hash(image_np), algorithm, int(n_segments))
+
+    index = _superpixel_cache.get(cache_key)
+    if index is None:
+        index = SuperpixelIndex(image_np, algorithm, n_segments)
+        _superpixel_cache.put(cache_key, index)
+    return index
+
+
+# ============================================================================
+# SAM2 video propagation
+# ============================================================================
+
+# SAM2 video checkpoints (looked up in <models>/sam/) and their configs, best first
+SAM2_VIDEO_CHECKPOINTS = [
+    ("sam2.1_hiera_large.pt", "configs/sam2.1/sam2.1_hiera_l.yaml"),
+    ("sam2.1_hiera_base_plus.pt", "configs/sam2.1/sam2.1_hiera_b+.yaml"),
+    ("sam2.1_hiera_small.pt", "configs/sam2.1/sam2.1_hiera_s.yaml"),
+    ("sam2.1_hiera_tiny.pt", "configs/sam2.1/sam2.1_hiera_t.yaml"),
+    ("sam2_hiera_large.pt", "sam2_hiera_l.yaml"),
+    ("sam2_hiera_base_plus.pt", "sam2_hiera_b+.yaml"),
+    ("sam2_hiera_small.pt", "sam2_hiera_s.yaml"),
+    ("sam2_hiera_tiny.pt", "sam2_hiera_t.yaml"),
+]
+
+
+def _write_video_frames(frames: List[np.ndarray], directory: str) -> None:
+    """Write frames as <index>.jpg, the layout SAM2's video loader expects."""
+    from PIL import Image
+
+    for index, frame in enumerate(frames):
+        Image.fromarray(frame).save(os.path.join(directory, f"{index:05d}.jpg"), quality=95)
+
+
+def _add_video_prompt(predictor: Any, state: Any, prompt: Dict[str, Any]) -> None:
+    """Register one keyframe prompt (points and/or box) for one object."""
+    kwargs = {
+        "inference_state": state,
+        "frame_idx": int(prompt.get('frame', 0)),
+        "obj_id": int(prompt.get('obj_id', 1)),
+    }
+
+    points = prompt.get('points') or []
+    if points:
+        kwargs["points"] = np.array(points, dtype=np.float32)
+        kwargs["labels"] = np.array(prompt.get('labels') or [1] * len(points), dtype=np.int32)
+
+    if prompt.get('box') is not None:
+        kwargs["box"] = np.array(prompt['box'], dtype=np.float32)
+
+    # Older sam2 releases only have add_new_points (no box support)
+    add_prompt = getattr(predictor, "add_new_points_or_box", None) or predictor.add_new_points
+    add_prompt(**kwargs)
+
+
+def propagate_video_masks(
+    predictor: Any,
+    frames: List[np.ndarray],
+    prompts: List[Dict[str, Any]]
+) -> Iterator[Tuple[int, Dict[int, np.ndarray]]]:
+    """
+    Propagate keyframe prompts through a clip with the SAM2 video predictor.
+
+    Frames after the earliest keyframe are produced first (forward pass),
+    then frames before it (reverse pass), so results can be consumed while
+    propagation is still running.
+
+    Args:
+        predictor: SAM2VideoPredictor
+        frames: List of [H, W, 3] uint8 RGB frames
+        prompts: [{"frame": 0, "obj_id": 1, "points": [[x, y]], "labels": [1], "box": [...]}, ...]
+
+    Yields:
+        (frame_index, {obj_id: mask [H, W] bool})
+    """
+    import torch
+
+    first_keyframe = min(int(p.get('frame', 0)) for p in prompts)
+
+    # SAM2 loads videos from disk; use a private directory per request
+    with tempfile.TemporaryDirectory(prefix="lattice_sam2_") as frame_dir:
+        _write_video_frames(frames, frame_dir)
+
+        with torch.inference_mode():
+            state = predictor.init_state(video_path=frame_dir, offload_video_to_cpu=True)
+
+            try:
+                for prompt in prompts:
+                    _add_video_prompt(predictor, state, prompt)
+
+                passes = [False] + ([True] if first_keyframe > 0 else [])
+                for reverse in passes:
+                    for frame_index, obj_ids, mask_logits in predictor.propagate_in_video(
+                        state, start_frame_idx=first_keyframe, reverse=reverse
+                    ):
+                        # The keyframe itself is produced by both passes
+                        if reverse and frame_index == first_keyframe:
+                            continue
+
+                        masks = {
+                            int(obj_id): (mask_logits[i] > 0.0).squeeze(0).cpu().numpy()
+                            for i, obj_id in enumerate(obj_ids)
+                        }
+                        yield int(frame_index), masks
+            finally:
+                predictor.reset_state(state)
@@ -0,0 +1,1341 @@
+"""
+Lattice VLM Engine
+
+Inference worker for the /lattice/vlm routes in compositor_node.py.
+
+Qwen-VL generation runs on one dedicated worker thread fed by a bounded
+queue, so the aiohttp event loop (websockets, other Lattice routes,
+ComfyUI's own API) keeps serving while the model generates. Requests that
+are queued together with the same model and sampling settings are batched
+into a single generate() call. Every request carries a deadline and can be
+cancelled; a cancelled row stops generating at the next token.
+
+Streamed requests push text through a TextIteratorStreamer as it is
+decoded, and IntentStreamParser picks finished cameraIntents/splineIntents
+entries out of the partial JSON so clients can show them immediately.
+
+The system prompt is sent as its own chat turn, so every request starts
+with the same tokens. PromptPrefixCache keeps that prefix's past
+key/values per loaded model and prefill only runs the rest of the prompt.
+
+Images are resized once to the largest size whose visual-token count fits
+a budget on the model's patch grid, and the processed pixel tensors are
+cached per image hash, so repeated prompts on a frame skip preprocessing.
+
+With a JSON schema, JsonSchemaLogitsProcessor masks every token that would
+break the schema (checked with a character-level JsonSchemaMachine, over
+the most likely candidates first and the whole vocabulary only when none
+fit), and generation stops as soon as the top-level object closes or no
+valid continuation is left.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+import copy
+import json
+import uuid
+import weakref
+from collections import deque
+from concurrent.futures import Future
+from typing import Optional, Dict, Any, AsyncIterator, Callable, List, Tuple
+
+try:
+    from .lattice_cache import LRUCache
+except ImportError:
+    # Imported as a top-level module (tests, scripts/)
+    from lattice_cache import LRUCache
+
+logger = logging.getLogger("lattice.vlm")
+
+# Requests waiting for the worker (beyond this, submit() is refused)
+DEFAULT_VLM_QUEUE_SIZE = 16
+# Most prompts merged into one generate() call
+DEFAULT_VLM_MAX_BATCH = 4
+# How long the worker waits for more prompts to batch with the first one
+DEFAULT_VLM_BATCH_WAIT = 0.05
+# Seconds a request may spend queued plus generating
+DEFAULT_VLM_TIMEOUT = 300.0
+
+# Visual tokens per image; Qwen2-VL emits one per 28x28 pixels (14px
+# patches merged 2x2), so 1024 tokens is about 1036x774
+DEFAULT_VISUAL_TOKENS = 1024
+# Pixels per visual token side when the processor doesn't say
+DEFAULT_VISION_GRID = 28
+# Processed pixel tensors kept for repeat prompts on the same image
+VISION_CACHE_BYTES = 256 * 1024 * 1024
+
+# Constrained decoding: likeliest candidates checked per step (the whole
+# grammar-valid set is only built when none fit), longest whitespace run
+# between JSON tokens, longest number literal
+CONSTRAINT_TOP_K = 64
+MAX_JSON_WHITESPACE = 32
+MAX_JSON_NUMBER = 24
+
+
+class VLMQueueFull(RuntimeError):
+    """The worker queue is at capacity; retry later."""
+
+
+class VLMUnavailable(RuntimeError):
+    """The requested VLM could not be loaded."""
+
+
+class VLMCancelled(RuntimeError):
+    """The request was cancelled or hit its deadline before finishing."""
+
+
+class VLMRequest:
+    """
+    One prompt for the VLM worker.
+
+    Args:
+        model_name: Model to run (see compositor_node._load_vlm_model)
+        text: User-turn text
+        system: Optional system prompt, sent as its own turn (and cached
+            as a shared prefix)
+        image: Optional PIL image
+        image_key: Content hash of image, keys the processed-pixel cache
+        max_visual_tokens: Visual token budget for the image (None = no limit)
+        max_new_tokens: Generation limit for this request
+        temperature: Sampling temperature (0 = greedy)
+        schema: Optional JSON schema the output is constrained to
+        timeout: Seconds until the request is abandoned
+        request_id: Client-chosen id for /lattice/vlm/cancel
+        on_text: Optional callback for decoded text chunks as they are
+            generated (called on the worker thread)
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        text: str,
+        system: Optional[str] = None,
+        image: Any = None,
+        image_key: Optional[str] = None,
+        max_visual_tokens: Optional[int] = DEFAULT_VISUAL_TOKENS,
+        max_new_tokens: int = 2048,
+        temperature: float = 0.7,
+        schema: Optional[Dict[str, Any]] = None,
+        timeout: float = DEFAULT_VLM_TIMEOUT,
+        request_id: Optional[str] = None,
+        on_text: Optional[Callable[[str], None]] = None
+    ):
+        self.model_name = model_name
+        self.text = text
+        self.system = system
+        self.image = image
+        self.image_key = image_key
+        self.max_visual_tokens = max_visual_tokens
+        self.max_new_tokens = max(1, int(max_new_tokens))
+        self.temperature = float(temperature)
+        self.schema = schema
+        self.request_id = request_id or uuid.uuid4().hex
+        self.on_text = on_text
+        self.deadline = time.monotonic() + timeout
+        self.future: Future = Future()
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set() or time.monotonic() > self.deadline
+
+    @property
+    def batch_key(self) -> Tuple[Any, ...]:
+        """Requests with equal keys can share one generate() call."""
+        if self.on_text is not None:
+            # Streamers follow a single sequence, so streamed requests run alone
+            return (self.request_id,)
+        return (self.model_name, self.system, self.temperature, self.image is not None,
+                id(self.schema) if self.schema is not None else None)
+
+
+# ============================================================================
+# Visual token budget
+# ============================================================================
+
+def vision_grid(processor: Any) -> int:
+    """Pixels per visual token side: patch size x spatial merge size."""
+    image_processor = getattr(processor, 'image_processor', None)
+    patch = getattr(image_processor, 'patch_size', None)
+    merge = getattr(image_processor, 'merge_size', None)
+    if isinstance(patch, int) and isinstance(merge, int):
+        return patch * merge
+    return DEFAULT_VISION_GRID
+
+
+def fit_visual_budget(width: int, height: int, max_tokens: Optional[int], grid: int = DEFAULT_VISION_GRID) -> Tuple[int, int]:
+    """
+    Largest (width, height) on the token grid whose token count fits
+    max_tokens, keeping the aspect ratio and never upscaling past the
+    image's own size (rounded to the grid).
+
+    Args:
+        width, height: Source size in pixels
+        max_tokens: Visual token budget; None keeps the source size
+        grid: Pixels per token side
+
+    Returns:
+        Target (width, height), multiples of grid and at least 2 * grid
+    """
+    cols_max = max(2, round(width / grid))
+    rows_max = max(2, round(height / grid))
+    if max_tokens is None or cols_max * rows_max <= max_tokens:
+        return cols_max * grid, rows_max * grid
+
+    max_tokens = max(int(max_tokens), 4)
+    scale = (max_tokens / (cols_max * rows_max)) ** 0.5
+    cols = min(cols_max, max(2, int(width / grid * scale)))
+    rows = min(rows_max, max(2, int(height / grid * scale)))
+    while cols * rows > max_tokens and (cols > 2 or rows > 2):
+        if cols >= rows:
+            cols -= 1
+        else:
+            rows -= 1
+
+    # Flooring both sides can leave room for one more row or column
+    aspect = width / height
+    for _ in range(2):
+        grow_cols = (cols + 1) * rows <= max_tokens and cols < cols_max
+        grow_rows = cols * (rows + 1) <= max_tokens and rows < rows_max
+        if grow_cols and (not grow_rows or abs((cols + 1) / rows - aspect) <= abs(cols / (rows + 1) - aspect)):
+            cols += 1
+        elif grow_rows:
+            rows += 1
+    return cols * grid, rows * grid
+
+
+class VisionInputCache(LRUCache):
+    """
+    LRU cache of processed image inputs with a byte budget, keyed by image
+    content hash and token budget.
+
+    Entries are dicts: 'image' (the resized PIL image), 'pixel_values' and
+    'image_grid_thw' (processor output tensors, when the processor exposes
+    its image processor).
+    """
+
+    def __init__(self, max_bytes: int = VISION_CACHE_BYTES):
+        super().__init__(max_bytes=max_bytes)
+
+
+def prepare_image(processor: Any, request: VLMRequest, cache: Optional[VisionInputCache] = None) -> Dict[str, Any]:
+    """
+    Budget-resized image and processed pixel tensors for a request.
+
+    The image is resized once (bicubic) to fit_visual_budget() on the
+    processor's grid, so the processor's own resize is a no-op, then run
+    through the image processor. Both are cached per image_key, model,
+    grid and budget.
+    """
+    from PIL import Image
+
+    grid = vision_grid(processor)
+    key = None
+    if cache is not None and request.image_key:
+        key = f"{request.image_key}:{request.model_name}:{grid}:{request.max_visual_tokens}"
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+
+    image = request.image
+    size = fit_visual_budget(image.width, image.height, request.max_visual_tokens, grid)
+    if size != image.size:
+        image = image.resize(size, Image.BICUBIC)
+
+    entry = {"image": image}
+    image_processor = getattr(processor, 'image_processor', None)
+    if image_processor is not None:
+        processed = image_processor(images=[image], return_tensors="pt")
+        if "image_grid_thw" in processed:
+            entry["pixel_values"] = processed["pixel_values"]
+            entry["image_grid_thw"] = processed["image_grid_thw"]
+
+    if key is not None:
+        cache.put(key, entry)
+    return entry
+
+
+# ============================================================================
+# Generation
+# ============================================================================
+
+def _stopping_criteria(
+    requests: List[VLMRequest],
+    prompt_length: int,
+    constraint: Optional["JsonSchemaLogitsProcessor"] = None
+):
+    """
+    Per-row stop: a row finishes when its request is cancelled/expired,
+    reaches its own max_new_tokens (the batch runs to the largest one), or
+    closes its constrained JSON object.
+    """
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class RequestStop(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            generated = input_ids.shape[1] - prompt_length
+            if constraint is not None:
+                constraint.advance(input_ids)
+            return torch.tensor(
+                [r.cancelled or generated >= r.max_new_tokens
+                 or (constraint is not None and constraint.finished(row))
+                 for row, r in enumerate(requests)],
+                dtype=torch.bool, device=input_ids.device
+            )
+
+    return StoppingCriteriaList([RequestStop()])
+
+
+def _text_streamer(processor: Any, callback: Callable[[str], None]):
+    """
+    TextIteratorStreamer over the new tokens whose finalized chunks go
+    straight to callback, instead of a queue that needs a blocking reader.
+    """
+    from transformers import TextIteratorStreamer
+
+    class CallbackStreamer(TextIteratorStreamer):
+        def on_finalized_text(self, text: str, stream_end: bool = False):
+            if text:
+                callback(text)
+
+    tokenizer = getattr(processor, 'tokenizer', processor)
+    return CallbackStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+
+def _system_message(system: str) -> Dict[str, Any]:
+    return {"role": "system", "content": [{"type": "text", "text": system}]}
+
+
+def build_vlm_inputs(
+    processor: Any,
+    requests: List[VLMRequest],
+    vision_cache: Optional[VisionInputCache] = None
+) -> Dict[str, Any]:
+    """
+    Chat-templated, left-padded processor inputs for a batch of requests.
+
+    Images go through prepare_image(). When every image has cached pixel
+    tensors and the processor exposes its image token, the placeholders
+    are expanded here (one per visual token, as the Qwen-VL processor
+    does) and only the text is tokenized; otherwise the resized images go
+    through the full processor.
+    """
+    import torch
+
+    texts = []
+    prepared = []
+    for r in requests:
+        content = [{"type": "image", "image": r.image}] if r.image is not None else []
+        content.append({"type": "text", "text": r.text})
+        messages = [_system_message(r.system)] if r.system else []
+        messages.append({"role": "user", "content": content})
+        texts.append(processor.apply_chat_template(
+            messages,
+            tokenize=False,
+            add_generation_prompt=True
+        ))
+        if r.image is not None:
+            prepared.append(prepare_image(processor, r, vision_cache))
+
+    # Decoder-only batching needs the prompts right-aligned
+    tokenizer = getattr(processor, 'tokenizer', processor)
+    tokenizer.padding_side = 'left'
+
+    if not prepared:
+        return processor(text=texts, return_tensors="pt", padding=True)
+
+    image_token = getattr(processor, 'image_token', None)
+    merge = getattr(getattr(processor, 'image_processor', None), 'merge_size', None)
+    if image_token and isinstance(merge, int) and all("pixel_values" in entry for entry in prepared):
+        entries = iter(prepared)
+        expanded = []
+        for r, text in zip(requests, texts):
+            if r.image is not None:
+                tokens = int(next(entries)["image_grid_thw"].prod()) // (merge * merge)
+                text = text.replace(image_token, image_token * tokens, 1)
+            expanded.append(text)
+
+        inputs = dict(tokenizer(expanded, return_tensors="pt", padding=True))
+        inputs["pixel_values"] = torch.cat([entry["pixel_values"] for entry in prepared])
+        inputs["image_grid_thw"] = torch.cat([entry["image_grid_thw"] for entry in prepared])
+        return inputs
+
+    return processor(text=texts, images=[entry["image"] for entry in prepared], return_tensors="pt", padding=True)
+
+
+def generate_batch(
+    model: Any,
+    processor: Any,
+    requests: List[VLMRequest],
+    prefix_cache: Optional["PromptPrefixCache"] = None,
+    vision_cache: Optional[VisionInputCache] = None
+) -> List[str]:
+    """
+    Run one generate() call for requests sharing a batch_key.
+
+    With a prefix_cache and a system prompt, the prompt is prefilled on
+    top of the cached system-prompt key/values and generate() continues
+    from that cache.
+
+    Returns:
+        Decoded new text per request (prompt tokens excluded)
+    """
+    import torch
+
+    inputs = build_vlm_inputs(processor, requests, vision_cache)
+    device = next(model.parameters()).device
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+    prompt_length = inputs["input_ids"].shape[1]
+
+    extra = {}
+    if prefix_cache is not None and requests[0].system:
+        past = prefix_cache.prefill(model, processor, requests[0].system, inputs)
+        if past is not None:
+            extra["past_key_values"] = past
+
+    temperature = requests[0].temperature
+    tokenizer = getattr(processor, 'tokenizer', processor)
+    streamer = None
+    if len(requests) == 1 and requests[0].on_text is not None:
+        streamer = _text_streamer(processor, requests[0].on_text)
+
+    constraint = None
+    if requests[0].schema is not None:
+        from transformers import LogitsProcessorList
+
+        constraint = JsonSchemaLogitsProcessor(tokenizer, requests[0].schema, prompt_length, len(requests))
+        extra["logits_processor"] = LogitsProcessorList([constraint])
+
+    with torch.no_grad():
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max(r.max_new_tokens for r in requests),
+            do_sample=temperature > 0,
+            temperature=temperature if temperature > 0 else None,
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            stopping_criteria=_stopping_criteria(requests, prompt_length, constraint),
+            streamer=streamer,
+            **extra
+        )
+
+    return [
+        processor.decode(row[prompt_length:prompt_length + r.max_new_tokens], skip_special_tokens=True).strip()
+        for r, row in zip(requests, outputs)
+    ]
+
+
+# ============================================================================
+# Constrained decoding - JSON schema state machine
+# ============================================================================
+
+_ALL_TYPES = frozenset(("string", "number", "integer", "boolean", "null", "object", "array"))
+
+# Number literal grammar: (state, character class) -> next state
+_NUMBER_STEPS = {
+    ("start", "-"): "sign", ("start", "0"): "zero", ("start", "1"): "int",
+    ("sign", "0"): "zero", ("sign", "1"): "int",
+    ("zero", "."): "dot", ("zero", "e"): "e",
+    ("int", "0"): "int", ("int", "1"): "int", ("int", "."): "dot", ("int", "e"): "e",
+    ("dot", "0"): "frac", ("dot", "1"): "frac",
+    ("frac", "0"): "frac", ("frac", "1"): "frac", ("frac", "e"): "e",
+    ("e", "-"): "esign", ("e", "+"): "esign", ("e", "0"): "exp", ("e", "1"): "exp",
+    ("esign", "0"): "exp", ("esign", "1"): "exp",
+    ("exp", "0"): "exp", ("exp", "1"): "exp",
+}
+_NUMBER_ENDS = frozenset(("zero", "int", "frac", "exp"))
+_FRACTION_STATES = frozenset(("dot", "e"))
+
+
+def _number_class(ch: str) -> str:
+    if ch == "0":
+        return "0"
+    if "1" <= ch <= "9":
+        return "1"
+    if ch in "eE":
+        return "e"
+    return ch
+
+
+def _schema_types(schema: Dict[str, Any]) -> frozenset:
+    kind = schema.get("type")
+    if kind is None:
+        return frozenset(("string",)) if "enum" in schema else _ALL_TYPES
+    return frozenset((kind,)) if isinstance(kind, str) else frozenset(kind)
+
+
+class _Frame:
+    """One open JSON value: object, array, string, key, number or literal."""
+
+    __slots__ = ("kind", "schema", "state", "buf", "keys", "key", "escape")
+
+    def __init__(self, kind: str, schema: Dict[str, Any], state: str = "", buf: Any = ""):
+        self.kind = kind
+        self.schema = schema
+        self.state = state
+        self.buf = buf
+        self.keys = set() if kind == "object" else None
+        self.key = None
+        self.escape = 0  # 1 after a backslash, 2-5 while reading \uXXXX digits
+
+    def copy(self) -> "_Frame":
+        frame = _Frame.__new__(_Frame)
+        frame.kind, frame.schema, frame.state = self.kind, self.schema, self.state
+        frame.buf, frame.key, frame.escape = self.buf, self.key, self.escape
+        frame.keys = set(self.keys) if self.keys is not None else None
+        return frame
+
+
+class JsonSchemaMachine:
+    """
+    Character-level JSON recognizer constrained by a (subset of) JSON schema.
+
+    Supports "type" (single or list), "enum" of strings, "properties"
+    (the only keys allowed, each at most once), "required" (checked at
+    "}") and "items". feed() returns False as soon as text can no longer
+    lead to a valid document; done is set when the top-level value closes.
+    Whitespace runs are capped at MAX_JSON_WHITESPACE so the model can't
+    stall in indentation.
+    """
+
+    def __init__(self, schema: Dict[str, Any]):
+        self.schema = schema
+        self.stack: List[_Frame] = []
+        self.done = False
+        self.failed = False
+        self.whitespace = 0
+
+    def copy(self) -> "JsonSchemaMachine":
+        machine = JsonSchemaMachine.__new__(JsonSchemaMachine)
+        machine.schema, machine.done, machine.failed = self.schema, self.done, self.failed
+        machine.whitespace = self.whitespace
+        machine.stack = [frame.copy() for frame in self.stack]
+        return machine
+
+    def feed(self, text: str) -> bool:
+        if self.failed:
+            return False
+        for ch in text:
+            if not self._char(ch):
+                self.failed = True
+                return False
+        return True
+
+    # -- internals ----------------------------------------------------------
+
+    def _space(self) -> bool:
+        self.whitespace += 1
+        return self.whitespace <= MAX_JSON_WHITESPACE
+
+    def _close(self) -> None:
+        """Pop a finished value; its parent already expects what follows it."""
+        self.stack.pop()
+        if not self.stack:
+            self.done = True
+
+    def _start_value(self, schema: Dict[str, Any], ch: str) -> bool:
+        types = _schema_types(schema)
+        if ch == "{" and "object" in types:
+            self.stack.append(_Frame("object", schema, "start"))
+        elif ch == "[" and "array" in types:
+            self.stack.append(_Frame("array", schema, "start"))
+        elif ch == '"' and "string" in types:
+            self.stack.append(_Frame("string", schema))
+        elif (ch == "-" or ch.isdigit()) and types & {"number", "integer"}:
+            frame = _Frame("number", schema, "start", 0)
+            self.stack.append(frame)
+            return self._number(frame, ch)
+        elif ch == "t" and "boolean" in types:
+            self.stack.append(_Frame("literal", schema, buf="rue"))
+        elif ch == "f" and "boolean" in types:
+            self.stack.append(_Frame("literal", schema, buf="alse"))
+        elif ch == "n" and "null" in types:
+            self.stack.append(_Frame("literal", schema, buf="ull"))
+        else:
+            return False
+        return True
+
+    def _number(self, frame: _Frame, ch: str) -> bool:
+        state = _NUMBER_STEPS.get((frame.state, _number_class(ch)))
+        if state is None or frame.buf >= MAX_JSON_NUMBER:
+            return False
+        if state in _FRACTION_STATES and "number" not in _schema_types(frame.schema):
+            return False  # integers take no fraction or exponent
+        frame.state, frame.buf = state, frame.buf + 1
+        return True
+
+    def _string(self, frame: _Frame, ch: str) -> bool:
+        if frame.escape == 1:
+            if ch == "u":
+                frame.escape = 5
+            elif ch in '"\\/bfnrt':
+                frame.escape = 0
+            else:
+                return False
+            return True
+        if frame.escape:
+            if ch not in "0123456789abcdefABCDEF":
+                return False
+            frame.escape = 0 if frame.escape == 2 else frame.escape - 1
+            return True
+        if ch == "\\":
+            # Enum values and keys are matched literally, without escapes
+            if frame.kind == "key" or "enum" in frame.schema:
+                return False
+            frame.escape = 1
+            return True
+        if ch < " ":
+            return False
+
+        if frame.kind == "key":
+            parent = self.stack[-2]
+            allowed = [k for k in parent.schema.get("properties", {}) if k not in parent.keys]
+        else:
+            allowed = frame.schema.get("enum")
+
+        if ch == '"':
+            if allowed is not None and frame.buf not in allowed:
+                return False
+            self.stack.pop()
+            if frame.kind == "key":
+                parent.key = frame.buf
+                parent.keys.add(frame.buf)
+                parent.state = "colon"
+            elif not self.stack:
+                self.done = True
+            return True
+
+        if allowed is not None:
+            prefix = frame.buf + ch
+            if not any(value.startswith(prefix) for value in allowed):
+                return False
+            frame.buf = prefix
+        return True
+
+    def _char(self, ch: str) -> bool:
+        if self.done:
+            return ch in " \t\n\r"
+
+        if not self.stack:
+            if ch in " \t\n\r":
+                return self._space()
+            self.whitespace = 0
+            return ch == "{" and "object" in _schema_types(self.schema) and self._start_value(self.schema, ch)
+
+        frame = self.stack[-1]
+        if frame.kind in ("string", "key"):
+            return self._string(frame, ch)
+        if frame.kind == "literal":
+            if not ch == frame.buf[:1]:
+                return False
+            frame.buf = frame.buf[1:]
+            if not frame.buf:
+                self._close()
+            return True
+        if frame.kind == "number":
+            if self._number(frame, ch):
+                return True
+            if frame.state not in _NUMBER_ENDS:
+                return False
+            # The number ended; this character belongs to its parent
+            self._close()
+            return self._char(ch)
+
+        if ch in " \t\n\r":
+            return self._space()
+        self.whitespace = 0
+
+        if frame.kind == "object":
+            properties = frame.schema.get("properties", {})
+            if frame.state in ("start", "next_key") and ch == '"':
+                if len(frame.keys) == len(properties):
+                    return False
+                self.stack.append(_Frame("key", frame.schema))
+                return True
+            if frame.state == "colon":
+                if ch != ":":
+                    return False
+                frame.state = "value"
+                return True
+            if frame.state == "value":
+                frame.state = "after_value"
+                return self._start_value(properties[frame.key], ch)
+            if frame.state == "after_value" and ch == "," and len(frame.keys) < len(properties):
+                frame.state = "next_key"
+                return True
+            if frame.state in ("start", "after_value") and ch == "}":
+                if not set(frame.schema.get("required", ())) <= frame.keys:
+                    return False
+                self._close()
+                return True
+            return False
+
+        # Array
+        if frame.state in ("start", "after_value") and ch == "]":
+            self._close()
+            return True
+        if frame.state == "after_value":
+            if ch != ",":
+                return False
+            frame.state = "value"
+            return True
+        frame.state = "after_value"
+        return self._start_value(frame.schema.get("items", {}), ch)
+
+
+# Decoded text per token id, and token ids per first character, per tokenizer
+_token_texts: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_token_first_chars: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+class JsonSchemaLogitsProcessor:
+    """
+    Logits processor that keeps each batch row inside a JSON schema.
+
+    Every step, the row's JsonSchemaMachine is advanced by the token just
+    generated; then the CONSTRAINT_TOP_K highest-scoring candidates are
+    tried on a copy of it. When none of them fit, the allowed set is every
+    token the grammar accepts next: tokens whose first character the
+    machine takes, each checked in full. All other tokens are masked.
+
+    EOS is only allowed once the top-level object has closed. A row with no
+    valid continuation fails closed: only EOS remains and finished() ends
+    it, so unconstrained text is never sampled.
+    """
+
+    def __init__(self, tokenizer: Any, schema: Dict[str, Any], prompt_length: int, batch_size: int,
+                 top_k: int = CONSTRAINT_TOP_K):
+        self.tokenizer = tokenizer
+        self.machines = [JsonSchemaMachine(schema) for _ in range(batch_size)]
+        self.position = prompt_length
+        self.top_k = top_k
+
+        eos = tokenizer.eos_token_id
+        self.eos_ids = [eos] if isinstance(eos, int) else list(eos or [])
+        self.special_ids = set(getattr(tokenizer, 'all_special_ids', None) or []) | set(self.eos_ids)
+        try:
+            self.texts = _token_texts.setdefault(tokenizer, {})
+            self.first_chars = _token_first_chars.setdefault(tokenizer, {})
+        except TypeError:
+            self.texts = {}
+            self.first_chars = {}
+
+    def _text(self, token_id: int) -> str:
+        text = self.texts.get(token_id)
+        if text is None:
+            text = "" if token_id in self.special_ids else self.tokenizer.decode([token_id], skip_special_tokens=False)
+            self.texts[token_id] = text
+        return text
+
+    def advance(self, input_ids: Any) -> None:
+        """Feed tokens generated since the last call (idempotent per length)."""
+        end = input_ids.shape[1]
+        for position in range(self.position, end):
+            for row, machine in enumerate(self.machines):
+                if machine.done or machine.failed:
+                    continue
+                token_id = int(input_ids[row, position])
+                if token_id in self.special_ids:
+                    machine.failed = True
+                else:
+                    machine.feed(self._text(token_id))
+        self.position = max(self.position, end)
+
+    def finished(self, row: int) -> bool:
+        machine = self.machines[row]
+        return machine.done or machine.failed
+
+    def _fits(self, machine: JsonSchemaMachine, token_id: int) -> bool:
+        text = self._text(token_id)
+        return bool(text) and machine.copy().feed(text)
+
+    def _tokens_by_first_char(self, vocab: int) -> Dict[str, List[int]]:
+        """Token ids grouped by the first character of their text (built once per tokenizer)."""
+        index = self.first_chars.get(vocab)
+        if index is None:
+            index = {}
+            for token_id in range(vocab):
+                text = self._text(token_id)
+                if text:
+                    index.setdefault(text[0], []).append(token_id)
+            self.first_chars[vocab] = index
+        return index
+
+    def _allowed(self, machine: JsonSchemaMachine, row_scores: Any) -> List[int]:
+        vocab = row_scores.shape[-1]
+        # Usually one of the likeliest tokens fits
+        candidates = row_scores.topk(min(self.top_k, vocab)).indices.tolist()
+        valid = [t for t in candidates if self._fits(machine, t)]
+        if valid:
+            return valid
+
+        # Otherwise allow exactly the tokens the grammar accepts next
+        valid = []
+        for ch, token_ids in self._tokens_by_first_char(vocab).items():
+            if machine.copy().feed(ch):
+                valid.extend(t for t in token_ids if self._fits(machine, t))
+        return valid
+
+    def __call__(self, input_ids: Any, scores: Any) -> Any:
+        import torch
+
+        self.advance(input_ids)
+        mask = torch.full_like(scores, float("-inf"))
+        for row, machine in enumerate(self.machines):
+            allowed = [] if machine.done or machine.failed else self._allowed(machine, scores[row])
+            if not allowed:
+                # Closed, or no valid continuation (fail closed): only EOS remains
+                machine.failed = machine.failed or not machine.done
+                allowed = self.eos_ids
+            mask[row, allowed] = 0
+        return scores + mask
+
+
+# ============================================================================
+# Shared prompt prefix cache
+# ============================================================================
+
+def _rope_modules(model: Any) -> List[Any]:
+    """The model and its inner model, whichever exist (Qwen-VL keeps rope state on one)."""
+    inner = getattr(model, 'model', None)
+    return [model] + ([inner] if inner is not None else [])
+
+
+def _prefill(model: Any, inputs: Dict[str, Any], past: Any, start: int, end: int) -> Any:
+    """
+    Run prompt tokens [start, end) on top of past (holding [0, start)).
+
+    Qwen2/3-VL use 3-D multimodal rope positions that depend on the whole
+    prompt, so they are computed over the full prompt with get_rope_index()
+    and sliced; the model's rope_deltas are set for the decode steps that
+    generate() runs afterwards. Other models take positions from
+    cache_position.
+    """
+    import torch
+
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs.get("attention_mask")
+    kwargs = {k: v for k, v in inputs.items() if k not in ("input_ids", "attention_mask")}
+
+    for module in _rope_modules(model):
+        get_rope_index = getattr(module, 'get_rope_index', None)
+        if get_rope_index is not None:
+            position_ids, rope_deltas = get_rope_index(
+                input_ids, inputs.get("image_grid_thw"), inputs.get("video_grid_thw"), attention_mask)
+            kwargs["position_ids"] = position_ids[..., start:end]
+            for target in _rope_modules(model):
+                if hasattr(target, 'rope_deltas'):
+                    target.rope_deltas = rope_deltas
+            break
+
+    return model(
+        input_ids=input_ids[:, start:end],
+        attention_mask=attention_mask[:, :end] if attention_mask is not None else None,
+        past_key_values=past,
+        cache_position=torch.arange(start, end, device=input_ids.device),
+        use_cache=True,
+        **kwargs
+    )
+
+
+class PromptPrefixCache:
+    """
+    Past key/values of the fixed system-prompt prefix, per loaded model.
+
+    The prefix is the chat template rendered for the system turn alone.
+    It is encoded once; each request copies that cache, prefills the rest
+    of its prompt except the last token, and generate() continues from
+    there.
+
+    The first cached prefill for a model is checked against a full
+    prefill of the same prompt. If the next-token logits disagree, the
+    cache is disabled for that model. Batches with left padding (prompts
+    of unequal length) don't start with the prefix, so they skip the
+    cache.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._model = None
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.cached_prefill_ms = 0.0
+
+    def _entry(self, model: Any, processor: Any, system: str) -> Dict[str, Any]:
+        import torch
+        from transformers import DynamicCache
+
+        if model is not self._model:
+            with self._lock:
+                self._model = model
+                self._entries.clear()
+
+        entry = self._entries.get(system)
+        if entry is None:
+            tokenizer = getattr(processor, 'tokenizer', processor)
+            text = processor.apply_chat_template(
+                [_system_message(system)], tokenize=False, add_generation_prompt=False)
+            device = next(model.parameters()).device
+            ids = tokenizer(text, return_tensors="pt", add_special_tokens=False)["input_ids"].to(device)
+
+            start = time.perf_counter()
+            past = DynamicCache()
+            with torch.no_grad():
+                model(input_ids=ids, past_key_values=past, use_cache=True,
+                      cache_position=torch.arange(ids.shape[1], device=device))
+            entry = {
+                "ids": ids,
+                "past": past,
+                "build_ms": (time.perf_counter() - start) * 1000,
+                "verified": False,
+                "usable": True,
+                "full_prefill_ms": None,
+            }
+            with self._lock:
+                self._entries[system] = entry
+            logger.info("Cached %d-token system prompt prefix in %.0f ms", ids.shape[1], entry["build_ms"])
+        return entry
+
+    def prefill(self, model: Any, processor: Any, system: str, inputs: Dict[str, Any]) -> Optional[Any]:
+        """
+        Prefill inputs (all but the last prompt token) on the cached prefix.
+        Called from the worker thread only; the lock just guards stats().
+
+        Returns:
+            The cache to pass to generate() as past_key_values, or None to
+            run without it
+        """
+        import torch
+        from transformers import DynamicCache
+
+        if not self.enabled:
+            return None
+
+        entry = self._entry(model, processor, system)
+        input_ids = inputs["input_ids"]
+        mask = inputs.get("attention_mask")
+        prefix_length = entry["ids"].shape[1]
+        if (not entry["usable"]
+                or input_ids.shape[1] <= prefix_length + 1
+                or (mask is not None and not bool(mask.all()))
+                or not torch.equal(input_ids[:, :prefix_length], entry["ids"].expand(input_ids.shape[0], -1))):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        past = copy.deepcopy(entry["past"])
+        if input_ids.shape[0] > 1:
+            past.batch_repeat_interleave(input_ids.shape[0])
+
+        end = input_ids.shape[1] - 1
+        start = time.perf_counter()
+        with torch.no_grad():
+            cached = _prefill(model, inputs, past, prefix_length, end)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        if not entry["verified"]:
+            start = time.perf_counter()
+            with torch.no_grad():
+                full = _prefill(model, inputs, DynamicCache(), 0, end)
+            full_ms = (time.perf_counter() - start) * 1000
+
+            a, b = cached.logits[:, -1].float(), full.logits[:, -1].float()
+            error = float((a - b).abs().max() / b.abs().max().clamp_min(1e-6))
+            with self._lock:
+                entry["verified"] = True
+                entry["full_prefill_ms"] = full_ms
+                if error > 1e-2 or not torch.equal(a.argmax(-1), b.argmax(-1)):
+                    logger.warning("Prefix cache disabled: cached prefill diverges (relative error %.3g)", error)
+                    entry["usable"] = False
+                    self.misses += 1
+                    return full.past_key_values
+
+        with self._lock:
+            self.hits += 1
+            self.cached_prefill_ms += elapsed
+        return past
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = list(self._entries.values())
+            built = sum(e["build_ms"] for e in entries)
+            return {
+                "enabled": self.enabled,
+                "entries": len(entries),
+                "prefix_tokens": [int(e["ids"].shape[1]) for e in entries],
+                "usable": [e["usable"] for e in entries],
+                "hits": self.hits,
+                "misses": self.misses,
+                "prefix_build_ms": round(built, 1),
+                # Measured once per prefix: full prompt prefill vs. prefill on the cache
+                "full_prefill_ms": [None if e["full_prefill_ms"] is None else round(e["full_prefill_ms"], 1)
+                                    for e in entries],
+                "mean_cached_prefill_ms": round(self.cached_prefill_ms / self.hits, 1) if self.hits else None,
+                # Prefix encoding skipped on every hit
+                "estimated_saved_ms": round(self.hits * built / max(len(entries), 1), 1),
+            }
+
+
+# ============================================================================
+# Worker
+# ============================================================================
+
+class VLMWorker:
+    """
+    Single-thread VLM inference queue with dynamic batching.
+
+    The thread starts on the first submit(). It takes the oldest request,
+    waits up to batch_wait for more with the same batch_key (up to
+    max_batch), and runs them as one generate() call. Requests with other
+    keys keep their place for the next round.
+    """
+
+    def __init__(
+        self,
+        load_model: Callable[[str], Tuple[Any, Any]],
+        queue_size: int = DEFAULT_VLM_QUEUE_SIZE,
+        max_batch: int = DEFAULT_VLM_MAX_BATCH,
+        batch_wait: float = DEFAULT_VLM_BATCH_WAIT
+    ):
+        """
+        Args:
+            load_model: model_name -> (model, processor), or (None, None)
+                when unavailable. Always called on the worker thread.
+            queue_size: Max queued requests
+            max_batch: Max requests per generate() call
+            batch_wait: Seconds to wait for batch mates
+        """
+        self.load_model = load_model
+        self.prefix_cache = PromptPrefixCache()
+        self.vision_cache = VisionInputCache()
+        self.queue_size = queue_size
+        self.max_batch = max(1, max_batch)
+        self.batch_wait = batch_wait
+
+        self._queue: "queue.Queue[VLMRequest]" = queue.Queue(maxsize=queue_size)
+        self._held: "deque[VLMRequest]" = deque()
+        self._requests: Dict[str, VLMRequest] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.batches = 0
+        self.batched_requests = 0
+
+    # -- client side --------------------------------------------------------
+
+    def submit(self, request: VLMRequest) -> Future:
+        """Queue a request; raises VLMQueueFull when the queue is at capacity."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lattice-vlm", daemon=True)
+                self._thread.start()
+            if len(self._held) + self._queue.qsize() >= self.queue_size:
+                raise VLMQueueFull(f"VLM queue full ({self.queue_size} requests waiting)")
+            self._requests[request.request_id] = request
+            self._queue.put_nowait(request)
+        return request.future
+
+    async def run(self, request: VLMRequest) -> str:
+        """
+        Submit and await a request from the event loop.
+
+        The request is cancelled if the awaiting task is cancelled (client
+        disconnect) or its deadline passes.
+        """
+        future = asyncio.wrap_future(self.submit(request))
+        try:
+            return await asyncio.wait_for(future, max(0.0, request.deadline - time.monotonic()))
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            request.cancel()
+            raise
+
+    def stream(self, request: VLMRequest) -> AsyncIterator[str]:
+        """
+        Submit a request and return an async iterator over its text chunks
+        as they are generated. Call from the event loop.
+
+        Raises VLMQueueFull right away when the queue is at capacity. The
+        iterator raises asyncio.TimeoutError at the deadline and worker
+        errors once generation ends; abandoning it cancels the request.
+        """
+        loop = asyncio.get_event_loop()
+        chunks: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+
+        request.on_text = lambda text: loop.call_soon_threadsafe(chunks.put_nowait, text)
+        future = self.submit(request)
+        # Queued after every chunk: both are scheduled from the worker thread in order
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(chunks.put_nowait, None))
+        return self._drain(request, chunks)
+
+    async def _drain(self, request: VLMRequest, chunks: "asyncio.Queue[Optional[str]]") -> AsyncIterator[str]:
+        try:
+            while True:
+                chunk = await asyncio.wait_for(
+                    chunks.get(), max(0.0, request.deadline - time.monotonic()))
+                if chunk is None:
+                    break
+                yield chunk
+        except BaseException:
+            request.cancel()
+            raise
+
+        request.future.result()
+
+    def cancel(self, request_id: str) -> bool:
+        """Cancel a queued or running request by id."""
+        with self._lock:
+            request = self._requests.get(request_id)
+        if request is None:
+            return False
+        request.cancel()
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize() + len(self._held),
+                "queue_size": self.queue_size,
+                "active": self.active,
+                "max_batch": self.max_batch,
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "batches": self.batches,
+                "mean_batch_size": round(self.batched_requests / self.batches, 2) if self.batches else 0.0
+            }
+
+    # -- worker thread ------------------------------------------------------
+
+    def _next(self, timeout: Optional[float]) -> Optional[VLMRequest]:
+        if self._held:
+            return self._held.popleft()
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _collect(self) -> List[VLMRequest]:
+        """Block for the next request, then gather batch mates."""
+        first = self._next(None)
+        batch = [first]
+        skipped = []
+        give_up = time.monotonic() + self.batch_wait
+
+        # Held requests first (they were queued earlier), then new arrivals
+        while self._held and len(batch) < self.max_batch:
+            request = self._held.popleft()
+            (batch if request.batch_key == first.batch_key else skipped).append(request)
+        while len(batch) < self.max_batch:
+            remaining = give_up - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            (batch if request.batch_key == first.batch_key else skipped).append(request)
+
+        self._held.extendleft(reversed(skipped))
+        return batch
+
+    def _finish(self, request: VLMRequest, result: Any = None, error: Optional[Exception] = None) -> None:
+        """Resolve a request's future (unless the awaiting side gave up) and forget it."""
+        with self._lock:
+            self._requests.pop(request.request_id, None)
+            if isinstance(error, VLMCancelled):
+                self.cancelled += 1
+            elif error is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+        if not request.future.done():
+            if error is not None:
+                request.future.set_exception(error)
+            else:
+                request.future.set_result(result)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+
+            live = []
+            for request in batch:
+                if request.cancelled:
+                    self._finish(request, error=VLMCancelled("Request cancelled before it started"))
+                else:
+                    live.append(request)
+            if not live:
+                continue
+
+            self.active = len(live)
+            try:
+                model, processor = self.load_model(live[0].model_name)
+                if model is None or processor is None:
+                    raise VLMUnavailable(f"VLM model not available: {live[0].model_name}")
+
+                texts = generate_batch(model, processor, live, self.prefix_cache, self.vision_cache)
+                self.batches += 1
+                self.batched_requests += len(live)
+
+                for request, text in zip(live, texts):
+                    if request.cancelled:
+                        self._finish(request, error=VLMCancelled("Request cancelled during generation"))
+                    else:
+                        self._finish(request, result=text)
+
+            except Exception as e:
+                if not isinstance(e, VLMUnavailable):
+                    logger.exception("VLM batch of %d failed", len(live))
+                for request in live:
+                    if request.request_id in self._requests:
+                        self._finish(request, error=e)
+
+            finally:
+                self.active = 0
+
+
+def parse_intent_json(text: str) -> Optional[Dict[str, Any]]:
+    """Outermost {...} span of a model response parsed as JSON, or None."""
+    import re
+
+    match = re.search(r'\{[\s\S]*\}', text)
+    if not match:
+        return None
+    try:
+        return json.loads(match.group())
+    except json.JSONDecodeError:
+        return None
+
+
+# ============================================================================
+# Incremental intent parsing
+# ============================================================================
+
+# Top-level arrays whose elements are reported one by one as they close
+INTENT_LIST_KEYS = ("cameraIntents", "splineIntents", "layerIntents")
+
+
+class IntentStreamParser:
+    """
+    Incremental parser for the intent JSON while it is still streaming.
+
+    feed() scans only the new text (tracking strings, escapes and nesting)
+    and returns an event for everything that finished in it:
+
+        {"intent": "cameraIntents", "index": 0, "value": {...}}
+            one per element of an INTENT_LIST_KEYS array
+        {"field": "description", "value": "..."}
+            one per other top-level field
+
+    Text before the first "{" (a ```json fence, preamble) is skipped and
+    scanning stops once the top-level object closes.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.done = False
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._state = "start"  # start, key, colon, value, in_value, after
+        self._key: Optional[str] = None
+        self._value_start = 0
+        self._element_start: Optional[int] = None
+        self._element_index = 0
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.text += chunk
+        events = []
+        text = self.text
+
+        for i in range(self._pos, len(text)):
+            if self.done:
+                break
+            c = text[i]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._state == "key":
+                        self._key = self._loads(text[self._string_start:i + 1])
+                        self._state = "colon"
+                continue
+
+            if self._state == "start":
+                if c == '{':
+                    self._depth, self._state = 1, "key"
+                continue
+
+            if c.isspace():
+                continue
+
+            if self._depth == 1 and self._state == "colon":
+                if c == ':':
+                    self._state = "value"
+                continue
+            if self._depth == 1 and self._state == "value":
+                self._value_start, self._state = i, "in_value"
+                self._element_index = 0
+
+            if c == '"':
+                self._in_string, self._string_start = True, i
+            elif c in '{[':
+                if self._depth == 2 and c == '{' and self._key in INTENT_LIST_KEYS:
+                    self._element_start = i
+                self._depth += 1
+            elif c in '}]':
+                self._depth -= 1
+                if self._depth == 2 and self._element_start is not None:
+                    value = self._loads(text[self._element_start:i + 1])
+                    if value is not None:
+                        events.append({"intent": self._key, "index": self._element_index, "value": value})
+                    self._element_index += 1
+                    self._element_start = None
+                elif self._depth == 1:
+                    # A container value just closed
+                    if self._key not in INTENT_LIST_KEYS:
+                        self._emit_field(events, text[self._value_start:i + 1])
+                    self._state = "after"
+                elif self._depth == 0:
+                    # Top-level object closed; a pending scalar ends here
+                    if self._state == "in_value":
+                        self._emit_field(events, text[self._value_start:i])
+                    self.done = True
+            elif c == ',' and self._depth == 1:
+                if self._state == "in_value":
+                    self._emit_field(events, text[self._value_start:i])
+                self._state = "key"
+
+        self._pos = len(text)
+        return events
+
+    def _emit_field(self, events: List[Dict[str, Any]], raw: str) -> None:
+        value = self._loads(raw.strip())
+        if value is not None or raw.strip() == "null":
+            events.append({"field": self._key, "value": value})
+
+    @staticmethod
+    def _loads(raw: str) -> Any:
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Benchmark fast depth (reduced process_res + guided upsampling) against full DepthAnything V3 inference"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+# Import the engine directly so ComfyUI/aiohttp aren't required
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nodes'))
+from lattice_depth import (
+    fit_scale_shift,
+    infer_depth,
+    infer_depth_fast,
+    resize_depth,
+    DEFAULT_FAST_SIZE,
+)
+
+
+def load_model(name):
+    from depth_anything_3.api import DepthAnything3
+    import torch
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return DepthAnything3.from_pretrained(f"depth-anything/{name}").to(device=torch.device(device))
+
+
+def synchronize():
+    """Wait for queued GPU work so timings cover the whole forward pass"""
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def edge_mask(depth, fraction=0.05):
+    """Pixels with the strongest depth gradients (where upsampling errors show)"""
+    gy, gx = np.gradient(depth)
+    magnitude = np.hypot(gx, gy)
+    return magnitude >= np.quantile(magnitude, 1 - fraction)
+
+
+def relative_error(estimate, reference, mask=None):
+    """Mean abs error after a scale/shift fit, relative to the reference's range"""
+    scale, shift = fit_scale_shift(estimate, reference)
+    error = np.abs(estimate * scale + shift - reference)
+    if mask is not None:
+        error = error[mask]
+    return float(error.mean() / (reference.max() - reference.min() + 1e-6))
+
+
+def timed(fn, repeats):
+    """Best wall time of fn() over repeats, after one untimed warm-up call"""
+    result = fn()
+    best = float('inf')
+    for _ in range(repeats):
+        synchronize()
+        start = time.perf_counter()
+        result = fn()
+        synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--model', default='DA3-LARGE-1.1', help='DepthAnything V3 model name')
+    parser.add_argument('--image', action='append', required=True, help='Image to test (repeatable)')
+    parser.add_argument('--fast-size', type=int, default=DEFAULT_FAST_SIZE)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+
+    print(f"{'image':>20} {'size':>10} {'full (ms)':>10} {'fast (ms)':>10} {'speedup':>8} "
+          f"{'err':>8} {'edge err':>9} {'bilinear edge':>14}")
+    for path in args.image:
+        image = np.array(Image.open(path).convert('RGB'))
+        height, width = image.shape[:2]
+
+        # Both sides time the same model.inference() call; only process_res differs
+        full_time, full = timed(lambda: infer_depth(model, [image]), args.repeats)
+        fast_time, fast = timed(lambda: infer_depth_fast(model, image, args.fast_size), args.repeats)
+
+        reference = resize_depth(np.asarray(full['depth'][0]), height, width)
+        low = infer_depth(model, [image], process_res=args.fast_size)
+        bilinear = resize_depth(np.asarray(low['depth'][0]), height, width)
+        edges = edge_mask(reference)
+
+        print(f"{os.path.basename(path)[:20]:>20} {f'{width}x{height}':>10} "
+              f"{full_time * 1000:>10.1f} {fast_time * 1000:>10.1f} "
+              f"{full_time / fast_time:>7.1f}x "
+              f"{relative_error(fast['depth'][0], reference):>8.4f} "
+              f"{relative_error(fast['depth'][0], reference, edges):>9.4f} "
+              f"{relative_error(bilinear, reference, edges):>14.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Benchmark depth back-projection throughput (points/sec) at common resolutions"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+# Import the engine directly so ComfyUI/aiohttp aren't required
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nodes'))
+from lattice_pointcloud import backproject_depth
+
+RESOLUTIONS = {
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4K': (3840, 2160),
+}
+
+
+def make_inputs(width, height, seed=0):
+    """Synthetic depth ramp with noise plus a random RGB image"""
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0.05, 1.0, width, dtype=np.float32)[None, :]
+    depth = np.repeat(ramp, height, axis=0) + rng.random((height, width), dtype=np.float32) * 0.01
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return depth, image
+
+
+def legacy_backproject(depth, image, subsample=1):
+    """Original per-pixel Python loop, kept for comparison"""
+    height, width = depth.shape
+    fx = fy = max(width, height)
+    cx, cy = width / 2, height / 2
+    points, colors = [], []
+    for y in range(0, height, subsample):
+        for x in range(0, width, subsample):
+            z = depth[y, x]
+            if z > 0.01:
+                points.append([(x - cx) * z / fx, (y - cy) * z / fy, z])
+                colors.append(image[y, x].tolist())
+    return np.array(points, dtype=np.float32), np.array(colors, dtype=np.uint8)
+
+
+def bench(fn, depth, image, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        points, _ = fn(depth, image)
+        times.append(time.perf_counter() - start)
+    return min(times), len(points)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--legacy', action='store_true', help='Also time the old Python loop at 720p')
+    args = parser.parse_args()
+
+    print(f"{'resolution':>10} {'points':>10} {'time (ms)':>10} {'Mpts/s':>8}")
+    for name, (width, height) in RESOLUTIONS.items():
+        depth, image = make_inputs(width, height)
+        elapsed, count = bench(backproject_depth, depth, image, args.repeats)
+        print(f"{name:>10} {count:>10} {elapsed * 1000:>10.1f} {count / elapsed / 1e6:>8.1f}")
+
+    if args.legacy:
+        width, height = RESOLUTIONS['720p']
+        depth, image = make_inputs(width, height)
+        elapsed, count = bench(legacy_backproject, depth, image, 1)
+        print(f"{'720p loop':>10} {count:>10} {elapsed * 1000:>10.1f} {count / elapsed / 1e6:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
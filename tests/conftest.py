@@ -0,0 +1,5 @@
+"""Import the engine modules directly so ComfyUI/aiohttp aren't required"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nodes'))
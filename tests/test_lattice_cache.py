@@ -0,0 +1,43 @@
+import numpy as np
+
+from lattice_cache import (
+    nbytes,
+    LRUCache,
+)
+
+
+def test_lru_evicts_least_recently_used_entry():
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_lru_byte_budget():
+    cache = LRUCache(max_bytes=1000)
+    cache.put("a", {"depth": np.zeros(100, dtype=np.float32)})
+    cache.put("b", np.zeros(100, dtype=np.float32))
+    cache.put("too_big", np.zeros(1001, dtype=np.uint8))
+
+    assert cache.get("too_big") is None
+    assert cache.stats()["bytes"] == 800
+
+    # Replacing an entry releases its old size
+    cache.put("a", np.zeros(10, dtype=np.float32))
+    assert cache.stats()["bytes"] == 440
+    # ...and makes it the most recently used
+    cache.put("c", np.zeros(150, dtype=np.float32))
+    assert cache.get("b") is None and cache.get("a") is not None
+
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["max_bytes"]) == (2, 640, 1000)
+
+
+def test_nbytes_nested_values():
+    value = {"a": np.zeros((2, 3), dtype=np.float64), "b": [np.zeros(4, dtype=np.uint8), None], "c": "x"}
+    assert nbytes(value) == 52
@@ -0,0 +1,181 @@
+import base64
+
+import numpy as np
+import pytest
+
+from lattice_depth import (
+    decode_depth,
+    encode_depth,
+    infer_depth,
+    infer_depth_tiled,
+    single_result,
+    RAW_DEPTH_DTYPES,
+)
+
+
+def ramp_depth(height=24, width=40):
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    return 0.5 + 0.05 * xx + 0.02 * yy
+
+
+# ============================================================================
+# Transport encodings
+# ============================================================================
+
+@pytest.mark.parametrize("fmt, atol", [("f32", 0.0), ("f16", 2e-3)])
+def test_raw_depth_roundtrip(fmt, atol):
+    depth = ramp_depth()
+    payload, info = encode_depth(depth, fmt)
+
+    assert (info["width"], info["height"]) == (40, 24)
+    assert len(payload) == 40 * 24 * RAW_DEPTH_DTYPES[fmt].itemsize
+
+    decoded = decode_depth(base64.b64encode(payload).decode(), fmt, shape=(info["height"], info["width"]))
+    assert decoded.dtype == np.float32
+    np.testing.assert_allclose(decoded, depth, atol=atol)
+
+
+@pytest.mark.parametrize("fmt, levels", [("png", 255), ("png16", 65535)])
+def test_png_depth_roundtrip_within_quantization(fmt, levels):
+    depth = ramp_depth()
+    payload, info = encode_depth(depth, fmt)
+
+    decoded = decode_depth(payload, fmt, depth_range=(info["depth_min"], info["depth_max"]))
+    step = (info["depth_max"] - info["depth_min"]) / levels
+    np.testing.assert_allclose(decoded, depth, atol=step)
+
+
+def test_raw_depth_needs_matching_shape():
+    payload, _ = encode_depth(ramp_depth(), "f32")
+    b64 = base64.b64encode(payload).decode()
+
+    with pytest.raises(ValueError):
+        decode_depth(b64, "f32")
+    with pytest.raises(ValueError):
+        decode_depth(b64, "f32", shape=(40, 40))
+
+
+def test_single_result_resizes_to_image():
+    low = ramp_depth(18, 24)
+    raw = {
+        "depth": low[None],
+        "conf": np.ones((1, 18, 24), dtype=np.float32),
+        "intrinsics": np.array([[[20.0, 0.0, 12.0], [0.0, 20.0, 9.0], [0.0, 0.0, 1.0]]]),
+    }
+    entry = single_result(raw, (72, 96))
+
+    assert entry["depth"].shape == entry["conf"].shape == (72, 96)
+    np.testing.assert_allclose(entry["intrinsics"], [[80.0, 0.0, 48.0], [0.0, 80.0, 36.0], [0.0, 0.0, 1.0]])
+    assert single_result(raw)["depth"].shape == (18, 24)
+
+
+# ============================================================================
+# In-memory inference
+# ============================================================================
+
+class PathOnlyModel:
+    def __init__(self):
+        self.seen = []
+
+    def inference(self, images: "list[str]"):
+        self.seen.extend(images)
+        return {"depth": np.stack([ramp_depth() for _ in images])}
+
+
+class FailingModel:
+    def inference(self, images):
+        raise ValueError("bad input")
+
+
+def test_infer_depth_uses_temp_files_only_for_path_wrappers():
+    pytest.importorskip("torch")
+    model = PathOnlyModel()
+    image = np.zeros((24, 40, 3), dtype=np.uint8)
+
+    result = infer_depth(model, [image])
+
+    assert result["depth"].shape == (1, 24, 40)
+    assert len(model.seen) == 1 and isinstance(model.seen[0], str)
+    assert model.inference_accepts_arrays is False
+
+
+def test_infer_depth_propagates_model_errors():
+    pytest.importorskip("torch")
+    with pytest.raises(ValueError):
+        infer_depth(FailingModel(), [np.zeros((8, 8, 3), dtype=np.uint8)])
+
+
+# ============================================================================
+# Tiled inference
+# ============================================================================
+
+class RecordingModel:
+    """Stands in for DA3: depth comes back at the processing resolution."""
+
+    def __init__(self):
+        self.calls = []
+
+    def inference(self, images, process_res=504):
+        height, width = images[0].shape[:2]
+        self.calls.append(((height, width), process_res))
+        factor = process_res / max(height, width)
+        return {"depth": ramp_depth(round(height * factor), round(width * factor))[None]}
+
+
+class PathlessResModel(RecordingModel):
+    def inference(self, images):
+        return super().inference(images, process_res=max(images[0].shape[:2]))
+
+
+def test_tiled_inference_passes_tile_size_as_process_res():
+    pytest.importorskip("torch")
+    model = RecordingModel()
+    image = np.zeros((200, 300, 3), dtype=np.uint8)
+
+    result = infer_depth_tiled(model, image, tile_size=128, overlap=16)
+
+    assert result["depth"].shape == (1, 200, 300)
+    assert result["tiles"] == len(model.calls) - 1 > 1
+    # Global pass and every tile run at the tile size, not DA3's default 504
+    assert all(res == 128 for _, res in model.calls)
+    assert all(max(shape) <= 128 for shape, _ in model.calls[1:])
+
+
+def test_tiled_inference_downscales_for_wrappers_without_process_res():
+    pytest.importorskip("torch")
+    model = PathlessResModel()
+    image = np.zeros((200, 300, 3), dtype=np.uint8)
+
+    result = infer_depth_tiled(model, image, tile_size=128, overlap=16)
+
+    assert result["depth"].shape == (1, 200, 300)
+    assert all(max(shape) <= 128 for shape, _ in model.calls)
+
+
+# ============================================================================
+# Depth to normals
+# ============================================================================
+
+def test_depth_to_normals_tilted_plane():
+    pytest.importorskip("torch")
+    from lattice_depth import depth_to_normals
+
+    height, width = 48, 64
+    fx = fy = 60.0
+    cx, cy = width / 2, height / 2
+    intrinsics = [[fx, 0.0, cx], [0.0, fy, cy], [0.0, 0.0, 1.0]]
+
+    # Camera-space plane z = a x + b y + c
+    a, b, c = 0.3, -0.2, 3.0
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float64)
+    rx, ry = (xx - cx) / fx, (yy - cy) / fy
+    depth = (c / (1 - a * rx - b * ry)).astype(np.float32)
+
+    normals = depth_to_normals(depth, intrinsics, scales=(1, 2), device="cpu")
+
+    assert normals.shape == (height, width, 3)
+    np.testing.assert_allclose(np.linalg.norm(normals, axis=-1), 1.0, atol=1e-4)
+    # Map convention: +Z faces the camera, so n = -(a, b, -1) / |.|
+    expected = np.array([-a, -b, 1.0]) / np.linalg.norm([a, b, 1.0])
+    interior = normals[4:-4, 4:-4].reshape(-1, 3)
+    np.testing.assert_allclose(interior, np.broadcast_to(expected, interior.shape), atol=2e-3)
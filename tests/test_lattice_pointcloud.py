@@ -0,0 +1,200 @@
+import struct
+
+import numpy as np
+import pytest
+
+from lattice_pointcloud import (
+    backproject_depth,
+    encode_splat,
+    gaussians_from_depth,
+    mesh_from_depth,
+    voxel_downsample,
+    PointCloudOctree,
+    SPLAT_DTYPE,
+)
+
+INTRINSICS = [[100.0, 0.0, 32.0], [0.0, 100.0, 24.0], [0.0, 0.0, 1.0]]
+
+
+def plane_depth(height=48, width=64, z=2.0):
+    return np.full((height, width), z, dtype=np.float32)
+
+
+# ============================================================================
+# Back-projection and voxel grid
+# ============================================================================
+
+def test_backproject_pinhole():
+    depth = plane_depth()
+    depth[10, 40] = 4.0
+    points, colors = backproject_depth(depth, intrinsics=INTRINSICS)
+
+    assert points.shape == (48 * 64, 3) and colors is None
+    # Row-major pixel order: pixel (u=40, v=10)
+    x, y, z = points[10 * 64 + 40]
+    assert z == pytest.approx(4.0)
+    assert x == pytest.approx((40 - 32) * 4.0 / 100.0)
+    assert y == pytest.approx((10 - 24) * 4.0 / 100.0)
+
+
+def test_backproject_drops_invalid_and_keeps_colors_aligned():
+    depth = plane_depth()
+    depth[:, :10] = 0.0
+    image = np.zeros((48, 64, 3), dtype=np.uint8)
+    image[..., 0] = np.arange(64, dtype=np.uint8)
+
+    points, colors = backproject_depth(depth, image, INTRINSICS, subsample=2)
+
+    assert len(points) == len(colors) == 24 * 27
+    # Red channel stores the column, which back-projects to x
+    np.testing.assert_allclose(points[:, 0], (colors[:, 0] - 32.0) * 2.0 / 100.0, atol=1e-6)
+
+
+def test_voxel_downsample_averages_each_cell():
+    points = np.array([[0.0, 0.0, 0.0], [0.4, 0.0, 0.0], [5.0, 5.0, 5.0]], dtype=np.float32)
+    colors = np.array([[0, 0, 0], [100, 50, 10], [255, 255, 255]], dtype=np.uint8)
+
+    out_points, out_colors = voxel_downsample(points, colors, voxel_size=1.0)
+
+    assert len(out_points) == 2
+    order = np.argsort(out_points[:, 0])
+    np.testing.assert_allclose(out_points[order], [[0.2, 0.0, 0.0], [5.0, 5.0, 5.0]], atol=1e-6)
+    np.testing.assert_array_equal(out_colors[order], [[50, 25, 5], [255, 255, 255]])
+
+
+def test_voxel_downsample_small_voxels_over_wide_extent():
+    # 1e7 cells per axis: the dense grid would not fit in int64
+    points = np.array([[0.0, 0.0, 0.0], [1e-4, 0.0, 0.0], [1e4, 1e4, 1e4]])
+
+    out_points, _ = voxel_downsample(points, voxel_size=1e-3)
+
+    assert len(out_points) == 2
+    np.testing.assert_allclose(np.sort(out_points[:, 0]), [5e-5, 1e4], rtol=1e-6)
+
+
+def test_voxel_downsample_rejects_bad_size():
+    with pytest.raises(ValueError):
+        voxel_downsample(np.zeros((1, 3), dtype=np.float32), voxel_size=0)
+
+
+# ============================================================================
+# Octree LOD
+# ============================================================================
+
+def test_octree_levels_conserve_mass():
+    rng = np.random.default_rng(0)
+    points = rng.random((5000, 3)).astype(np.float32)
+    colors = rng.integers(0, 256, (5000, 3)).astype(np.uint8)
+    octree = PointCloudOctree(points, colors, max_depth=6)
+
+    counts = octree.level_counts()
+    assert counts[0] == 1
+    assert counts == sorted(counts)
+    assert counts[-1] <= len(points)
+
+    # Level 0 is the centroid of everything
+    root, root_colors = octree.level(0)
+    np.testing.assert_allclose(root[0], points.mean(axis=0), atol=1e-5)
+    np.testing.assert_array_equal(root_colors[0], np.rint(colors.mean(axis=0)))
+
+
+def test_octree_level_for_budget():
+    points = np.random.default_rng(1).random((2000, 3)).astype(np.float32)
+    octree = PointCloudOctree(points, max_depth=8)
+    counts = octree.level_counts()
+
+    level = octree.level_for_budget(300)
+    assert counts[level] <= 300
+    assert level == octree.max_depth or counts[level + 1] > 300
+    assert octree.level_for_budget(0) == 0
+
+    level_points, level_colors = octree.level(level)
+    assert len(level_points) == counts[level] and level_colors is None
+
+
+# ============================================================================
+# Mesh
+# ============================================================================
+
+def test_mesh_flat_plane_decimates_to_exact_surface():
+    mesh = mesh_from_depth(plane_depth(33, 33), intrinsics=INTRINSICS, max_level=5)
+
+    assert mesh["grid_vertices"] == 33 * 33
+    assert len(mesh["vertices"]) < mesh["grid_vertices"]
+    np.testing.assert_allclose(mesh["vertices"][:, 2], 2.0)
+    assert mesh["faces"].max() < len(mesh["vertices"])
+
+    # Triangles tile the grid's footprint exactly, without overlap
+    v = mesh["vertices"][mesh["faces"]][..., :2]
+    cross = (v[:, 1, 0] - v[:, 0, 0]) * (v[:, 2, 1] - v[:, 0, 1]) - (v[:, 1, 1] - v[:, 0, 1]) * (v[:, 2, 0] - v[:, 0, 0])
+    extent = 32 * 2.0 / 100.0
+    assert np.abs(cross).sum() / 2 == pytest.approx(extent * extent, rel=1e-4)
+    assert np.all(np.sign(cross) == np.sign(cross[0]))
+
+
+def test_mesh_breaks_at_discontinuity():
+    depth = plane_depth(16, 16)
+    depth[:, 8:] = 6.0
+    mesh = mesh_from_depth(depth, intrinsics=INTRINSICS, tolerance=0.0)
+
+    # No triangle spans the 2 -> 6 jump
+    z = mesh["vertices"][mesh["faces"]][..., 2]
+    assert np.all(z.max(axis=1) / z.min(axis=1) < 1.1)
+
+
+def test_mesh_colors_follow_vertices():
+    image = np.zeros((16, 16, 3), dtype=np.uint8)
+    image[..., 1] = np.arange(16, dtype=np.uint8)[:, None] * 10
+    mesh = mesh_from_depth(plane_depth(16, 16), image, INTRINSICS, step=3)
+
+    rows = np.rint(mesh["vertices"][:, 1] * 100.0 / 2.0 + 24).astype(int)
+    np.testing.assert_array_equal(mesh["colors"][:, 1], rows * 10)
+
+
+# ============================================================================
+# Gaussian splats
+# ============================================================================
+
+def test_splats_face_camera_on_fronto_parallel_plane():
+    splats = gaussians_from_depth(plane_depth(), intrinsics=INTRINSICS, max_splats=None)
+
+    assert len(splats["positions"]) == splats["source_points"] == 48 * 64
+    np.testing.assert_allclose(np.linalg.norm(splats["rotations"], axis=1), 1.0, atol=1e-5)
+    # Pixel footprint at z=2, f=100 is 0.02; the thin axis is along the normal
+    assert np.all(splats["scales"][:, 2] < splats["scales"][:, 1])
+    assert np.all(np.abs(splats["normals"][:, 2]) > 0.9)
+
+
+def test_splat_budget_is_respected():
+    splats = gaussians_from_depth(plane_depth(), intrinsics=INTRINSICS, max_splats=500)
+    assert 0 < len(splats["positions"]) <= 500
+    assert splats["voxel_size"] is not None
+
+
+def test_splat_merge_small_voxels_over_wide_extent():
+    depth = plane_depth(8, 8)
+    depth[0, 0] = 1e6
+    unmerged = gaussians_from_depth(depth, intrinsics=INTRINSICS, max_splats=None)
+    # Voxels far smaller than the pixel footprint merge nothing
+    splats = gaussians_from_depth(depth, intrinsics=INTRINSICS, voxel_size=1e-4, max_splats=None)
+    assert len(splats["positions"]) == len(unmerged["positions"])
+
+
+def test_encode_splat_layout():
+    image = np.full((48, 64, 4), 255, dtype=np.uint8)
+    image[:, :32, 3] = 0
+    splats = gaussians_from_depth(plane_depth(), image, INTRINSICS, max_splats=None)
+    payload = encode_splat(splats)
+
+    assert SPLAT_DTYPE.itemsize == 32
+    assert len(payload) == 32 * len(splats["positions"]) == 32 * 48 * 32
+    records = np.frombuffer(payload, dtype=SPLAT_DTYPE)
+
+    # Sorted by size x opacity, largest first
+    volume = np.prod(records['scale'], axis=1)
+    assert np.all(np.diff(volume) <= 1e-12)
+    # Quaternions round-trip through the uint8 mapping
+    quats = (records['rotation'].astype(np.float32) - 128) / 128
+    np.testing.assert_allclose(np.linalg.norm(quats, axis=1), 1.0, atol=0.02)
+    x, y, z = struct.unpack('<3f', payload[:12])
+    assert z == pytest.approx(2.0)
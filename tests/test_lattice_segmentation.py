@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from lattice_segmentation import (
+    encode_mask_rle,
+    region_grow_mask,
+    rle_counts,
+    MaskIndex,
+)
+
+
+def disk(shape, cx, cy, r):
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    return (xx - cx) ** 2 + (yy - cy) ** 2 <= r * r
+
+
+# ============================================================================
+# RLE
+# ============================================================================
+
+def test_rle_counts_column_major_starting_with_zeros():
+    mask = np.array([[1, 0], [1, 1]], dtype=bool)
+    # Column-major: 1, 1, 0, 1
+    assert rle_counts(mask).tolist() == [0, 2, 1, 1]
+    assert rle_counts(np.zeros((2, 3), dtype=bool)).tolist() == [6]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_encode_mask_rle_matches_pycocotools(seed):
+    mask_utils = pytest.importorskip("pycocotools.mask")
+    rng = np.random.default_rng(seed)
+    mask = disk((67, 91), *rng.integers(10, 60, 2), rng.integers(3, 40))
+    mask ^= rng.random(mask.shape) < 0.02
+
+    expected = mask_utils.encode(np.asfortranarray(mask.astype(np.uint8)))
+    encoded = encode_mask_rle(mask)
+
+    assert encoded["size"] == [67, 91]
+    assert encoded["counts"] == expected["counts"].decode("ascii")
+    np.testing.assert_array_equal(
+        mask_utils.decode({"size": encoded["size"], "counts": encoded["counts"].encode("ascii")}), mask)
+
+
+# ============================================================================
+# Mask index
+# ============================================================================
+
+def make_index():
+    shape = (40, 60)
+    big = np.zeros(shape, dtype=bool)
+    big[5:35, 5:55] = True
+    small = disk(shape, 20, 20, 6)
+    other = disk(shape, 45, 20, 4)
+    masks = [
+        {"mask": small, "area": int(small.sum()), "score": 0.9},
+        {"mask": big, "area": int(big.sum()), "score": 0.8},
+        {"mask": other, "area": int(other.sum()), "score": 0.7},
+    ]
+    return MaskIndex(masks, shape), big, small, other
+
+
+def test_mask_index_orders_by_area_and_roundtrips_masks():
+    index, big, small, other = make_index()
+
+    assert len(index) == 3
+    assert [e["area"] for e in index.entries] == sorted((e["area"] for e in index.entries), reverse=True)
+    np.testing.assert_array_equal(index.mask(0), big)
+    np.testing.assert_array_equal(index.mask(1), small)
+    np.testing.assert_array_equal(index.mask(2), other)
+
+
+def test_mask_index_lookup_innermost_first():
+    index, _, _, _ = make_index()
+
+    assert index.lookup(20, 20) == [1, 0]
+    assert index.top(20, 20) == 1
+    assert index.lookup(50, 30) == [0]
+    assert index.lookup(2, 2) == [] and index.top(2, 2) == -1
+    assert index.top(-1, 500) == -1
+
+
+# ============================================================================
+# Region growing fallback
+# ============================================================================
+
+def test_region_grow_selects_connected_similar_region():
+    image = np.zeros((30, 30, 3), dtype=np.uint8)
+    image[:, 15:] = 200
+    # Same color as the left half but not connected to it
+    image[10:20, 20:25] = 5
+
+    mask = region_grow_mask(image, [[3, 3]], tolerance=10)
+
+    assert mask[:, :15].all()
+    assert not mask[:, 15:].any()
+
+
+def test_region_grow_background_points_subtract():
+    image = np.zeros((30, 30, 3), dtype=np.uint8)
+    image[10:20, 10:20] = 100
+    image[12:18, 12:18] = 200
+
+    mask = region_grow_mask(image, [[0, 0], [15, 15]], [1, 0], tolerance=10)
+    assert mask[0, 0] and not mask[15, 15] and not mask[11, 11]
+
+    both = region_grow_mask(image, [[0, 0], [11, 11]], tolerance=10)
+    assert both[11, 11] and both[0, 0] and not both[15, 15]
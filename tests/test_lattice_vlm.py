@@ -0,0 +1,212 @@
+import json
+
+import pytest
+
+from lattice_vlm import (
+    parse_intent_json,
+    IntentStreamParser,
+    JsonSchemaLogitsProcessor,
+    JsonSchemaMachine,
+    MAX_JSON_WHITESPACE,
+)
+
+POINT = {"type": ["object", "null"], "properties": {"x": {"type": "number"}, "y": {"type": "number"}},
+         "required": ["x", "y"]}
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "description": {"type": "string"},
+        "confidence": {"type": "number"},
+        "cameraIntents": {"type": "array", "items": {
+            "type": "object",
+            "properties": {
+                "type": {"enum": ["dolly", "pan", "orbit"]},
+                "durationFrames": {"type": "integer"},
+                "handle": POINT,
+                "loop": {"type": "boolean"}
+            },
+            "required": ["type"]
+        }}
+    },
+    "required": ["description", "cameraIntents"]
+}
+
+VALID = {
+    "description": "slow \"push\"\n in é",
+    "confidence": -1.5e-3,
+    "cameraIntents": [
+        {"type": "dolly", "durationFrames": 81, "handle": None, "loop": False},
+        {"handle": {"x": 0, "y": 12.25}, "type": "orbit", "loop": True}
+    ]
+}
+
+
+def feed(text, schema=SCHEMA):
+    machine = JsonSchemaMachine(schema)
+    return machine.feed(text), machine
+
+
+# ============================================================================
+# Constrained decoding state machine
+# ============================================================================
+
+@pytest.mark.parametrize("text", [
+    json.dumps(VALID),
+    json.dumps(VALID, indent=2),
+    json.dumps(VALID, ensure_ascii=False),
+    '{"description": "", "cameraIntents": []}',
+])
+def test_schema_machine_accepts_valid_documents(text):
+    ok, machine = feed(text)
+    assert ok and machine.done
+    assert machine.feed("\n ")
+    assert not machine.feed("x")
+
+
+@pytest.mark.parametrize("text", [
+    'Here is the JSON: {',                                        # preamble
+    '{"foo": 1',                                                  # unknown key
+    '{"description": "a", "description"',                         # duplicate key
+    '{"description": "a"}',                                       # missing required
+    '{"description": "a", "cameraIntents": [{}',                  # missing nested required
+    '{"cameraIntents": [{"type": "spin"',                         # not in enum
+    '{"cameraIntents": [{"type": "do\\u006cly"',                  # escapes in enums
+    '{"confidence": 01',                                          # leading zero
+    '{"confidence": 1.}',                                         # dangling fraction
+    '{"cameraIntents": [{"durationFrames": 8.5',                  # integer field
+    '{"cameraIntents": [{"loop": tru ',                           # broken literal
+    '{"cameraIntents": [{"handle": "x"',                          # wrong type
+    '{"description": "a\x01',                                     # control character
+    '{"description": "a",}',                                      # trailing comma
+    '{' + ' ' * (MAX_JSON_WHITESPACE + 1),                        # runaway whitespace
+])
+def test_schema_machine_rejects_invalid_prefixes(text):
+    ok, machine = feed(text)
+    assert not ok and machine.failed and not machine.done
+
+
+def test_schema_machine_accepts_partial_prefixes():
+    text = json.dumps(VALID)
+    machine = JsonSchemaMachine(SCHEMA)
+    for i, ch in enumerate(text):
+        assert machine.feed(ch), text[:i + 1]
+        assert machine.done == (i == len(text) - 1)
+
+
+def test_schema_machine_copy_is_independent():
+    ok, machine = feed('{"description": "a", "confidence": 1')
+    assert ok
+
+    # A number ends only when the next character arrives
+    assert machine.copy().feed("2")
+    assert machine.copy().feed(",")
+    assert not machine.copy().feed("}")  # cameraIntents still required
+    assert not machine.done and not machine.failed
+
+
+# ============================================================================
+# Constrained decoding logits processor
+# ============================================================================
+
+MOVE_SCHEMA = {
+    "type": "object",
+    "properties": {"type": {"enum": ["dolly", "pan"]}, "frames": {"type": "integer"}},
+    "required": ["type", "frames"]
+}
+
+
+class ToyTokenizer:
+    """Token id -> text; the last id is EOS."""
+
+    def __init__(self, vocab):
+        self.vocab = list(vocab) + ["</s>"]
+        self.eos_token_id = len(self.vocab) - 1
+        self.all_special_ids = [self.eos_token_id]
+
+    def decode(self, ids, skip_special_tokens=False):
+        return "".join(self.vocab[i] for i in ids)
+
+
+def greedy_decode(tokenizer, processor, scores, steps=40):
+    import torch
+
+    input_ids = torch.zeros((1, 1), dtype=torch.long)
+    for _ in range(steps):
+        masked = processor(input_ids, scores[None].clone())
+        token = int(masked[0].argmax())
+        input_ids = torch.cat([input_ids, torch.tensor([[token]])], dim=1)
+        processor.advance(input_ids)
+        if token == tokenizer.eos_token_id or processor.finished(0):
+            break
+    return "".join(tokenizer.vocab[t] for t in input_ids[0, 1:].tolist() if t != tokenizer.eos_token_id)
+
+
+def test_logits_processor_forces_schema_when_top_tokens_are_invalid():
+    torch = pytest.importorskip("torch")
+    # The model strongly prefers prose; every schema token ranks below it
+    vocab = ["Sure", " thing", "!", "hello", "{", "}", '"', "type", "frames", ":", ",", "pan", "dolly",
+             '"pan"', "1", "2", "4", "x"]
+    tokenizer = ToyTokenizer(vocab)
+    scores = -torch.arange(len(tokenizer.vocab), dtype=torch.float32)
+
+    processor = JsonSchemaLogitsProcessor(tokenizer, MOVE_SCHEMA, prompt_length=1, batch_size=1, top_k=2)
+    first = processor(torch.zeros((1, 1), dtype=torch.long), scores[None].clone())
+    # Only the grammar's valid first tokens survive, not the whole vocabulary
+    assert torch.isfinite(first[0]).nonzero().ravel().tolist() == [vocab.index("{")]
+
+    processor = JsonSchemaLogitsProcessor(tokenizer, MOVE_SCHEMA, prompt_length=1, batch_size=1, top_k=2)
+    text = greedy_decode(tokenizer, processor, scores)
+
+    assert json.loads(text) == {"type": "pan", "frames": 1}
+    assert processor.machines[0].done and not processor.machines[0].failed
+
+
+def test_logits_processor_fails_closed_without_valid_continuation():
+    torch = pytest.importorskip("torch")
+    # No quote token: the object can never get its required keys
+    tokenizer = ToyTokenizer(["hello", "{", "}", "type", ":"])
+    scores = torch.zeros(len(tokenizer.vocab))
+
+    processor = JsonSchemaLogitsProcessor(tokenizer, MOVE_SCHEMA, prompt_length=1, batch_size=1)
+    text = greedy_decode(tokenizer, processor, scores)
+
+    assert text == "{"
+    assert processor.machines[0].failed and processor.finished(0)
+
+
+# ============================================================================
+# Incremental intent parsing
+# ============================================================================
+
+def test_intent_stream_parser_emits_events_as_values_close():
+    text = "```json\n" + json.dumps({
+        "description": "orbit the {subject}",
+        "confidence": 0.8,
+        "cameraIntents": [{"type": "orbit"}, {"type": "dolly", "axis": "z"}],
+        "layerIntents": []
+    }) + "\n```"
+
+    parser = IntentStreamParser()
+    events = []
+    for ch in text:
+        events.extend(parser.feed(ch))
+
+    assert events == [
+        {"field": "description", "value": "orbit the {subject}"},
+        {"field": "confidence", "value": 0.8},
+        {"intent": "cameraIntents", "index": 0, "value": {"type": "orbit"}},
+        {"intent": "cameraIntents", "index": 1, "value": {"type": "dolly", "axis": "z"}},
+    ]
+    assert parser.done
+
+
+def test_intent_stream_parser_waits_for_unfinished_values():
+    parser = IntentStreamParser()
+    assert parser.feed('{"cameraIntents": [{"type": "pa') == []
+    assert parser.feed('n"}') == [{"intent": "cameraIntents", "index": 0, "value": {"type": "pan"}}]
+    assert not parser.done
+
+
+def test_parse_intent_json_strips_surrounding_text():
+    assert parse_intent_json('Sure!\n```json\n{"a": {"b": 1}}\n```') == {"a": {"b": 1}}
+    assert parse_intent_json("no json here") is None